@@ -31,6 +31,10 @@ typedef enum {
 #define CRC_BYTE_MUM 4
 #define CS_BYTE_NUM 1
 #define COR_BYTE_OFS (CRC_BYTE_MUM - CS_BYTE_NUM)
+/* len, cmd, seq, 4b address, req_ack, 4b crc */
+#define WRITE_SEQ_OVERHEAD 12
+/* len, cmd, seq, 4b address, 2b decoded length, req_ack, 4b crc */
+#define WRITE_RLE_OVERHEAD 14
 
 
 
@@ -10,6 +10,8 @@
  */
 
 #define REQ_ACK 0x01
+/* len, cmd, 4b entry address, req_ack, checksum */
+#define EXIT_BLD_ENTRY_LEN 8
 
 typedef enum
 {
@@ -24,6 +26,11 @@ typedef enum
   CMD_IMAGE_CRC_VERIFY,
   CMD_SYSRST,
   CMD_EXIT_BLD,
+  CMD_WRITE_SEQ,
+  CMD_GET_CAPS,
+  CMD_SECTOR_CRC,
+  CMD_WRITE_RLE,
+  CMD_SET_BAUD,
   CMD_NUM,
   CMD_UNDEFINED = 0xFF
 } bld_cmd_e;
@@ -39,5 +46,6 @@ typedef enum
  */
 int  hal_bld_verify_app_mem(uint32_t start_adr);
 void hal_bld_go_to_main_app(uint32_t jump_addr);
+void hal_bld_go_to_entry(uint32_t entry_addr);
 
 #endif // HAL_BLD_H
\ No newline at end of file
@@ -3,13 +3,15 @@
 
 #include "bootloader.h"
 #include "hal_bld.h"
+#include "bld/bld.h"
 #include <string.h>
 
 /**
  *  VARIABLES AND DEFINES
  *===================================================================
  */
-#define UART_RX_LEN_MAX 256
+#define UART_RX_LEN_MAX BLD_RX_SLOT_LEN
+#define FRAME_LEN_MIN 3 // len, cmd, checksum
 #define UART_END_BYTE 0xFE
 
 /**
@@ -32,14 +34,17 @@ void hal_uart_burst_write(UART_Regs *const reg, uint8_t *data, uint8_t size);
  */
 bld_cmd_e hal_uart_read_cmd(void);
 void hal_uart_resp(UART_Regs *const reg, uint8_t *data, uint8_t size);
+bool hal_uart_switch_baud(UART_Regs *const reg, const bld_baud_div_t *div);
+void hal_uart_rx_idle_poll(void);
 
 /**
  *                       FETCH DATA
  *===================================================================
  */
 
-void hal_uart_fetch_rx_buf(uint8_t *buf, uint16_t len);
-uint8_t hal_uart_fetch_rx_buf_cnt(void);
+uint8_t *hal_uart_fetch_frame(void);
+void hal_uart_release_frame(void);
+bool hal_uart_frame_ready(void);
 
 /**
  *                       INTERRUPT HANDLER
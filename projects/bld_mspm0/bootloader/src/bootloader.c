@@ -13,6 +13,7 @@
 
 volatile bld_state_e sys_state = BLD_IDLE;
 volatile bld_cmd_e host_cmd = CMD_NOP;
+static bld_seq_t write_seq; // pipelined writes already programmed
 
 /**
  *  Enter application
@@ -38,11 +39,10 @@ static bool is_enter_app_triggred(void) {
  */
 
 static void bld_exe_cmd(void) {
-  uint8_t rx_buffer[UART_RX_LEN_MAX];
+  uint8_t *rx_buffer = hal_uart_fetch_frame(); // frame is used in place
   uint32_t addr = 0;
   uint32_t size = 0;
 
-  hal_uart_fetch_rx_buf(rx_buffer, sizeof(rx_buffer)); // copy rx buffer
   switch (host_cmd) {
 
   case CMD_GET_BLD_VER: {
@@ -67,6 +67,7 @@ static void bld_exe_cmd(void) {
       hal_uart_resp(UART_0_INST, (uint8_t *)&is_blank, sizeof(is_blank));
     } else {
       hal_flash_erase_mem(addr, size);
+      bld_seq_reset(&write_seq); // new image, sequence numbers restart
       if (rx_buffer[rx_buffer[0] - 2] == REQ_ACK) {
         uint8_t ret = 0x01;
         hal_uart_resp(UART_0_INST, (uint8_t *)&ret, sizeof(ret));
@@ -108,6 +109,91 @@ static void bld_exe_cmd(void) {
 
   } break;
 
+  case CMD_WRITE_SEQ: {
+    /* Pipelined write: len, cmd, seq, 4b address, n data, req_ack, 4b crc.
+     * The host keeps several frames in flight and matches ACKs by seq.
+     * This is the only command sent in extended frames (16-bit len), so
+     * fields are read relative to the cmd byte.
+     */
+    uint8_t *frame = rx_buffer + bld_frame_hdr_len(rx_buffer) - 1;
+    uint16_t data_len = bld_frame_len(rx_buffer) - WRITE_SEQ_OVERHEAD -
+                        (bld_frame_hdr_len(rx_buffer) - BLD_FRAME_HDR_LEN);
+    uint8_t seq = frame[2];
+    for (int i = 0; i < 4; i++) {
+      addr |= frame[3 + i] << (24 - i * 8);
+    }
+
+    /* A frame resent because its ACK was lost is only acknowledged */
+    if (!bld_seq_is_done(&write_seq, seq)) {
+      uint32_t write_buffer = 0x00;
+      for (int i = 0; i < data_len; i += 4) {
+        for (int j = 0; j < 4; j++) {
+          write_buffer |= frame[7 + i + j] << (24 - j * 8);
+        }
+        hal_flash_write_mem_32bit(addr + i, write_buffer);
+        write_buffer = 0x00;
+      }
+      bld_seq_mark(&write_seq, seq);
+    }
+
+    uint8_t ack[2] = {0x01, seq};
+    hal_uart_resp(UART_0_INST, ack, sizeof(ack));
+  } break;
+
+  case CMD_WRITE_RLE: {
+    /* Compressed pipelined write: len, cmd, seq, 4b address, 2b decoded
+     * length, rle payload, req_ack, 4b crc. Expanded straight into flash,
+     * see bld_rle_expand().
+     */
+    uint8_t *frame = rx_buffer + bld_frame_hdr_len(rx_buffer) - 1;
+    uint16_t rle_len = bld_frame_len(rx_buffer) - WRITE_RLE_OVERHEAD -
+                       (bld_frame_hdr_len(rx_buffer) - BLD_FRAME_HDR_LEN);
+    uint8_t seq = frame[2];
+    for (int i = 0; i < 4; i++) {
+      addr |= frame[3 + i] << (24 - i * 8);
+    }
+    size = (frame[7] << 8) | frame[8];
+
+    uint8_t ack[2] = {0x01, seq};
+    if (!bld_seq_is_done(&write_seq, seq)) {
+      if (bld_rle_expand(&frame[9], rle_len, addr, size,
+                         hal_flash_write_mem_32bit)) {
+        bld_seq_mark(&write_seq, seq);
+      } else {
+        ack[0] = 0x00;
+      }
+    }
+    hal_uart_resp(UART_0_INST, ack, sizeof(ack));
+  } break;
+
+  case CMD_GET_CAPS: {
+    /* Lets the host size its frames to the RX buffer. Every upload starts
+     * with this query, sequence numbers restart here as well since blank
+     * sectors may be written without a preceding erase. */
+    bld_seq_reset(&write_seq);
+    uint8_t caps[BLD_CAPS_LEN];
+    bld_get_caps(caps);
+    caps[3] |= BLD_CAPS_SET_BAUD;
+    hal_uart_resp(UART_0_INST, caps, sizeof(caps));
+  } break;
+
+  case CMD_SET_BAUD: {
+    /* len, cmd, 4b baudrate, req_ack, checksum. The ACK goes out at the
+     * current rate, then the UART waits for the host at the new one.
+     */
+    uint32_t baud = 0;
+    bld_baud_div_t div;
+    for (int i = 0; i < 4; i++) {
+      baud |= rx_buffer[2 + i] << (24 - i * 8);
+    }
+
+    uint8_t ret = bld_baud_divisor(UART_0_INST_FREQUENCY, baud, &div);
+    hal_uart_resp(UART_0_INST, (uint8_t *)&ret, sizeof(ret));
+    if (ret) {
+      hal_uart_switch_baud(UART_0_INST, &div);
+    }
+  } break;
+
   case CMD_IMAGE_CRC_VERIFY: {
     /**
      * This command is meant for flash image crc check
@@ -122,21 +208,63 @@ static void bld_exe_cmd(void) {
 
     uint32_t calc_crc = crc32_lookup_tb(0, size, (uint8_t *)(addr));
 
-    uint8_t ret;
-    if (calc_crc != ref_crc) {
-      ret = 0x00;
-    }
+    /* ACK only if the flash content matches */
+    uint8_t ret = (calc_crc == ref_crc) ? 0x01 : 0x00;
 
     if (rx_buffer[rx_buffer[0] - 2] == REQ_ACK) {
-      ret = 0x01;
       hal_uart_resp(UART_0_INST, (uint8_t *)&ret, sizeof(ret));
     }
 
   } break;
+
+  case CMD_SECTOR_CRC: {
+    /**
+     * Per-sector CRCs for delta updates: len, cmd, 4b address, count,
+     * req_ack, checksum. Answered with one big endian CRC32 per SECTOR_SIZE
+     * from address, the host then only rewrites the sectors that differ.
+     */
+    for (int i = 0; i < 4; i++) {
+      addr |= rx_buffer[2 + i] << (24 - i * 8);
+    }
+    uint8_t count = rx_buffer[6];
+    if (count > BLD_SECTOR_CRC_MAX) {
+      count = BLD_SECTOR_CRC_MAX;
+    }
+    /* never read outside the flash */
+    if (addr >= FLASH_END_ADDR) {
+      count = 0;
+    } else if (count > (FLASH_END_ADDR - addr) / SECTOR_SIZE) {
+      count = (FLASH_END_ADDR - addr) / SECTOR_SIZE;
+    }
+
+    uint8_t sector_crc[BLD_SECTOR_CRC_MAX * 4];
+    for (uint8_t n = 0; n < count; n++) {
+      uint32_t crc =
+          crc32_lookup_tb(0, SECTOR_SIZE, (uint8_t *)(addr + n * SECTOR_SIZE));
+      for (int i = 0; i < 4; i++) {
+        sector_crc[n * 4 + i] = (crc >> (24 - i * 8)) & 0xFF;
+      }
+    }
+    hal_uart_resp(UART_0_INST, sector_crc, count * 4);
+  } break;
   case CMD_EXIT_BLD: {
     if (is_enter_app_triggred()) {
-      hal_uart_resp(UART_0_INST, (uint8_t *)(0x01), 1);
-      hal_bld_go_to_main_app(FLASH_MAIN_APP_ADDR);
+      /* Host may send the image entry point (4 bytes) */
+      uint32_t entry_addr = 0;
+      if (rx_buffer[0] == EXIT_BLD_ENTRY_LEN) {
+        for (int i = 0; i < 4; i++) {
+          entry_addr |= rx_buffer[2 + i] << (24 - i * 8);
+        }
+      }
+
+      uint8_t ret = 0x01;
+      hal_uart_resp(UART_0_INST, (uint8_t *)&ret, sizeof(ret));
+      if ((entry_addr >= FLASH_APP_START) &&
+          (entry_addr < FLASH_APP_START + FLASH_APP_SIZE)) {
+        hal_bld_go_to_entry(entry_addr);
+      } else {
+        hal_bld_go_to_main_app(FLASH_MAIN_APP_ADDR);
+      }
     }
   } break;
 
@@ -161,22 +289,28 @@ int main(void) {
   /*===============^^^================*/
   /* Instaying in bootloader */
 
+  bld_seq_reset(&write_seq);
   hal_uart_en_irq();
 
   while (1) {
     switch (sys_state) {
     case BLD_IDLE: {
+      /* Next frame may already be queued while the last one executed */
+      if (hal_uart_frame_ready()) {
+        sys_state = BLD_READ_CMD;
+      } else {
+        hal_uart_rx_idle_poll();
+      }
     } break;
 
     case BLD_READ_CMD: {
-      host_cmd = hal_uart_read_cmd();
-      if (host_cmd != CMD_UNDEFINED) {
-        sys_state = BLD_EXE_CMD;
-      }
+      host_cmd = hal_uart_read_cmd(); // invalid frames are dropped here
+      sys_state = (host_cmd != CMD_UNDEFINED) ? BLD_EXE_CMD : BLD_IDLE;
     } break;
 
     case BLD_EXE_CMD: {
       bld_exe_cmd();
+      hal_uart_release_frame();
       sys_state = BLD_IDLE;
     } break;
 
@@ -24,7 +24,21 @@ void hal_bld_go_to_main_app(uint32_t jump_addr) {
   typedef void (*pfunction)(void);
   pfunction jump_to_app;
 
+  SysTick->CTRL = 0; // RX idle timer of the bootloader
   app_addr = *(uint32_t *)(jump_addr + 0x04);
   jump_to_app = (pfunction)app_addr;
   jump_to_app();
+}
+
+/**
+ * @brief Jump to the application entry point given by the host
+ * @note  Cortex-M only runs in thumb state, so bit 0 is forced to 1
+ */
+void hal_bld_go_to_entry(uint32_t entry_addr) {
+  typedef void (*pfunction)(void);
+  pfunction jump_to_app;
+
+  SysTick->CTRL = 0; // RX idle timer of the bootloader
+  jump_to_app = (pfunction)(entry_addr | 0x01);
+  jump_to_app();
 }
\ No newline at end of file
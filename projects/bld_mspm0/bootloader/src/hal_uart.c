@@ -7,22 +7,32 @@
 #include "utils/checksum.h"
 #include "utils/crc.h"
 
-extern volatile bld_state_e sys_state;
-
 /**
  *  VARIABLES
  *===================================================================
  */
 
-static uint8_t rx_buf_cnt = 0; // rx buffer counter
-static uint8_t rx_buf[UART_RX_LEN_MAX];
+static bld_rx_queue_t rx_queue; // frames received from the host
+static uint32_t rx_idle_ticks;   // SysTick ticks, see bld_rx_idle_ticks()
 
 /**
  *  SETUPS
  *===================================================================
  */
 
+static void hal_uart_rx_idle_config(UART_Regs *const reg) {
+  bld_baud_div_t div = {.ibrd = reg->IBRD, .fbrd = reg->FBRD};
+  rx_idle_ticks = bld_rx_idle_ticks(CPUCLK_FREQ, UART_0_INST_FREQUENCY, &div);
+}
+
 void hal_uart_en_irq(void) {
+  /* free running without interrupt, hal_uart_rx_idle_poll() reads it */
+  SysTick->LOAD = SysTick_LOAD_RELOAD_Msk;
+  SysTick->VAL = 0;
+  SysTick->CTRL = SysTick_CTRL_CLKSOURCE_Msk | SysTick_CTRL_ENABLE_Msk;
+  hal_uart_rx_idle_config(UART_0_INST);
+
+  bld_rx_queue_init(&rx_queue);
   NVIC_ClearPendingIRQ(UART_0_INST_INT_IRQN);
   NVIC_EnableIRQ(UART_0_INST_INT_IRQN);
 }
@@ -52,24 +62,42 @@ void hal_uart_burst_write(UART_Regs *const reg, uint8_t *data, uint8_t size) {
  *===================================================================
  */
 bld_cmd_e hal_uart_read_cmd(void) {
+  uint8_t *rx_buf = bld_rx_queue_peek(&rx_queue);
+  if (rx_buf == NULL) {
+    return CMD_UNDEFINED;
+  }
+  uint16_t rx_buf_cnt = bld_frame_len(rx_buf);
+  uint8_t hdr = bld_frame_hdr_len(rx_buf); // offset of the cmd byte
 
   /* Verify rx data*/
-  
+  if (rx_buf_cnt < hdr + FRAME_LEN_MIN - 1) {
+    bld_rx_queue_release(&rx_queue);
+    return CMD_UNDEFINED;
+  }
+
   // in case of crc
-  if (rx_buf[1] == CMD_WRITE_CRC) {    
+  if ((rx_buf[hdr] == CMD_WRITE_CRC) || (rx_buf[hdr] == CMD_WRITE_SEQ) ||
+      (rx_buf[hdr] == CMD_WRITE_RLE)) {
     uint32_t crc_result = crc32_lookup_tb(0, rx_buf_cnt - 4, rx_buf);
     for (int i = 0; i < 4; i++) {
       if (rx_buf[rx_buf_cnt - 1 - i] != ((crc_result >> (8 * i)) & 0xFF)) {
+        /* Corrupted pipelined write, tell the host which one to resend */
+        if (rx_buf[hdr] != CMD_WRITE_CRC) {
+          uint8_t nack[2] = {0x00, rx_buf[hdr + 1]};
+          hal_uart_resp(UART_0_INST, nack, sizeof(nack));
+        }
+        bld_rx_queue_release(&rx_queue);
         return CMD_UNDEFINED;
       }
     }
-  } else if (rx_buf[rx_buf_cnt - 1] != calc_checksum(rx_buf, rx_buf_cnt - 1)) {
+  } else if ((hdr != BLD_FRAME_HDR_LEN) ||
+             (rx_buf[rx_buf_cnt - 1] != calc_checksum(rx_buf, rx_buf_cnt - 1))) {
+    /* only CRC protected commands may use extended frames */
+    bld_rx_queue_release(&rx_queue);
     return CMD_UNDEFINED;
   }
 
-  /* reset data package */
-  rx_buf_cnt = 0;
-  return rx_buf[1];
+  return rx_buf[hdr];
 }
 
 void hal_uart_resp(UART_Regs *const reg, uint8_t *data, uint8_t size) {
@@ -84,18 +112,86 @@ void hal_uart_resp(UART_Regs *const reg, uint8_t *data, uint8_t size) {
   hal_uart_burst_write(reg, tx_buf, size + 2);
 }
 
+static void hal_uart_set_divisor(UART_Regs *const reg, uint32_t ibrd,
+                                 uint32_t fbrd) {
+  while (DL_UART_Main_isBusy(reg)) {
+    // let the last response byte out at the old baudrate
+  }
+  NVIC_DisableIRQ(UART_0_INST_INT_IRQN);
+  DL_UART_Main_disable(reg);
+  DL_UART_Main_setBaudRateDivisor(reg, ibrd, fbrd);
+  DL_UART_Main_enable(reg);
+  hal_uart_rx_idle_config(reg);
+  /* bytes caught across the switch are garbage */
+  bld_rx_queue_drop_partial(&rx_queue);
+  NVIC_EnableIRQ(UART_0_INST_INT_IRQN);
+}
+
+/* Switch baudrate once the CMD_SET_BAUD ACK is out. The host confirms with
+ * a frame at the new rate, without one within BLD_BAUD_CONFIRM_MS the old
+ * divisors are restored so a failed switch never strands the device.
+ */
+bool hal_uart_switch_baud(UART_Regs *const reg, const bld_baud_div_t *div) {
+  uint32_t old_ibrd = reg->IBRD;
+  uint32_t old_fbrd = reg->FBRD;
+  uint8_t used = rx_queue.used; // the CMD_SET_BAUD frame is still held
+
+  hal_uart_set_divisor(reg, div->ibrd, div->fbrd);
+  for (uint32_t ms = 0; ms < BLD_BAUD_CONFIRM_MS; ms++) {
+    if (rx_queue.used > used) {
+      return true;
+    }
+    delay_cycles(CPUCLK_FREQ / 1000);
+  }
+
+  hal_uart_set_divisor(reg, old_ibrd, old_fbrd);
+  return false;
+}
+
+/* Called from the idle loop, returns at once. Drops a partial frame once no
+ * byte arrived for BLD_RX_IDLE_MS (longer at slow baudrates), e.g. the
+ * garbage a host probing for the device leaves at a wrong baudrate, which
+ * would otherwise be taken as the head of the next frame.
+ */
+void hal_uart_rx_idle_poll(void) {
+  static uint16_t last_cnt;
+  static uint32_t last_tick;
+  static uint32_t idle;
+  uint16_t cnt = rx_queue.cnt;
+  uint32_t tick = SysTick->VAL;
+  /* SysTick counts down, wrapping at 24 bits */
+  uint32_t elapsed = (last_tick - tick) & SysTick_LOAD_RELOAD_Msk;
+
+  last_tick = tick;
+  if ((cnt == 0) || (cnt != last_cnt)) {
+    last_cnt = cnt;
+    idle = 0;
+    return;
+  }
+  idle += elapsed;
+  if (idle < rx_idle_ticks) {
+    return;
+  }
+
+  NVIC_DisableIRQ(UART_0_INST_INT_IRQN);
+  if (rx_queue.cnt == last_cnt) {
+    bld_rx_queue_drop_partial(&rx_queue);
+  }
+  NVIC_EnableIRQ(UART_0_INST_INT_IRQN);
+  last_cnt = 0;
+  idle = 0;
+}
+
 /**
  *  FETCH DATA
  *===================================================================
  */
 
-void hal_uart_fetch_rx_buf(uint8_t *buf, uint16_t len) {
-  if (len > UART_RX_LEN_MAX)
-    len = UART_RX_LEN_MAX;
-  memcpy(buf, rx_buf, len);
-}
+uint8_t *hal_uart_fetch_frame(void) { return bld_rx_queue_peek(&rx_queue); }
 
-uint8_t hal_uart_fetch_rx_buf_cnt(void) { return rx_buf_cnt; }
+void hal_uart_release_frame(void) { bld_rx_queue_release(&rx_queue); }
+
+bool hal_uart_frame_ready(void) { return rx_queue.used > 0; }
 
 /**
  *  INTERRUPT HANDLER
@@ -104,12 +200,7 @@ uint8_t hal_uart_fetch_rx_buf_cnt(void) { return rx_buf_cnt; }
 void UART_0_INST_IRQHandler(void) {
   switch (DL_UART_Main_getPendingInterrupt(UART_0_INST)) {
   case DL_UART_MAIN_IIDX_RX:
-    rx_buf[rx_buf_cnt] = DL_UART_Main_receiveData(UART_0_INST);
-    rx_buf_cnt++;
-    if (rx_buf_cnt == (rx_buf[0])) {
-      sys_state = BLD_READ_CMD;
-    }
-
+    bld_rx_queue_put_byte(&rx_queue, DL_UART_Main_receiveData(UART_0_INST));
     break;
   default:
     break;
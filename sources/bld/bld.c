@@ -1,25 +1,300 @@
 /**
  *******************************************************************************
- * @file    template_module.c
- * @brief   [Short module description, e.g.] Implementation for Template Module
- * @details This file implements functions declared in `template_module.h`.
- *          Structured for maintainable and modular embedded C development.
+ * @file    bld.c
+ * @brief   Portable bootloader protocol helpers
+ * @details This file implements functions declared in `bld.h`.
  *
  * @date    2025/07/04
- * @author  [Your Name]
+ * @author  ch-binh
  * @version 1.0.0
  * @license MIT
  *******************************************************************************
  */
 
 /* Includes ----------------------------------------------------------------- */
+#include "bld.h"
+#include <string.h>
+
 /* Private includes --------------------------------------------------------- */
+#include "cmsis_compiler.h"
 /* Private defines ---------------------------------------------------------- */
 /* Private macros ----------------------------------------------------------- */
 /* Private typedefs --------------------------------------------------------- */
 /* Private variables -------------------------------------------------------- */
 /* Private function prototypes ---------------------------------------------- */
 /* Exported functions ------------------------------------------------------- */
+
+/**
+ * @brief Reset the queue, pending and partial frames are discarded
+ */
+void bld_rx_queue_init(bld_rx_queue_t *q)
+{
+  memset(q, 0, sizeof(*q));
+}
+
+/**
+ * @brief  Store one received byte, to be called from the UART interrupt
+ * @note   When every slot is in use, or the frame does not fit in a slot, the
+ *         frame is still counted, so framing is kept, but its bytes are
+ *         dropped. The host resends it after its ACK timeout.
+ * @return true when the byte completes a frame that has been queued
+ */
+bool bld_rx_queue_put_byte(bld_rx_queue_t *q, uint8_t byte)
+{
+  if (q->cnt == 0)
+  {
+    q->ext  = (byte == BLD_FRAME_EXT_MARK);
+    q->len  = q->ext ? BLD_FRAME_EXT_HDR_LEN : byte;
+    q->drop = (q->used >= BLD_RX_SLOT_NUM);
+  }
+  else if (q->ext && (q->cnt < BLD_FRAME_EXT_HDR_LEN))
+  {
+    /* 16-bit length of an extended frame, MSB first */
+    q->len = (q->cnt == 1) ? (uint16_t)(byte << 8) : (uint16_t)(q->len | byte);
+    if ((q->cnt == 2) &&
+        ((q->len > BLD_RX_SLOT_LEN) || (q->len < BLD_FRAME_EXT_LEN_MIN)))
+    {
+      /* too long for a slot, or garbage: a too short frame ends with its
+       * header */
+      q->drop = true;
+    }
+  }
+
+  if (!q->drop)
+  {
+    q->slot[q->wr][q->cnt] = byte;
+  }
+  q->cnt++;
+
+  /* the length is only known once the whole header is in */
+  if ((q->cnt < q->len) ||
+      (q->ext && (q->cnt < BLD_FRAME_EXT_HDR_LEN)))
+  {
+    return false;
+  }
+
+  q->cnt = 0;
+  if (q->drop)
+  {
+    return false;
+  }
+  q->wr = (q->wr + 1) % BLD_RX_SLOT_NUM;
+  q->used++;
+  return true;
+}
+
+/**
+ * @brief  Oldest complete frame, it stays valid until released
+ * @return pointer to the frame, NULL if no frame is pending
+ */
+uint8_t *bld_rx_queue_peek(bld_rx_queue_t *q)
+{
+  if (q->used == 0)
+  {
+    return NULL;
+  }
+  return q->slot[q->rd];
+}
+
+/**
+ * @brief Give the oldest frame slot back to the interrupt, to be called from
+ *        the main loop
+ */
+void bld_rx_queue_release(bld_rx_queue_t *q)
+{
+  if (q->used == 0)
+  {
+    return;
+  }
+  /* the interrupt increments used when a frame completes, the decrement
+   * must not interleave with it */
+  BLD_IRQ_DISABLE();
+  q->rd = (q->rd + 1) % BLD_RX_SLOT_NUM;
+  q->used--;
+  BLD_IRQ_ENABLE();
+}
+
+/**
+ * @brief Forget the frame being received, its bytes were garbled by a
+ *        baudrate change. Complete frames are kept.
+ */
+void bld_rx_queue_drop_partial(bld_rx_queue_t *q)
+{
+  q->cnt = 0;
+}
+
+/**
+ * @brief Total length of a frame, header included
+ */
+uint16_t bld_frame_len(const uint8_t *frame)
+{
+  if (frame[0] == BLD_FRAME_EXT_MARK)
+  {
+    return (uint16_t)((frame[1] << 8) | frame[2]);
+  }
+  return frame[0];
+}
+
+/**
+ * @brief Offset of the command byte in a frame
+ */
+uint8_t bld_frame_hdr_len(const uint8_t *frame)
+{
+  return (frame[0] == BLD_FRAME_EXT_MARK) ? BLD_FRAME_EXT_HDR_LEN : BLD_FRAME_HDR_LEN;
+}
+
+/**
+ * @brief Fill the CMD_GET_CAPS response, BLD_CAPS_LEN bytes
+ */
+void bld_get_caps(uint8_t *caps)
+{
+  caps[0] = (uint8_t)(BLD_RX_SLOT_LEN >> 8);
+  caps[1] = (uint8_t)(BLD_RX_SLOT_LEN & 0xFF);
+  caps[2] = BLD_RX_SLOT_NUM;
+  caps[3] = BLD_CAPS_WRITE_SEQ | BLD_CAPS_SECTOR_CRC | BLD_CAPS_WRITE_RLE |
+            ((BLD_RX_SLOT_LEN > 0xFF) ? BLD_CAPS_EXT_FRAME : 0);
+}
+
+/**
+ * @brief Forget every written sequence number, called when a new image is
+ *        started (erase)
+ */
+void bld_seq_reset(bld_seq_t *s)
+{
+  memset(s->done, 0, sizeof(s->done));
+}
+
+bool bld_seq_is_done(const bld_seq_t *s, uint8_t seq)
+{
+  return (s->done[seq >> 3] >> (seq & 0x07)) & 0x01;
+}
+
+/**
+ * @brief Mark seq as written
+ * @note  The host keeps at most half of the sequence space in flight, so the
+ *        number half a turn ahead is released for reuse.
+ */
+void bld_seq_mark(bld_seq_t *s, uint8_t seq)
+{
+  uint8_t reuse = seq + (BLD_SEQ_NUM / 2);
+
+  s->done[seq >> 3] |= (uint8_t)(0x01 << (seq & 0x07));
+  s->done[reuse >> 3] &= (uint8_t) ~(0x01 << (reuse & 0x07));
+}
+
+/**
+ * @brief  Expand a run-length encoded (PackBits) payload straight into flash
+ * @note   Control byte n: 0x00..0x7F copies the next n + 1 bytes, 0x81..0xFF
+ *         repeats the next byte 257 - n times, 0x80 is skipped. Bytes are
+ *         gathered into little endian words, so no output buffer is needed.
+ * @param  src        encoded payload
+ * @param  src_len    encoded length
+ * @param  addr       flash address of the first byte, word aligned
+ * @param  out_len    decoded length announced by the host, a multiple of 4
+ * @param  write_word programs one word
+ * @return true if the payload decoded to exactly out_len bytes
+ */
+bool bld_rle_expand(const uint8_t *src, uint16_t src_len, uint32_t addr,
+                    uint16_t out_len, bld_write_word_t write_word)
+{
+  uint16_t in   = 0;
+  uint16_t out  = 0;
+  uint32_t word = 0;
+
+  if (out_len & 0x03)
+  {
+    return false;
+  }
+
+  while (in < src_len)
+  {
+    uint8_t  ctrl = src[in++];
+    uint16_t n;
+    bool     run = (ctrl > 0x80);
+
+    if (ctrl == 0x80)
+    {
+      continue;
+    }
+    n = run ? (uint16_t)(257 - ctrl) : (uint16_t)(ctrl + 1);
+    if ((in + (run ? 1 : n) > src_len) || (out + n > out_len))
+    {
+      return false;
+    }
+
+    for (uint16_t i = 0; i < n; i++)
+    {
+      word |= (uint32_t)src[run ? in : in + i] << (8 * (out & 0x03));
+      out++;
+      if ((out & 0x03) == 0)
+      {
+        write_word(addr + out - 4, word);
+        word = 0;
+      }
+    }
+    in += run ? 1 : n;
+  }
+
+  return out == out_len;
+}
+
+/**
+ * @brief  Baudrate divisors for a UART clocked at clk, with 16x oversampling
+ * @param  clk  UART functional clock in Hz, up to 1 GHz
+ * @param  baud requested baudrate
+ * @param  div  filled with the divisors
+ * @return true if the actual baudrate is within 1 / BLD_BAUD_ERR_DIV of baud
+ */
+bool bld_baud_divisor(uint32_t clk, uint32_t baud, bld_baud_div_t *div)
+{
+  uint32_t brd64;
+  uint32_t actual;
+  uint32_t diff;
+
+  if (baud == 0)
+  {
+    return false;
+  }
+
+  /* 64 * clk / (16 * baud), rounded to the nearest 1/64 */
+  brd64 = (clk * 4 + baud / 2) / baud;
+  if ((brd64 < 64) || ((brd64 >> 6) > 0xFFFF))
+  {
+    return false;
+  }
+
+  actual = (clk * 4) / brd64;
+  diff   = (actual > baud) ? (actual - baud) : (baud - actual);
+  if (diff * BLD_BAUD_ERR_DIV > baud)
+  {
+    return false;
+  }
+
+  div->ibrd = (uint16_t)(brd64 >> 6);
+  div->fbrd = (uint8_t)(brd64 & 0x3F);
+  return true;
+}
+
+/**
+ * @brief  Idle time after which a partial frame is dropped: BLD_RX_IDLE_MS,
+ *         or BLD_RX_IDLE_BYTES byte times if that is longer
+ * @param  tick_hz frequency of the timer measuring the idle time
+ * @param  clk     UART functional clock in Hz
+ * @param  div     divisors of the current baudrate
+ * @return the idle time in timer ticks
+ */
+uint32_t bld_rx_idle_ticks(uint32_t tick_hz, uint32_t clk,
+                           const bld_baud_div_t *div)
+{
+  uint64_t brd64 = ((uint64_t)div->ibrd << 6) | div->fbrd;
+  uint64_t idle  = (uint64_t)BLD_RX_IDLE_MS * tick_hz / 1000U;
+  /* a byte is 10 bits of 16 clocks of brd64 / 64 */
+  uint64_t bytes = BLD_RX_IDLE_BYTES * 10U * 16U * brd64 * tick_hz /
+                   (64U * (uint64_t)clk);
+
+  return (uint32_t)((bytes > idle) ? bytes : idle);
+}
+
 /* Private function definitions --------------------------------------------- */
 
 /* End of File -------------------------------------------------------------- */
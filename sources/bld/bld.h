@@ -1,22 +1,21 @@
 /**
  ******************************************************************************
- * @file    template_module.h
- * @brief   [Short module description, e.g.] Interface for Template Math Module
- * @details This file provides declarations for configuration macros, types,
- *          and public API for the Template module. Designed for embedded use.
+ * @file    bld.h
+ * @brief   Portable bootloader protocol helpers
+ * @details Hardware independent parts of the bootloader protocol shared by the
+ *          MCU ports in `projects/`: a queue of received frames, so the next
+ *          frame can be received while the current one is executed, and the
+ *          sequence tracking used by pipelined (windowed) writes.
  *
  * @date    2025/07/04
- * @author  [Your Name]
+ * @author  ch-binh
  * @version 1.0.0
  * @license MIT
  ******************************************************************************
- * @attention
- * This is a template header file. Replace placeholder content before use.
- ******************************************************************************
  */
 
-#ifndef TEMPLATE_MODULE_H
-#define TEMPLATE_MODULE_H
+#ifndef BLD_H
+#define BLD_H
 
 // #ifdef __cplusplus
 // extern "C" {
@@ -24,22 +23,143 @@
 
 /* Includes ----------------------------------------------------------------- */
 /* Standard libraries */
+#include <stdbool.h>
+#include <stdint.h>
+
 /* Project-specific headers */
 /* Configuration ------------------------------------------------------------ */
+#ifndef BLD_RX_SLOT_NUM
+#define BLD_RX_SLOT_NUM 2 /* frames buffered while one is being executed */
+#endif
+
+#ifndef BLD_RX_SLOT_LEN
+#define BLD_RX_SLOT_LEN 256 /* max frame length, above 255 needs ext frames */
+#endif
+
 /* Public defines ----------------------------------------------------------- */
+#define BLD_SEQ_NUM 256 /* sequence numbers are 1 byte */
+
+/* Extended frame: len byte 0x00 followed by a 16-bit big endian length */
+#define BLD_FRAME_EXT_MARK    0x00
+#define BLD_FRAME_HDR_LEN     1
+#define BLD_FRAME_EXT_HDR_LEN 3
+#define BLD_FRAME_EXT_LEN_MIN (BLD_FRAME_EXT_HDR_LEN + 2) /* cmd, checksum */
+
+/* CMD_GET_CAPS flags */
+#define BLD_CAPS_WRITE_SEQ 0x01 /* pipelined writes */
+#define BLD_CAPS_EXT_FRAME  0x02 /* frames longer than 255 bytes */
+#define BLD_CAPS_SECTOR_CRC 0x04 /* per-sector CRCs for delta updates */
+#define BLD_CAPS_WRITE_RLE  0x08 /* run-length encoded writes */
+#define BLD_CAPS_SET_BAUD   0x10 /* baudrate changes, set by the port */
+#define BLD_CAPS_LEN        4    /* 2b max frame length, rx slots, flags */
+
+/* CMD_SECTOR_CRC answers at most this many 4-byte CRCs per request */
+#ifndef BLD_SECTOR_CRC_MAX
+#define BLD_SECTOR_CRC_MAX 16
+#endif
+
+/* CMD_SET_BAUD: the new baudrate is kept only if a frame arrives within this
+ * time, otherwise the previous one is restored */
+#ifndef BLD_BAUD_CONFIRM_MS
+#define BLD_BAUD_CONFIRM_MS 200
+#endif
+
+/* A partial frame that stops growing for this long is dropped, so bytes the
+ * host sent at another baudrate do not swallow its next frame. At slow
+ * baudrates the limit is BLD_RX_IDLE_BYTES byte times instead. */
+#ifndef BLD_RX_IDLE_MS
+#define BLD_RX_IDLE_MS 20
+#endif
+#ifndef BLD_RX_IDLE_BYTES
+#define BLD_RX_IDLE_BYTES 2
+#endif
+
+/* Interrupts are masked while the main loop updates the rx queue state it
+ * shares with the UART interrupt. The CMSIS intrinsics by default. */
+#ifndef BLD_IRQ_DISABLE
+#define BLD_IRQ_DISABLE() __disable_irq()
+#endif
+#ifndef BLD_IRQ_ENABLE
+#define BLD_IRQ_ENABLE() __enable_irq()
+#endif
+
+/* Largest baudrate error accepted, 1 / BLD_BAUD_ERR_DIV (2%) */
+#define BLD_BAUD_ERR_DIV 50
+
 /* Public macros ------------------------------------------------------------ */
 /* Helper macros ------------------------------------------------------------ */
 /* Public typedefs ---------------------------------------------------------- */
+/**
+ * @brief Program one 32-bit word, e.g. hal_flash_write_mem_32bit()
+ */
+typedef int (*bld_write_word_t)(uint32_t addr, uint32_t word);
+
 /* Enumerations ------------------------------------------------------------- */
 /* Structures --------------------------------------------------------------- */
+
+/**
+ * @brief Received frames, filled byte by byte from the UART interrupt
+ */
+typedef struct
+{
+  uint8_t          slot[BLD_RX_SLOT_NUM][BLD_RX_SLOT_LEN];
+  uint16_t         cnt;  /* bytes received of the current frame */
+  uint16_t         len;  /* length of the current frame */
+  bool             ext;  /* current frame has a 16-bit length */
+  bool             drop; /* no free slot, current frame is discarded */
+  uint8_t          wr;   /* slot being received */
+  uint8_t          rd;   /* oldest complete frame */
+  volatile uint8_t used; /* number of complete frames */
+} bld_rx_queue_t;
+
+/**
+ * @brief Divisors of a UART with 16x oversampling and a 6-bit fractional
+ *        baudrate divisor
+ */
+typedef struct
+{
+  uint16_t ibrd; /* integer part */
+  uint8_t  fbrd; /* fractional part, in 1/64 */
+} bld_baud_div_t;
+
+/**
+ * @brief Sequence numbers already written, a retransmitted frame whose ACK
+ *        was lost is acknowledged again without programming flash twice.
+ */
+typedef struct
+{
+  uint8_t done[BLD_SEQ_NUM / 8];
+} bld_seq_t;
+
 /* Error codes -------------------------------------------------------------- */
 /* Function prototypes ------------------------------------------------------ */
+void     bld_rx_queue_init(bld_rx_queue_t *q);
+bool     bld_rx_queue_put_byte(bld_rx_queue_t *q, uint8_t byte);
+uint8_t *bld_rx_queue_peek(bld_rx_queue_t *q);
+void     bld_rx_queue_release(bld_rx_queue_t *q);
+void     bld_rx_queue_drop_partial(bld_rx_queue_t *q);
+
+uint16_t bld_frame_len(const uint8_t *frame);
+uint8_t  bld_frame_hdr_len(const uint8_t *frame);
+void     bld_get_caps(uint8_t *caps);
+
+void bld_seq_reset(bld_seq_t *s);
+bool bld_seq_is_done(const bld_seq_t *s, uint8_t seq);
+void bld_seq_mark(bld_seq_t *s, uint8_t seq);
+
+bool bld_rle_expand(const uint8_t *src, uint16_t src_len, uint32_t addr,
+                    uint16_t out_len, bld_write_word_t write_word);
+
+bool     bld_baud_divisor(uint32_t clk, uint32_t baud, bld_baud_div_t *div);
+uint32_t bld_rx_idle_ticks(uint32_t tick_hz, uint32_t clk,
+                           const bld_baud_div_t *div);
+
 /* Inline functions --------------------------------------------------------- */
 
 // #ifdef __cplusplus
 // }
 // #endif
 
-#endif /* TEMPLATE_MODULE_H */
+#endif /* BLD_H */
 
 /* End of File -------------------------------------------------------------- */
@@ -0,0 +1,115 @@
+import os
+import sys
+import tempfile
+import time
+
+HOST_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(HOST_DIR)
+sys.path.append(os.path.join(HOST_DIR, "utils"))
+sys.path.append(os.path.join(HOST_DIR, "common"))
+sys.path.append(os.path.join(HOST_DIR, "driverlib"))
+
+from dl_hexf import dl_hexf_readf
+
+#
+# DEFINES AND VARIABLES
+#============================================================================
+
+BENCH_IMG_SIZE = 1024 * 1024
+BENCH_BASE_ADDR = 0x08000000
+BENCH_REC_LEN = 16
+
+#
+# Helpers
+#============================================================================
+
+
+def bench_gen_hexf(fpath: str, size: int, base_addr: int = BENCH_BASE_ADDR,
+                   rec_len: int = BENCH_REC_LEN) -> None:
+    """
+    Write a synthetic hex file of `size` pseudo random bytes at `base_addr`.
+    """
+    payload = bytes((i * 7 + (i >> 8)) & 0xFF for i in range(size))
+    lines = []
+    ext_addr = -1
+    for ofs in range(0, size, rec_len):
+        addr = base_addr + ofs
+        if (addr >> 16) != ext_addr:
+            ext_addr = addr >> 16
+            lines.append(_bench_hex_rec(0x04, 0, ext_addr.to_bytes(2, "big")))
+        chunk = payload[ofs:ofs + rec_len]
+        lines.append(_bench_hex_rec(0x00, addr & 0xFFFF, chunk))
+    lines.append(_bench_hex_rec(0x01, 0, b""))
+
+    with open(fpath, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def _bench_hex_rec(rec_type: int, addr: int, data: bytes) -> str:
+    rec = bytes([len(data), addr >> 8, addr & 0xFF, rec_type]) + data
+    return ":" + (rec + bytes([-sum(rec) & 0xFF])).hex().upper()
+
+
+def _bench_legacy_readf(fpath: str) -> int:
+    """
+    Reference of the former three-pass reader: every pass splits each line
+    into per-byte ints (verify, boundary, shadow).
+    """
+
+    def breakdown(line):
+        data_len = int(line[1:3], 16)
+        return [
+            line[0], data_len, [int(line[3:5], 16), int(line[5:7], 16)],
+            int(line[7:9], 16),
+            [int(line[i:i + 2], 16) for i in range(9, 9 + data_len * 2, 2)],
+            int(line[9 + data_len * 2:11 + data_len * 2], 16)
+        ]
+
+    nbytes = 0
+    with open(fpath, "r") as f:
+        for _ in range(3):
+            f.seek(0, 0)
+            for line in f:
+                hex_line = breakdown(line.strip())
+                nbytes += len(hex_line[4])
+    return nbytes
+
+
+def _bench_time(func, *args) -> float:
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+#
+# Benchmark
+#============================================================================
+
+
+def bench_hexf_parse(size: int = BENCH_IMG_SIZE) -> dict:
+    """
+    Time the hex reader against the former three-pass reader.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fpath = os.path.join(tmp_dir, "bench.hex")
+        bench_gen_hexf(fpath, size)
+
+        legacy_s = _bench_time(_bench_legacy_readf, fpath)
+        stream_s = _bench_time(dl_hexf_readf, fpath)
+
+    return {
+        "size": size,
+        "legacy_s": legacy_s,
+        "stream_s": stream_s,
+        "speedup": legacy_s / stream_s,
+    }
+
+
+if __name__ == "__main__":
+    result = bench_hexf_parse()
+    print("=" * 40)
+    print(f"Hex parse of {result['size']} bytes")
+    print("-" * 40)
+    print(f"three-pass reader : {result['legacy_s']:.3f} s")
+    print(f"single-pass reader: {result['stream_s']:.3f} s")
+    print(f"speedup           : {result['speedup']:.1f}x")
@@ -0,0 +1,99 @@
+import os
+import sys
+import time
+
+HOST_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(HOST_DIR)
+sys.path.append(os.path.join(HOST_DIR, "utils"))
+sys.path.append(os.path.join(HOST_DIR, "common"))
+sys.path.append(os.path.join(HOST_DIR, "driverlib"))
+
+from dl_bld import Cmd, dl_bld_prep_packet, dl_bld_prep_write_packet
+from dl_uart import UART_BITS_PER_BYTE
+
+#
+# DEFINES AND VARIABLES
+#============================================================================
+
+BENCH_IMG_SIZE = 256 * 1024
+BENCH_BASE_ADDR = 0x08000000
+BENCH_CHUNK_SIZES = (240, 1024)
+BENCH_BAUDRATES = (115200, 921600, 3000000)
+
+#
+# Helpers
+#============================================================================
+
+
+def _bench_legacy_write_packet(write_addr: int, chunk, seq: int = None):
+    """
+    Reference of the former write packet builder: per-byte word swap into a
+    list, then dl_bld_prep_packet().
+    """
+    packet_data = []
+    packet_data.extend((write_addr >> (24 - i * 8)) & 0xFF for i in range(4))
+    for j in range(0, len(chunk), 4):
+        for k in range(4):
+            packet_data.append(chunk[j + 3 - k])
+
+    return dl_bld_prep_packet(length=len(packet_data) + 8,
+                              cmd=Cmd.CMD_WRITE_SEQ,
+                              data=packet_data,
+                              crc32=1,
+                              req_ack=1,
+                              seq=seq)
+
+
+def _bench_encode(encoder, image: bytes, chunk_size: int) -> tuple:
+    nbytes = 0
+    start = time.perf_counter()
+    for ofs in range(0, len(image), chunk_size):
+        chunk = memoryview(image)[ofs:ofs + chunk_size]
+        nbytes += len(encoder(BENCH_BASE_ADDR + ofs, chunk, ofs & 0xFF))
+    return time.perf_counter() - start, nbytes
+
+
+#
+# Benchmark
+#============================================================================
+
+
+def bench_packet_encode(size: int = BENCH_IMG_SIZE,
+                        chunk_size: int = 240) -> dict:
+    """
+    Time the write packet encoder against the former per-byte builder and
+    compare the host CPU time per packet with its wire time.
+    """
+    image = bytes((i * 7 + (i >> 8)) & 0xFF for i in range(size))
+    npackets = -(-size // chunk_size)
+
+    legacy_s, _ = _bench_encode(_bench_legacy_write_packet, image, chunk_size)
+    fast_s, nbytes = _bench_encode(dl_bld_prep_write_packet, image,
+                                   chunk_size)
+
+    return {
+        "size": size,
+        "chunk_size": chunk_size,
+        "packets": npackets,
+        "legacy_us": legacy_s / npackets * 1e6,
+        "fast_us": fast_s / npackets * 1e6,
+        "speedup": legacy_s / fast_s,
+        "wire_us": {
+            baud: nbytes / npackets * UART_BITS_PER_BYTE / baud * 1e6
+            for baud in BENCH_BAUDRATES
+        },
+    }
+
+
+if __name__ == "__main__":
+    for chunk_size in BENCH_CHUNK_SIZES:
+        result = bench_packet_encode(chunk_size=chunk_size)
+        print("=" * 40)
+        print(f"Write packets of {result['chunk_size']} bytes "
+              f"({result['packets']} packets)")
+        print("-" * 40)
+        print(f"per-byte builder : {result['legacy_us']:8.1f} us/packet")
+        print(f"buffer encoder   : {result['fast_us']:8.1f} us/packet")
+        print(f"speedup          : {result['speedup']:8.1f}x")
+        for baud, wire_us in result["wire_us"].items():
+            print(f"wire @ {baud:<9} : {wire_us:8.1f} us/packet")
@@ -0,0 +1,70 @@
+import os
+import sys
+
+HOST_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(HOST_DIR)
+sys.path.append(os.path.join(HOST_DIR, "utils"))
+sys.path.append(os.path.join(HOST_DIR, "common"))
+sys.path.append(os.path.join(HOST_DIR, "driverlib"))
+
+from dl_bld import BldImagePlan, dl_bld_prep_write_packet
+from dl_hexf import dl_hexf_readf
+from dl_uart import UART_BITS_PER_BYTE
+
+#
+# DEFINES AND VARIABLES
+#============================================================================
+
+BENCH_HEXF = os.path.join(HOST_DIR, "..", "..", "bin", "application.hex")
+BENCH_CHUNK_SIZE = 240
+BENCH_BAUDRATES = (115200, 921600)
+
+#
+# Benchmark
+#============================================================================
+
+
+def bench_rle_ratio(fpath: str = BENCH_HEXF,
+                    chunk_size: int = BENCH_CHUNK_SIZE) -> dict:
+    """
+    Bytes on the wire of a pipelined upload with and without CMD_WRITE_RLE,
+    and the resulting payload throughput on a fixed baud link.
+    """
+    plan = BldImagePlan(dl_hexf_readf(fpath))
+    chunks = plan.chunks(chunk_size)
+
+    payload = sum(len(chunk) for _, chunk in chunks)
+    wire = {}
+    for compress in (False, True):
+        wire[compress] = sum(
+            len(dl_bld_prep_write_packet(addr, chunk, idx & 0xFF, compress))
+            for idx, (addr, chunk) in enumerate(chunks))
+
+    return {
+        "file": os.path.basename(fpath),
+        "payload": payload,
+        "wire_plain": wire[False],
+        "wire_rle": wire[True],
+        "ratio": wire[False] / wire[True],
+        "bytes_per_s": {
+            baud: {
+                "plain": payload * baud / UART_BITS_PER_BYTE / wire[False],
+                "rle": payload * baud / UART_BITS_PER_BYTE / wire[True],
+            }
+            for baud in BENCH_BAUDRATES
+        },
+    }
+
+
+if __name__ == "__main__":
+    fpath = sys.argv[1] if len(sys.argv) > 1 else BENCH_HEXF
+    result = bench_rle_ratio(fpath)
+    print("=" * 40)
+    print(f"RLE writes of {result['file']} ({result['payload']} bytes)")
+    print("-" * 40)
+    print(f"wire bytes, plain : {result['wire_plain']}")
+    print(f"wire bytes, RLE   : {result['wire_rle']}")
+    print(f"ratio             : {result['ratio']:.2f}x")
+    for baud, rate in result["bytes_per_s"].items():
+        print(f"@ {baud:<8}: {rate['plain']:8.0f} -> {rate['rle']:8.0f} "
+              f"payload bytes/s")
@@ -0,0 +1,275 @@
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import struct
+import sys
+import tempfile
+import time
+
+HOST_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(HOST_DIR)
+sys.path.append(os.path.join(HOST_DIR, "utils"))
+sys.path.append(os.path.join(HOST_DIR, "common"))
+sys.path.append(os.path.join(HOST_DIR, "driverlib"))
+sys.path.append(os.path.join(HOST_DIR, "sim"))
+
+from bench_hexf import bench_gen_hexf
+from crc import crc32_lookup_tb
+from dl_bld import (Cmd, BldImagePlan, dl_bld_prep_packet,
+                    dl_bld_prep_write_packet, dl_bld_upload_target_file)
+from dl_binf import dl_bin_readf
+from dl_elff import dl_elff_readf
+from dl_hexf import dl_hexf_readf
+from memory_map import SECTOR_SIZE
+from sim_bld import BldSim, BldSimLoop, SimLink
+
+#
+# DEFINES AND VARIABLES
+#============================================================================
+
+BENCH_SUITE_VERSION = 1
+BENCH_BASE_ADDR = 0x08000000
+BENCH_SIZES = (1024, 16 * 1024, 256 * 1024, 1024 * 1024)
+BENCH_BAUDRATES = (115200, 921600, 3000000)
+BENCH_CHUNK_SIZE = 240
+BENCH_REPEAT = 3
+# paced uploads last size * 10 / baud seconds, bigger images are only
+# uploaded unpaced unless --upload-max is raised
+BENCH_UPLOAD_MAX = 64 * 1024
+
+BENCH_BIN_DIR = os.path.join(HOST_DIR, "..", "..", "bin")
+# app.bin is linked for the application slot of the MSPM0 layout
+BENCH_BINF_ADDR = 0x1800
+
+#
+# Helpers
+#============================================================================
+
+
+def _bench_best(func, *args, repeat: int = BENCH_REPEAT) -> float:
+    """Best wall time of repeat calls, the driverlib output is discarded."""
+    best = None
+    with open(os.devnull, "w") as devnull, \
+            contextlib.redirect_stdout(devnull):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func(*args)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _bench_record(image: str, size: int, stage: str, seconds: float,
+                  **extra) -> dict:
+    record = {
+        "image": image,
+        "size": size,
+        "stage": stage,
+        "seconds": seconds,
+        "bytes_per_s": size / seconds if seconds > 0 else None,
+    }
+    record.update(extra)
+    return record
+
+
+def _bench_gen_elff(fpath: str, payload: bytes, base_addr: int) -> None:
+    """Write an ELF32 file with payload as its only PT_LOAD segment."""
+    # header, one program header, then the data, no section headers
+    data_ofs = 52 + 32
+    ehdr = b"\x7fELF\x01\x01\x01" + bytes(9) + struct.pack(
+        "<HHIIIIIHHHHHH", 2, 40, 1, base_addr, 52, 0, 0, 52, 32, 1, 40, 0,
+        0)
+    phdr = struct.pack("<IIIIIIII", 1, data_ofs, base_addr, base_addr,
+                       len(payload), len(payload), 5, 4)
+    with open(fpath, "wb") as f:
+        f.write(ehdr + phdr + payload)
+
+
+def _bench_encode_generic(plan: BldImagePlan, chunk_size: int) -> None:
+    for addr, chunk in plan.chunks(chunk_size):
+        data = list(addr.to_bytes(4, "big")) + list(chunk)
+        dl_bld_prep_packet(length=len(data) + 7,
+                           cmd=Cmd.CMD_WRITE_CRC,
+                           data=data,
+                           crc32=1,
+                           req_ack=1)
+
+
+def _bench_encode_write(plan: BldImagePlan, chunk_size: int) -> None:
+    for idx, (addr, chunk) in enumerate(plan.chunks(chunk_size)):
+        dl_bld_prep_write_packet(addr, chunk, idx & 0xFF)
+
+
+def _bench_crc(plan: BldImagePlan) -> None:
+    for addr, view in plan.image_info.views():
+        crc32_lookup_tb(view)
+
+
+def _bench_upload(plan: BldImagePlan, link: SimLink) -> None:
+    image = plan.image_info
+    s_addr = image.s_addr - image.s_addr % SECTOR_SIZE
+    size = -(-(image.e_addr + 1 - s_addr) // SECTOR_SIZE) * SECTOR_SIZE
+    port = BldSimLoop(BldSim(s_addr, size), link)
+    if not dl_bld_upload_target_file(port, plan):
+        raise RuntimeError("upload to the simulated device failed")
+
+
+#
+# Benchmark
+#============================================================================
+
+
+def bench_image(name: str, size: int, hex_fpath: str = None,
+                bin_fpath: str = None, bin_addr: int = BENCH_BASE_ADDR,
+                elf_fpath: str = None,
+                baudrates: tuple = BENCH_BAUDRATES,
+                upload_max: int = BENCH_UPLOAD_MAX,
+                repeat: int = BENCH_REPEAT) -> list:
+    """
+    Time every stage of an upload of one image.
+
+    Args:
+        name (str): Image name used in the records.
+        size (int): Payload bytes of the image.
+        hex_fpath (str): Hex file of the image, if any.
+        bin_fpath (str): Bin file of the image, if any.
+        bin_addr (int): Load address of the bin file.
+        elf_fpath (str): ELF file of the image, if any.
+        baudrates (tuple): Line rates of the paced uploads.
+        upload_max (int): Biggest image uploaded paced.
+
+    Returns:
+        list: One record per stage, see _bench_record().
+    """
+    records = []
+    image = None
+    if hex_fpath:
+        records.append(_bench_record(
+            name, size, "parse_hex",
+            _bench_best(dl_hexf_readf, hex_fpath, repeat=repeat)))
+        with open(os.devnull, "w") as devnull, \
+                contextlib.redirect_stdout(devnull):
+            image = dl_hexf_readf(hex_fpath)
+    if bin_fpath:
+        records.append(_bench_record(
+            name, size, "parse_bin",
+            _bench_best(dl_bin_readf, bin_fpath, bin_addr, repeat=repeat)))
+        if image is None:
+            with open(os.devnull, "w") as devnull, \
+                    contextlib.redirect_stdout(devnull):
+                image = dl_bin_readf(bin_fpath, bin_addr)
+    if elf_fpath:
+        records.append(_bench_record(
+            name, size, "parse_elf",
+            _bench_best(dl_elff_readf, elf_fpath, repeat=repeat)))
+
+    plan = BldImagePlan(image)
+    records.append(_bench_record(
+        name, size, "encode_prep_packet",
+        _bench_best(_bench_encode_generic, plan, BENCH_CHUNK_SIZE,
+                    repeat=repeat)))
+    records.append(_bench_record(
+        name, size, "encode_write_packet",
+        _bench_best(_bench_encode_write, plan, BENCH_CHUNK_SIZE,
+                    repeat=repeat)))
+    records.append(_bench_record(
+        name, size, "crc32", _bench_best(_bench_crc, plan, repeat=repeat)))
+
+    # unpaced, the host side of the protocol alone
+    records.append(_bench_record(
+        name, size, "upload",
+        _bench_best(_bench_upload, plan, SimLink(), repeat=repeat),
+        baudrate=None))
+    if size <= upload_max:
+        for baud in baudrates:
+            seconds = _bench_best(_bench_upload, plan,
+                                  SimLink(baud, pace=True), repeat=1)
+            records.append(_bench_record(name, size, "upload", seconds,
+                                         baudrate=baud))
+    return records
+
+
+def bench_suite(sizes: tuple = BENCH_SIZES,
+                baudrates: tuple = BENCH_BAUDRATES,
+                upload_max: int = BENCH_UPLOAD_MAX,
+                repeat: int = BENCH_REPEAT) -> dict:
+    """
+    Run bench_image() on synthetic images of every size and on the sample
+    files in bin/.
+
+    Returns:
+        dict: Run metadata and the list of records, ready for json.dump().
+    """
+    records = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in sizes:
+            hex_fpath = os.path.join(tmp_dir, f"synth_{size}.hex")
+            bin_fpath = os.path.join(tmp_dir, f"synth_{size}.bin")
+            elf_fpath = os.path.join(tmp_dir, f"synth_{size}.elf")
+            bench_gen_hexf(hex_fpath, size)
+            payload = bytes((i * 7 + (i >> 8)) & 0xFF for i in range(size))
+            with open(bin_fpath, "wb") as f:
+                f.write(payload)
+            _bench_gen_elff(elf_fpath, payload, BENCH_BASE_ADDR)
+            records += bench_image(f"synth_{size}", size, hex_fpath,
+                                   bin_fpath, BENCH_BASE_ADDR, elf_fpath,
+                                   baudrates, upload_max, repeat)
+
+    sample_hexf = os.path.join(BENCH_BIN_DIR, "application.hex")
+    if os.path.exists(sample_hexf):
+        with open(os.devnull, "w") as devnull, \
+                contextlib.redirect_stdout(devnull):
+            size = dl_hexf_readf(sample_hexf).size
+        records += bench_image("application.hex", size, hex_fpath=sample_hexf,
+                               baudrates=baudrates, upload_max=upload_max,
+                               repeat=repeat)
+    sample_binf = os.path.join(BENCH_BIN_DIR, "app.bin")
+    if os.path.exists(sample_binf):
+        records += bench_image("app.bin", os.path.getsize(sample_binf),
+                               bin_fpath=sample_binf,
+                               bin_addr=BENCH_BINF_ADDR, baudrates=baudrates,
+                               upload_max=upload_max, repeat=repeat)
+
+    return {
+        "suite_version": BENCH_SUITE_VERSION,
+        "timestamp": datetime.datetime.now(
+            datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "chunk_size": BENCH_CHUNK_SIZE,
+        "repeat": repeat,
+        "records": records,
+    }
+
+
+def bench_parse_args():
+    parser = argparse.ArgumentParser(
+        description="Time parse, encode, CRC and upload stages")
+    parser.add_argument("-o", "--output", default=None,
+                        help="JSON output file (default: stdout)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=BENCH_SIZES,
+                        help="synthetic image sizes in bytes")
+    parser.add_argument("--baud", type=int, nargs="+",
+                        default=BENCH_BAUDRATES,
+                        help="baudrates of the paced uploads")
+    parser.add_argument("--upload-max", type=int, default=BENCH_UPLOAD_MAX,
+                        help="biggest image uploaded paced")
+    parser.add_argument("--repeat", type=int, default=BENCH_REPEAT,
+                        help="runs per stage, the best one is kept")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = bench_parse_args()
+    result = bench_suite(tuple(args.sizes), tuple(args.baud),
+                         args.upload_max, args.repeat)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Wrote {len(result['records'])} records to {args.output}")
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
@@ -7,4 +7,17 @@ class ERRNO:
     ERR_FNF = -1  # File not found
     ERR_INVALID = -3  # Invalid value
     ERR_INVALID_PORT = -4  # Invalid port
-    ERR_INVALID_DATATYPE = -5  # Invalid data type
\ No newline at end of file
+    ERR_INVALID_DATATYPE = -5  # Invalid data type
+
+class EXIT_CODE:
+    """
+    Process exit codes of the command line interface.
+    """
+    SUCCESS = 0
+    ERR = 1  # General error
+    ERR_USAGE = 2  # Invalid arguments (argparse)
+    ERR_FILE = 3  # Image file missing or invalid
+    ERR_PORT = 4  # Serial port cannot be opened
+    ERR_NO_RESPONSE = 5  # Bootloader does not answer
+    ERR_UPLOAD = 6  # Erase, write or CRC check failed
+    ERR_EXIT_BLD = 7  # Application start failed
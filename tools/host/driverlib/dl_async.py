@@ -0,0 +1,429 @@
+import asyncio
+import os
+
+from dl_bld import *
+
+#
+# VARIABLES AND DEFINES
+#============================================================================
+
+# Ports without a file descriptor (Windows, BldSimLoop) are polled this often
+ASYNC_POLL_S = 0.001
+
+
+class AsyncUart:
+    """
+    asyncio transport of a serial port.
+
+    On POSIX the port descriptor is watched by the event loop, nothing runs
+    while the line is quiet; other ports are polled every ASYNC_POLL_S.
+    Received bytes are split into frames by the port's UartFrameParser,
+    like dl_uart_read_frame() does for the blocking API.
+    """
+
+    def __init__(self, uart_port: serial.Serial):
+        self.uart_port = uart_port
+        self.parser = dl_uart_frame_parser(uart_port)
+        self.metrics = measure_metrics(uart_port)
+        self._frames = asyncio.Queue()
+        self._tx_buf = bytearray()
+        self._fd = None
+        self._poller = None
+        self._loop = None
+        self._timeout = None  # of the port before start()
+
+    def start(self) -> None:
+        """Hook the port into the running event loop."""
+        self._loop = asyncio.get_running_loop()
+        self._timeout = self.uart_port.timeout
+        self.uart_port.timeout = 0  # reads return what already arrived
+        try:
+            fd = self.uart_port.fileno()
+            self._loop.add_reader(fd, self._on_readable)
+            self._fd = fd
+        except (AttributeError, NotImplementedError, OSError,
+                serial.SerialException):
+            self._poller = self._loop.create_task(self._poll())
+
+    def stop(self) -> None:
+        """Unhook the port, its timeout is restored."""
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+            self._loop.remove_writer(self._fd)
+            self._fd = None
+        if self._poller is not None:
+            self._poller.cancel()
+            self._poller = None
+        if self._loop is not None:
+            self.uart_port.timeout = self._timeout
+            self._loop = None
+
+    def write(self, packets: list) -> int:
+        """
+        Queue packets as one write, the part the driver does not take at
+        once is sent when the port is writable again.
+
+        Returns:
+            int: Number of bytes queued.
+        """
+        data = b"".join(packets)
+        self.metrics.count("tx_frames", len(packets))
+        self.metrics.count("tx_bytes", len(data))
+        if self._fd is None:
+            self.uart_port.write(data)
+            return len(data)
+        self._tx_buf += data
+        self._on_writable()
+        return len(data)
+
+    async def read_frame(self, timeout: float) -> bytes:
+        """
+        Returns:
+            bytes: The next frame including length and checksum, None if
+                none arrived within timeout.
+        """
+        try:
+            frame = await asyncio.wait_for(self._frames.get(),
+                                           max(timeout, 0.0))
+        except asyncio.TimeoutError:
+            # the partial frame will not complete, look for one behind it
+            self._parse(resync=True)
+            if self._frames.empty():
+                self.metrics.count("timeouts")
+                return None
+            frame = self._frames.get_nowait()
+        self.metrics.count("rx_frames")
+        return frame
+
+    def reset_input(self) -> None:
+        """Forget frames and bytes received so far."""
+        while not self._frames.empty():
+            self._frames.get_nowait()
+        self.parser.reset()
+
+    def _on_readable(self) -> None:
+        try:
+            data = self.uart_port.read(max(self.uart_port.in_waiting, 1))
+        except serial.SerialException:
+            data = b""
+        if not data:
+            return
+        self.metrics.count("rx_bytes", len(data))
+        self.parser.feed(data)
+        self._parse()
+
+    def _parse(self, resync: bool = False) -> None:
+        while True:
+            frame = self.parser.next_frame(resync)
+            if frame is None:
+                break
+            self._frames.put_nowait(frame)
+
+    def _on_writable(self) -> None:
+        try:
+            nbytes = os.write(self._fd, self._tx_buf)
+        except BlockingIOError:
+            nbytes = 0
+        del self._tx_buf[:nbytes]
+        if self._tx_buf:
+            self._loop.add_writer(self._fd, self._on_writable)
+        else:
+            self._loop.remove_writer(self._fd)
+
+    async def _poll(self) -> None:
+        while True:
+            if self.uart_port.in_waiting:
+                self._on_readable()
+            await asyncio.sleep(ASYNC_POLL_S)
+
+
+class AsyncBootloader:
+    """
+    Bootloader client for asyncio, one event loop can drive many boards
+    without a thread per port:
+
+        async with AsyncBootloader("/dev/ttyUSB0") as bld:
+            print(await bld.get_version())
+            await bld.upload(image_info)
+
+    Packets, frames and image plans are the ones of the blocking dl_bld
+    API, only the waiting is done by the event loop.
+    """
+
+    def __init__(self,
+                 port,
+                 baudrate: int = 115200,
+                 timeout: float = 1.0):
+        """
+        Args:
+            port (str | serial.Serial): Port name, or an open port object
+                such as a BldSimLoop.
+            baudrate (int): Baudrate used when opening a port by name.
+            timeout (float): Answer deadline of a request.
+        """
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.uart_port: serial.Serial = None
+        self.uart: AsyncUart = None
+
+    async def open(self) -> "AsyncBootloader":
+        if isinstance(self.port, str):
+            self.uart_port = serial.Serial(port=self.port,
+                                           baudrate=self.baudrate,
+                                           timeout=0)
+        else:
+            self.uart_port = self.port
+        self.uart = AsyncUart(self.uart_port)
+        self.uart.start()
+        return self
+
+    async def close(self) -> None:
+        if self.uart is not None:
+            self.uart.stop()
+            self.uart = None
+        if isinstance(self.port, str) and self.uart_port is not None:
+            self.uart_port.close()
+
+    async def __aenter__(self) -> "AsyncBootloader":
+        return await self.open()
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    async def _request(self, cmd: int, data: list = (),
+                       timeout: float = None) -> bytes:
+        # one command and its response frame
+        tx_buf = dl_bld_prep_packet(length=len(data) + 4,
+                                    cmd=cmd,
+                                    data=list(data),
+                                    csum=1,
+                                    req_ack=1)
+        self.uart.write([bytes(tx_buf)])
+        return await self.uart.read_frame(
+            self.timeout if timeout is None else timeout)
+
+    async def _request_ack(self, cmd: int, data: list = ()) -> bool:
+        frame = await self._request(cmd, data)
+        return frame is not None and len(frame) == 3 and bool(frame[1])
+
+    #
+    # Commands
+    #========================================================================
+
+    async def get_version(self) -> bytes:
+        """
+        Returns:
+            bytes: The version string, None if the bootloader does not
+                answer.
+        """
+        frame = await self._request(Cmd.CMD_GET_BLD_VER)
+        return bytes(frame[1:-1]) if frame is not None else None
+
+    async def get_caps(self) -> BldCaps:
+        """See dl_bld_get_caps(), also restarts the write sequence."""
+        frame = await self._request(Cmd.CMD_GET_CAPS, timeout=0.2)
+        if frame is None or len(frame) != 6:
+            return None
+        return BldCaps(rx_frame_max=(frame[1] << 8) | frame[2],
+                       rx_slots=frame[3],
+                       flags=frame[4])
+
+    async def blanking(self, addr: int, size: int) -> bool:
+        return await self._request_ack(
+            Cmd.CMD_CHECK_BLANKING,
+            addr.to_bytes(4, "big") + size.to_bytes(4, "big"))
+
+    async def erase(self, addr: int, size: int) -> bool:
+        return await self._request_ack(
+            Cmd.CMD_ERASE,
+            addr.to_bytes(4, "big") + size.to_bytes(4, "big"))
+
+    async def check_crc(self, addr: int, size: int, crc: int) -> bool:
+        ok = await self._request_ack(
+            Cmd.CMD_IMAGE_CRC_VERIFY,
+            addr.to_bytes(4, "big") + size.to_bytes(4, "big") +
+            crc.to_bytes(4, "big"))
+        if not ok:
+            measure_metrics(self.uart_port).count("crc_mismatches")
+        return ok
+
+    async def read_sector_crcs(self, sector_addrs: list) -> dict:
+        """See dl_bld_read_sector_crcs()."""
+        crcs = {}
+        for start_addr, count in dl_bld_sector_crc_runs(sector_addrs):
+            run_crcs = dl_bld_sector_crc_parse(
+                start_addr, count, await self._request(
+                    Cmd.CMD_SECTOR_CRC,
+                    start_addr.to_bytes(4, "big") + bytes([count])))
+            if run_crcs is None:
+                print(f"[{self.uart_port.port}] read sector CRC "
+                      f"@{start_addr} failed")
+                return None
+            crcs.update(run_crcs)
+        return crcs
+
+    async def exit(self, entry_addr: int = None) -> bool:
+        """Leave the bootloader, see dl_bld_exit()."""
+        data = entry_addr.to_bytes(4, "big") if entry_addr is not None \
+            else b""
+        return await self._request_ack(Cmd.CMD_EXIT_BLD, data)
+
+    async def upload(self,
+                     image_info,
+                     window: int = BLD_UPLOAD_WINDOW,
+                     chunk_size: int = None,
+                     progress=None,
+                     delta: bool = False,
+                     compress: bool = True) -> bool:
+        """
+        Erase, write and verify the image, see dl_bld_upload_target_file().
+        The plan, the write mode and the sectors erased are the ones of the
+        blocking upload, only the I/O is awaited.
+
+        Args:
+            image_info (ImageInfo | BldImagePlan): Image to upload, a plan
+                is reused as is (e.g. from dl_cache).
+            window (int): CMD_WRITE_SEQ packets in flight.
+            chunk_size (int): Bytes per write packet, by default the largest
+                one the bootloader can receive.
+            progress (callable): Called as progress(stage, done, total).
+            delta (bool): Only erase and write the sectors that differ.
+            compress (bool): Allow run-length encoded writes.
+
+        Returns:
+            bool: True once the device CRC matches the image.
+        """
+        plan = image_info if isinstance(image_info, BldImagePlan) else \
+            BldImagePlan(image_info)
+        metrics = measure_metrics(self.uart_port)
+
+        with metrics.span("caps"):
+            caps = await self.get_caps()
+        use_seq, window, chunk_size, compress = dl_bld_write_mode(
+            caps, window, chunk_size, compress)
+
+        if delta and not (caps is not None and caps.sector_crc):
+            print(f"[{self.uart_port.port}] delta update not supported, "
+                  f"full update")
+        elif delta:
+            with metrics.span("delta"):
+                device_crcs = await self.read_sector_crcs(
+                    [sector_addr for sector_addr, _ in plan.sectors])
+            if device_crcs is None:
+                return False
+            plan = plan.delta(device_crcs)
+            if not plan.sectors:
+                return True
+
+        with metrics.span("erase"):
+            if not await self._erase_image(plan, progress):
+                print(f"[{self.uart_port.port}] erase failed")
+                return False
+
+        with metrics.span("write"):
+            if not await self._write(plan.chunks(chunk_size), window,
+                                     progress, compress, use_seq):
+                return False
+
+        with metrics.span("verify"):
+            for idx, (start_addr, span_size) in enumerate(plan.spans):
+                if not await self.check_crc(start_addr, span_size,
+                                            plan.span_crcs[idx]):
+                    print(f"[{self.uart_port.port}] CRC mismatch "
+                          f"@{start_addr}")
+                    return False
+                if progress:
+                    progress("verify", idx + 1, len(plan.spans))
+        return True
+
+    async def _erase_image(self, plan: BldImagePlan, progress) -> bool:
+        # the sector decisions of dl_bld_erase_image(), awaited
+        steps = dl_bld_erase_steps(plan, progress)
+        try:
+            cmd, addr, size = next(steps)
+            while True:
+                if cmd == Cmd.CMD_CHECK_BLANKING:
+                    answer = await self.blanking(addr, size)
+                else:
+                    answer = await self.erase(addr, size)
+                cmd, addr, size = steps.send(answer)
+        except StopIteration as stop:
+            return bool(stop.value)
+
+    async def _write(self, chunks: list, window: int, progress,
+                     compress: bool, seq: bool,
+                     max_attempt: int = 3) -> bool:
+        """
+        Write the chunks with up to `window` packets in flight, the async
+        counterpart of dl_bld_write_pipelined(). Without seq every chunk is
+        a CMD_WRITE_CRC waiting for its ACK.
+        """
+        window = max(1, min(window, BLD_SEQ_WINDOW_MAX))
+        quality = dl_uart_link_quality(self.uart_port)
+        metrics = measure_metrics(self.uart_port)
+        acked = bytearray(len(chunks))
+        # seq: [chunk index, packet, deadline (0 while waiting to be sent),
+        #       attempt]
+        pending = {}
+        base = 0
+        next_idx = 0
+        loop = asyncio.get_running_loop()
+
+        while base < len(chunks):
+            batch = [entry for entry in pending.values() if not entry[2]]
+            while next_idx < len(chunks) and next_idx < base + window:
+                write_addr, chunk = chunks[next_idx]
+                key = next_idx & 0xFF
+                tx_buf = dl_bld_prep_write_packet(write_addr, chunk,
+                                                  key if seq else None,
+                                                  compress)
+                pending[key] = [next_idx, bytes(tx_buf), 0.0, 1]
+                batch.append(pending[key])
+                next_idx += 1
+            if batch:
+                self.uart.write([entry[1] for entry in batch])
+                deadline = loop.time() + self.timeout
+                for entry in batch:
+                    entry[2] = deadline
+
+            deadlines = [entry[2] for entry in pending.values() if entry[2]]
+            frame = await self.uart.read_frame(min(deadlines) - loop.time())
+
+            failed = []
+            if frame is None:
+                now = loop.time()
+                for entry in pending.values():
+                    if entry[2] and entry[2] <= now:
+                        quality.record_timeout()
+                        failed.append(entry)
+            else:
+                # CMD_WRITE_CRC answers [ack], CMD_WRITE_SEQ [ack, seq]
+                key = frame[2] if seq and len(frame) == 4 else \
+                    next(iter(pending)) if not seq and len(frame) == 3 \
+                    else None
+                if key in pending and frame[1]:
+                    quality.record_ok()
+                    acked[pending.pop(key)[0]] = 1
+                    old_base = base
+                    while base < len(chunks) and acked[base]:
+                        base += 1
+                    if progress and base != old_base:
+                        progress("write", base, len(chunks))
+                elif key in pending and pending[key][2]:
+                    quality.record_nack()
+                    metrics.count("nacks")
+                    failed.append(pending[key])
+
+            for entry in failed:
+                entry[2] = 0.0
+                if entry[3] == max_attempt:
+                    print(f"[{self.uart_port.port}] write "
+                          f"@{chunks[entry[0]][0]} failed {max_attempt} "
+                          f"times, abort")
+                    return False
+                entry[3] += 1
+                metrics.count("retries")
+            if frame is None and failed:
+                await asyncio.sleep(quality.backoff())
+        return True
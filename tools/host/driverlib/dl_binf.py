@@ -1,10 +1,8 @@
-from dl_file import *
+import mmap
+import os
 
-#
-# DEFINES AND VARIABLES
-#============================================================================
-
-_image_info = ImageInfo()
+from dl_file import *
+from utils.measure import measure_metrics
 
 #
 # Command functions: Only need this one
@@ -13,35 +11,40 @@ _image_info = ImageInfo()
 
 def dl_bin_readf(file_path: str, start_addr: int = 0x00000000) -> ImageInfo:
     """
-    Read and verify the BIN file, and store the image in RAM.
+    Read the BIN file as one image segment at start_addr.
+
+    The file is memory-mapped and the segment is a read-only view of the
+    mapping, so loading costs the same whatever the image size and the
+    upload slices its chunks straight from the page cache. The file must
+    not change while the image is in use.
     """
     print("Verify file path: opening file...")
     try:
-        with open(file_path, 'rb') as file:
+        with open(file_path, 'rb') as file, \
+                measure_metrics().span("parse_bin"):
             print("Verify file path: file opened successfully")
 
-            _image_info.s_addr = start_addr & 0xFFFF
-            _image_info.main_addr = (start_addr >> 16) & 0xFFFF
-            dl_binf_shadow_read(_image_info, file)
-            return _image_info
+            image = ImageInfo()
+            dl_binf_shadow_read(image, file, start_addr)
+            return image
 
     except FileNotFoundError:
         print(f"File not found: {file_path}")
         return None
-    except IOError:
+    except (IOError, ValueError):
         print(f"An error occurred while reading the file: {file_path}")
         return None
 
 
 @staticmethod
-def dl_binf_shadow_read(image: ImageInfo, f) -> None:
-    f.seek(0, 0)  # return cursor to start of line
-
-    print("Shadowing bin file: reading file...")
-    data = f.read()
-
-    for i, byte in enumerate(data):
-        image.mem_buffer[i] = byte
-
-    image.e_addr = image.s_addr + len(data) - 1
-    print("Shadowing bin file: memory copy success")
+def dl_binf_shadow_read(image: ImageInfo, f, start_addr: int) -> None:
+    print("Shadowing bin file: mapping file...")
+    if os.fstat(f.fileno()).st_size == 0:
+        # an empty file cannot be mapped, the image stays empty
+        print("Shadowing bin file: file is empty")
+        return
+    # the mapping outlives the file, the segment view keeps it open
+    data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    image.add(start_addr, data, copy=False)
+    print(f"Shadowing bin file: {len(data)} bytes mapped at "
+          f"0x{start_addr:08X}")
@@ -1,8 +1,13 @@
+import array
+import threading
+
 from dl_file import *
 from dl_uart import *
 from utils.checksum import *
 from utils.crc import crc32_lookup_tb
-from utils.measure import measure_exe_time
+from utils.rle import rle_encode
+from utils.measure import measure_exe_time, measure_metrics
+from common.memory_map import SECTOR_SIZE
 
 #
 # VARIABLES AND DEFINES
@@ -24,10 +29,185 @@ class Cmd():
     CMD_IMAGE_CRC_VERIFY = 0x08
     CMD_SYSRST = 0x09
     CMD_EXIT_BLD = 0x0A
-    CMD_NUM = 0x0A
+    CMD_WRITE_SEQ = 0x0B
+    CMD_GET_CAPS = 0x0C
+    CMD_SECTOR_CRC = 0x0D
+    CMD_WRITE_RLE = 0x0E
+    CMD_SET_BAUD = 0x0F
+    CMD_NUM = 0x10
     CMD_UNDEFINED = 0xFF
 
 
+# Write frames kept in flight by the pipelined upload, 1 means stop-and-wait
+BLD_UPLOAD_WINDOW = 4
+# Sequence numbers are 1 byte, at most half of them can be in flight
+BLD_SEQ_WINDOW_MAX = 128
+
+# Length byte 0x00 announces an extended frame with a 16-bit length
+BLD_FRAME_EXT_MARK = 0x00
+BLD_FRAME_LEN_MAX = 0xFF
+# Write chunk of bootloaders without CMD_GET_CAPS
+BLD_CHUNK_SIZE_LEGACY = 240
+# len, cmd, seq, 4b address, req_ack, 4b crc
+BLD_WRITE_SEQ_OVERHEAD = 12
+# CMD_WRITE_RLE adds the 2b decoded length
+BLD_WRITE_RLE_OVERHEAD = 14
+# CRCs answered per CMD_SECTOR_CRC request
+BLD_SECTOR_CRC_MAX = 16
+# erased flash reads as 0xFF
+BLD_BLANK_BYTE = 0xFF
+BLD_BLANK_SECTOR_CRC = crc32_lookup_tb(bytes([BLD_BLANK_BYTE]) * SECTOR_SIZE)
+# after CMD_SET_BAUD the device goes back to its previous baudrate unless a
+# frame arrives at the new one within this time
+BLD_BAUD_CONFIRM_S = 0.2
+# the device switches once its ACK is out, give it time before talking
+BLD_BAUD_SETTLE_S = 0.002
+# link manager: a window of exchanges with more errors than this, or
+# BLD_LINK_TIMEOUTS_MAX timeouts in a row, steps the baudrate down
+BLD_LINK_ERR_MAX = 0.1
+BLD_LINK_TIMEOUTS_MAX = 2
+# windows without any error before trying the next higher baudrate, doubled
+# each time that baudrate had to be left again
+BLD_LINK_CLEAN_WINDOWS = 4
+BLD_LINK_BAUD_MIN = 9600
+
+
+class BldCaps:
+    """
+    Bootloader capabilities, reported by CMD_GET_CAPS.
+    """
+    WRITE_SEQ = 0x01  # pipelined writes
+    EXT_FRAME = 0x02  # frames longer than 255 bytes
+    SECTOR_CRC = 0x04  # per-sector CRCs for delta updates
+    WRITE_RLE = 0x08  # run-length encoded pipelined writes
+    SET_BAUD = 0x10  # CMD_SET_BAUD
+
+    def __init__(self, rx_frame_max: int, rx_slots: int, flags: int):
+        self.rx_frame_max = rx_frame_max
+        self.rx_slots = rx_slots
+        self.write_seq = bool(flags & self.WRITE_SEQ)
+        self.ext_frame = bool(flags & self.EXT_FRAME)
+        self.sector_crc = bool(flags & self.SECTOR_CRC)
+        self.write_rle = bool(flags & self.WRITE_RLE)
+        self.set_baud = bool(flags & self.SET_BAUD)
+
+    def chunk_size(self, limit: int = SECTOR_SIZE) -> int:
+        """
+        Largest word aligned write chunk that fits the RX buffer, at most
+        `limit` (one flash sector by default).
+        """
+        frame_max = self.rx_frame_max
+        if not self.ext_frame:
+            frame_max = min(frame_max, BLD_FRAME_LEN_MAX)
+        else:
+            frame_max -= 2  # 16-bit length header
+        return min(frame_max - BLD_WRITE_SEQ_OVERHEAD, limit) & ~0x03
+
+
+class BldImagePlan:
+    """
+    Erase ranges, write chunks, span and sector CRCs of an image.
+
+    Computed once and only read by the uploads afterwards, so one plan can
+    be shared by sessions flashing the same image on several ports.
+    """
+
+    def __init__(self,
+                 image_info: ImageInfo,
+                 span_crcs: list = None,
+                 sector_crcs: list = None):
+        """
+        Args:
+            image_info (ImageInfo): Image to upload.
+            span_crcs (list): CRC of every span, in the order of spans.
+            sector_crcs (list): CRC of every sector, in the order of
+                sectors. Both come from an earlier plan of the same image
+                (see dl_cache), given they skip the CRC pass.
+
+        Raises:
+            ValueError: The given CRCs do not match the spans or sectors
+                of the image.
+        """
+        self.image_info = image_info
+        self.spans = image_info.spans(align=4)
+        self.erase_ranges = []
+        for start_addr, span_size in self.spans:
+            # the MCU erases the sector of every SECTOR_SIZE step from the
+            # start address, widen the range so the last sector is not
+            # skipped
+            erase_addr = start_addr - start_addr % SECTOR_SIZE
+            erase_size = -(-(start_addr + span_size - erase_addr) //
+                           SECTOR_SIZE) * SECTOR_SIZE
+            self.erase_ranges.append((erase_addr, erase_size))
+        if span_crcs is not None and len(span_crcs) != len(self.spans):
+            raise ValueError("span CRCs do not match the image")
+        self.span_crcs = span_crcs
+        if span_crcs is None:
+            self.span_crcs = [
+                crc32_lookup_tb(image_info.read(start_addr, span_size))
+                for start_addr, span_size in self.spans
+            ]
+        # expected content of every erased sector, bytes outside the image
+        # stay erased (0xFF)
+        sector_addrs = sorted({
+            sector_addr
+            for erase_addr, erase_size in self.erase_ranges
+            for sector_addr in range(erase_addr, erase_addr +
+                                     erase_size, SECTOR_SIZE)
+        })
+        if sector_crcs is not None and len(sector_crcs) != len(sector_addrs):
+            raise ValueError("sector CRCs do not match the image")
+        if sector_crcs is None:
+            sector_crcs = [
+                crc32_lookup_tb(image_info.read(sector_addr, SECTOR_SIZE))
+                for sector_addr in sector_addrs
+            ]
+        self.sectors = list(zip(sector_addrs, sector_crcs))
+        # sectors left blank by the image (padding, reserved areas)
+        self.blank_sectors = {
+            sector_addr
+            for sector_addr, crc in self.sectors
+            if crc == BLD_BLANK_SECTOR_CRC
+        }
+        # sectors known to be blank on the device, see delta()
+        self.device_blank = set()
+        self._chunks = {}
+        self._lock = threading.Lock()
+
+    def chunks(self, chunk_size: int) -> list:
+        """
+        Returns:
+            list: (write_addr, chunk) tuples, see dl_bld_plan_chunks().
+        """
+        with self._lock:
+            if chunk_size not in self._chunks:
+                self._chunks[chunk_size] = dl_bld_plan_chunks(
+                    self.image_info, chunk_size)
+            return self._chunks[chunk_size]
+
+    def delta(self, device_crcs: dict) -> "BldImagePlan":
+        """
+        Plan of the sectors whose flash content differs from the image.
+
+        Args:
+            device_crcs (dict): sector address: CRC read from the device.
+        """
+        image = ImageInfo()
+        image.start_addr = self.image_info.start_addr
+        for sector_addr, crc in self.sectors:
+            if device_crcs.get(sector_addr) != crc:
+                for addr, view in self.image_info.clip(sector_addr,
+                                                       SECTOR_SIZE).views():
+                    image.add(addr, view)
+        plan = BldImagePlan(image)
+        plan.device_blank = {
+            sector_addr
+            for sector_addr, crc in device_crcs.items()
+            if crc == BLD_BLANK_SECTOR_CRC
+        }
+        return plan
+
+
 #
 # Static functions
 # They are utility functions that can be used independently.
@@ -38,7 +218,8 @@ def dl_bld_prep_packet(length: int,
                        data: list,
                        csum: int = 1,
                        crc32: int = 0,
-                       req_ack: int = 0) -> bytearray:
+                       req_ack: int = 0,
+                       seq: int = None) -> bytearray:
     """
     Prepare a packet to be sent over UART.
 
@@ -49,12 +230,21 @@ def dl_bld_prep_packet(length: int,
         req_ack (int): Acknowledgment request flag (1 for ACK, 0 for no ACK).
         csum (int): Checksum flag (1 to include checksum, 0 otherwise).
         crc32 (int): CRC32 flag (1 to include CRC32, 0 otherwise).
+        seq (int): Sequence number placed after the command byte, used by
+            pipelined commands to match their ACK (None to omit it).
         
     Returns:
         bytearray: The prepared packet.
     """
 
-    packet = [length, cmd] + data + [req_ack]
+    if length > BLD_FRAME_LEN_MAX:
+        # extended frame, the 16-bit length counts its 2 extra header bytes
+        length += 2
+        header = [BLD_FRAME_EXT_MARK, length >> 8, length & 0xFF, cmd]
+    else:
+        header = [length, cmd]
+
+    packet = header + ([] if seq is None else [seq]) + data + [req_ack]
     # recommendation, if length is > 64 bytes using crc
     if crc32:
         crc = crc32_lookup_tb(packet)
@@ -65,13 +255,104 @@ def dl_bld_prep_packet(length: int,
     return bytearray(packet)
 
 
+@staticmethod
+def dl_bld_prep_write_packet(write_addr: int,
+                             chunk,
+                             seq: int = None,
+                             compress: bool = False) -> bytearray:
+    """
+    Prepare a CRC protected write packet for one chunk of the image.
+
+    Args:
+        write_addr (int): Flash address of the chunk.
+        chunk (bytes-like): Chunk data, a multiple of 4 bytes.
+        seq (int): Sequence number, selects CMD_WRITE_SEQ instead of
+            CMD_WRITE_CRC.
+        compress (bool): Send the chunk run-length encoded in a
+            CMD_WRITE_RLE packet when that is shorter (requires seq).
+
+    Returns:
+        bytearray: The prepared packet.
+
+    Notes:
+        Same frame as dl_bld_prep_packet() builds, encoded into one
+        preallocated buffer: header, address, word swapped payload, req_ack
+        and the CRC are written in place without per-byte lists.
+        CMD_WRITE_RLE carries the decoded length after the address and the
+        encoded chunk in its original byte order.
+    """
+    cmd = Cmd.CMD_WRITE_CRC if seq is None else Cmd.CMD_WRITE_SEQ
+    fields = write_addr.to_bytes(4, "big")
+    payload = None
+    if compress and seq is not None:
+        payload = rle_encode(chunk)
+        if len(payload) + 2 < len(chunk):
+            cmd = Cmd.CMD_WRITE_RLE
+            fields += len(chunk).to_bytes(2, "big")
+        else:
+            payload = None
+    payload_len = len(chunk if payload is None else payload)
+
+    length = payload_len + len(fields) + (3 if seq is None else 4) + 4
+    if length > BLD_FRAME_LEN_MAX:
+        length += 2
+        header = bytes((BLD_FRAME_EXT_MARK, length >> 8, length & 0xFF))
+    else:
+        header = bytes((length, ))
+    header += bytes((cmd, ) if seq is None else (cmd, seq))
+
+    packet = bytearray(length)
+    ofs = len(header)
+    packet[:ofs] = header
+    packet[ofs:ofs + len(fields)] = fields
+    ofs += len(fields)
+
+    if payload is not None:
+        packet[ofs:ofs + payload_len] = payload
+    else:
+        # rearrange data to big endian format, 32-bit words are swapped in C
+        words = array.array("I")
+        words.frombytes(chunk)
+        words.byteswap()
+        packet[ofs:ofs + payload_len] = memoryview(words).cast("B")
+    ofs += payload_len
+
+    packet[ofs] = 1  # req_ack
+    crc = crc32_lookup_tb(memoryview(packet)[:ofs + 1])
+    packet[ofs + 1:] = crc.to_bytes(4, "big")
+    return packet
+
+
+@staticmethod
+def dl_bld_plan_chunks(image_info: ImageInfo, chunk_size: int) -> list:
+    """
+    Split the image into the write chunks of the upload.
+
+    Chunks that only hold 0xFF are left out, the erase already set them.
+
+    Returns:
+        list: (write_addr, chunk) tuples, chunks are word aligned.
+    """
+    chunks = []
+    blank = bytes([BLD_BLANK_BYTE]) * chunk_size
+    # flash is programmed word by word, gaps between spans are left untouched
+    for start_addr, span_size in image_info.spans(align=4):
+        for ofs in range(0, span_size, chunk_size):
+            size = min(chunk_size, span_size - ofs)
+            chunk = image_info.read(start_addr + ofs, size)
+            if chunk != blank[:size]:
+                chunks.append((start_addr + ofs, chunk))
+    return chunks
+
+
 #
 # Command functions
 #============================================================================
 
 
 # CMD 2: GET BOOTLOADER VERSION
-def dl_bld_get_version(uart_port: serial.Serial) -> bytearray:
+def dl_bld_get_version(uart_port: serial.Serial,
+                       timeout: float = 1.0) -> bytearray:
     """
     Retrieve the bootloader version from the MCU.
 
@@ -91,23 +372,273 @@ def dl_bld_get_version(uart_port: serial.Serial) -> bytearray:
     # Send the command over UART
     dl_uart_write(uart_port, tx_buf)
     # handle response
-    resp = dl_uart_read_resp(uart_port)
+    resp = dl_uart_read_resp(uart_port, timeout)
     return resp if resp[0] else resp[0]
 
 
+# CMD 12: GET CAPABILITIES
+def dl_bld_get_caps(uart_port: serial.Serial,
+                    timeout: float = 0.2) -> BldCaps:
+    """
+    Query the frame size and features supported by the bootloader.
+
+    Returns:
+        BldCaps: The capabilities, None for bootloaders that predate the
+            command (they do not answer).
+    """
+    tx_buf = dl_bld_prep_packet(length=4,
+                                cmd=Cmd.CMD_GET_CAPS,
+                                data=[],
+                                csum=1,
+                                req_ack=1)
+    dl_uart_write(uart_port, tx_buf)
+
+    resp = dl_uart_read_frame(uart_port, timeout)
+    if resp is None or len(resp) != 6:
+        return None
+    return BldCaps(rx_frame_max=(resp[1] << 8) | resp[2],
+                   rx_slots=resp[3],
+                   flags=resp[4])
+
+
+# CMD 13: SECTOR CRC
+def dl_bld_read_sector_crcs(uart_port: serial.Serial,
+                            sector_addrs: list) -> dict:
+    """
+    Read the CRC of flash sectors, BLD_SECTOR_CRC_MAX consecutive sectors
+    per request.
+
+    Notes:
+        The data sent includes:
+        - 1 length byte (value = 9)
+        - 1 command byte (CMD_SECTOR_CRC)
+        - 4 address bytes
+        - 1 sector count byte
+        - 1 req ack byte
+        - 1 checksum byte
+        The response holds a 4-byte big endian CRC per sector.
+
+    Returns:
+        dict: sector address: CRC, None if the device did not answer.
+    """
+    crcs = {}
+    for start_addr, count in dl_bld_sector_crc_runs(sector_addrs):
+        packet_data = list(start_addr.to_bytes(4, "big")) + [count]
+        tx_buf = dl_bld_prep_packet(length=len(packet_data) + 4,
+                                    cmd=Cmd.CMD_SECTOR_CRC,
+                                    data=packet_data,
+                                    csum=1,
+                                    req_ack=1)
+        dl_uart_write(uart_port, tx_buf)
+
+        run_crcs = dl_bld_sector_crc_parse(start_addr, count,
+                                           dl_uart_read_frame(uart_port))
+        if run_crcs is None:
+            print(f"Read sector CRC @{start_addr} failed")
+            return None
+        crcs.update(run_crcs)
+    return crcs
+
+
+@staticmethod
+def dl_bld_sector_crc_runs(sector_addrs: list) -> list:
+    """
+    Group sectors into CMD_SECTOR_CRC requests.
+
+    Returns:
+        list: [start address, sector count] of runs of consecutive sectors,
+            BLD_SECTOR_CRC_MAX sectors at most.
+    """
+    runs = []
+    for sector_addr in sorted(sector_addrs):
+        if runs and runs[-1][0] + runs[-1][1] * SECTOR_SIZE == sector_addr \
+                and runs[-1][1] < BLD_SECTOR_CRC_MAX:
+            runs[-1][1] += 1
+        else:
+            runs.append([sector_addr, 1])
+    return runs
+
+
+@staticmethod
+def dl_bld_sector_crc_parse(start_addr: int, count: int, resp) -> dict:
+    """
+    Returns:
+        dict: sector address: CRC of a CMD_SECTOR_CRC response, None if
+            the response is missing or does not hold count CRCs.
+    """
+    if resp is None or len(resp) != count * 4 + 2:
+        return None
+    return {
+        start_addr + idx * SECTOR_SIZE:
+        int.from_bytes(resp[1 + idx * 4:5 + idx * 4], "big")
+        for idx in range(count)
+    }
+
+
+# CMD 15: SET BAUDRATE
+def dl_bld_set_baud(uart_port: serial.Serial, baudrate: int) -> int:
+    """
+    Move the device and the port to another baudrate.
+
+    The device ACKs at the current baudrate, then switches and waits for a
+    frame at the new one. A CMD_GET_BLD_VER confirms the switch, without it
+    both sides go back to the previous baudrate.
+
+    Notes:
+        The data sent includes:
+        - 1 length byte (value = 8)
+        - 1 command byte (CMD_SET_BAUD)
+        - 4 baudrate bytes
+        - 1 req ack byte
+        - 1 checksum byte
+
+    Returns:
+        int: 1 if the link now runs at baudrate, 0 if it stayed at the
+            previous one (rejected by the device or not confirmed).
+    """
+    old_baudrate = uart_port.baudrate
+    tx_buf = dl_bld_prep_packet(length=8,
+                                cmd=Cmd.CMD_SET_BAUD,
+                                data=list(baudrate.to_bytes(4, "big")),
+                                csum=1,
+                                req_ack=1)
+    dl_uart_write(uart_port, tx_buf)
+
+    resp = dl_uart_read_frame(uart_port, BLD_BAUD_CONFIRM_S)
+    if resp is None or len(resp) != 3 or not resp[1]:
+        print(f"Set baudrate: {baudrate} rejected")
+        return 0
+
+    uart_port.flush()
+    uart_port.baudrate = baudrate
+    time.sleep(BLD_BAUD_SETTLE_S)
+    if dl_bld_get_version(uart_port, BLD_BAUD_CONFIRM_S):
+        dl_uart_link_quality(uart_port).reset()
+        print(f"Set baudrate: {old_baudrate} -> {baudrate}")
+        return 1
+
+    # the device restores its baudrate by itself
+    print(f"Set baudrate: {baudrate} not confirmed, back to {old_baudrate}")
+    uart_port.baudrate = old_baudrate
+    time.sleep(BLD_BAUD_CONFIRM_S)
+    uart_port.reset_input_buffer()
+    dl_uart_frame_parser(uart_port).reset()
+    return 0
+
+
+class BldLinkManager:
+    """
+    Move the baudrate of a port along BUADRATE_LIST with its link quality.
+
+    The write loops record every exchange in the port UartLinkQuality. A
+    window with more than BLD_LINK_ERR_MAX errors, or timeouts in a row,
+    steps the baudrate down; clean windows step it back up, never above
+    baud_max. Baudrates the device did not accept are not tried again.
+    """
+
+    def __init__(self, uart_port: serial.Serial, baud_max: int):
+        self.uart_port = uart_port
+        self.baud_initial = uart_port.baudrate
+        self.bauds = [
+            baud for baud in BUADRATE_LIST
+            if BLD_LINK_BAUD_MIN <= baud <= baud_max
+        ]
+        self.quality = dl_uart_link_quality(uart_port)
+        self.blocked = set()
+        self.step_downs = {}  # baudrate: times it had to be left
+        self.clean_windows = 0
+        self._target = None
+        self._reason = ""
+
+    def start(self) -> None:
+        """Switch to the fastest baudrate the device accepts."""
+        for baud in reversed(self.bauds):
+            if baud == self.uart_port.baudrate or \
+                    dl_bld_set_baud(self.uart_port, baud):
+                return
+            self.blocked.add(baud)
+
+    def restore(self) -> None:
+        """Go back to the baudrate the port was opened with."""
+        if self.uart_port.baudrate != self.baud_initial:
+            dl_bld_set_baud(self.uart_port, self.baud_initial)
+
+    def target(self, urgent: bool = False) -> int:
+        """
+        Args:
+            urgent (bool): Judge the window even if it is not full yet, a
+                packet is about to be given up.
+
+        Returns:
+            int: Baudrate to switch to before the next exchange, None to
+                stay. Stable until switch() is called.
+        """
+        if self._target is None:
+            self._target = self._evaluate(urgent)
+        return self._target
+
+    def switch(self) -> None:
+        """Apply target(), to be called while no frame is in flight."""
+        baud, self._target = self._target, None
+        if baud is None:
+            return
+        old_baud = self.uart_port.baudrate
+        print(f"Link: {self._reason} at {old_baud}")
+        if baud < old_baud:
+            self.step_downs[old_baud] = self.step_downs.get(old_baud, 0) + 1
+        if not dl_bld_set_baud(self.uart_port, baud):
+            self.blocked.add(baud)
+        self.quality.reset()
+        self.clean_windows = 0
+
+    def _evaluate(self, urgent: bool) -> int:
+        quality = self.quality
+        if quality.timeouts_in_row >= BLD_LINK_TIMEOUTS_MAX:
+            self._reason = f"{quality.timeouts_in_row} timeouts in a row"
+            return self._next_baud(-1)
+        if not quality.full() and not urgent:
+            return None
+
+        # every window is judged once
+        error_rate = quality.error_rate()
+        quality.outcomes.clear()
+        if error_rate > BLD_LINK_ERR_MAX:
+            self._reason = f"{error_rate:.0%} errors"
+            return self._next_baud(-1)
+        self.clean_windows = self.clean_windows + 1 if not error_rate else 0
+        higher = self._next_baud(1)
+        if higher is not None and self.clean_windows >= \
+                BLD_LINK_CLEAN_WINDOWS << self.step_downs.get(higher, 0):
+            self._reason = f"{self.clean_windows} clean windows"
+            return higher
+        return None
+
+    def _next_baud(self, step: int) -> int:
+        baud = self.uart_port.baudrate
+        if step < 0:
+            bauds = [b for b in reversed(self.bauds) if b < baud]
+        else:
+            bauds = [b for b in self.bauds if b > baud]
+        bauds = [b for b in bauds if b not in self.blocked]
+        return bauds[0] if bauds else None
+
+
 # CMD 3: CHECK BLANKING
 def dl_bld_blanking(uart_port: serial.Serial,
                     fl_adr,
                     size,
-                    req_ack: int = 1) -> bool:
+                    req_ack: int = 1,
+                    check_conn: bool = True) -> bool:
     """
     Check blanking of memory range based on starting address and memory length.
+    check_conn=False skips the version round trip, for callers that already
+    know the bootloader answers (see BldSession).
     
     Data sent includes:
         1b len, 1b cmd, 4b address, 4b size, 1b req_ack, 1b checksum
     """
     # check connection first
-    if not dl_bld_get_version(uart_port):
+    if check_conn and not dl_bld_get_version(uart_port):
         print("Read BLD version failed, MCU might be out of bootloader")
         return 0
     # Connection confirmed, continue function
@@ -139,15 +670,17 @@ def dl_bld_blanking(uart_port: serial.Serial,
 def dl_bld_write(uart_port: serial.Serial,
                  fl_adr,
                  data: bytearray,
-                 req_ack: int = 0) -> bytearray:
+                 req_ack: int = 0,
+                 check_conn: bool = True) -> bytearray:
     """
     Send data to the MCU to be written to flash memory.
+    check_conn=False skips the version round trip, see dl_bld_blanking().
 
     Data sent includes:
         1b len, 1b cmd, 4b address, n data, 1b req_ack, 1b checksum
     """
     # check connection first
-    if not dl_bld_get_version(uart_port):
+    if check_conn and not dl_bld_get_version(uart_port):
         print("Read BLD version failed, MCU might be out of bootloader")
         return 0
     # Connection confirmed, continue function
@@ -186,7 +719,8 @@ def dl_bld_write(uart_port: serial.Serial,
 def dl_bld_erase(uart_port: serial.Serial,
                  fl_adr,
                  size,
-                 req_ack: int = 0) -> bytearray:
+                 req_ack: int = 0,
+                 check_conn: bool = True) -> bytearray:
     """
     Send erase command to MCU. Including starting address and size of memory to be erased.
 
@@ -201,12 +735,14 @@ def dl_bld_erase(uart_port: serial.Serial,
         fl_adr (int/str): Start address of the memory range to be erased (int or hex string).
         size (int/str): Size of data to be erased (int or hex string).
         req_ack (int): Acknowledgment request flag (1 for ACK, 0 for no ACK).
+        check_conn (bool): Confirm the bootloader answers first, False if
+            the caller already did (see BldSession).
 
     Returns:
         bytearray: The response from the MCU after the erase operation.
     """
     # check connection first
-    if not dl_bld_get_version(uart_port):
+    if check_conn and not dl_bld_get_version(uart_port):
         print("Read BLD version failed, MCU might be out of bootloader")
         return 0
     # Connection confirmed, continue function
@@ -240,9 +776,9 @@ def dl_bld_erase(uart_port: serial.Serial,
 #
 # CMD 6: UPLOADING
 #=====================================================================
-def dl_bld_upload(uart_port: serial.Serial):
+def dl_bld_upload(uart_port: serial.Serial, check_conn: bool = True):
     # check connection first
-    if not dl_bld_get_version(uart_port):
+    if check_conn and not dl_bld_get_version(uart_port):
         print("Read BLD version failed, MCU might be out of bootloader")
         return 0
     # Connection confirmed, continue function
@@ -260,7 +796,7 @@ def dl_bld_upload(uart_port: serial.Serial):
 
         print("Uploading bin file")
     elif fpath.endswith(".elf"):
-        print("Uploading elf file")
+        return dl_bld_upload_elff(uart_port, fpath)
 
     return 1
 
@@ -271,6 +807,19 @@ def dl_bld_upload_hexf(uart_port: serial.Serial, file_path: str):
     from dl_hexf import dl_hexf_readf
     # upload image
     image_info = dl_hexf_readf(file_path)
+    if image_info is None:
+        return 0
+    return dl_bld_upload_target_file(uart_port, image_info)
+
+
+@measure_exe_time
+@staticmethod
+def dl_bld_upload_elff(uart_port: serial.Serial, file_path: str):
+    from dl_elff import dl_elff_readf
+    # upload image, segments are views into the mapped file
+    image_info = dl_elff_readf(file_path)
+    if image_info is None:
+        return 0
     return dl_bld_upload_target_file(uart_port, image_info)
 
 
@@ -288,81 +837,412 @@ def dl_bld_upload_binf(uart_port: serial.Serial, file_path: str, start_addr):
 
     # prepare upload image
     image_info = dl_bin_readf(file_path, start_addr)
+    if image_info is None:
+        return 0
 
     # upload image
     return dl_bld_upload_target_file(uart_port, image_info)
 
 
 @staticmethod
-def dl_bld_upload_target_file(uart_port: serial.Serial, image_info: ImageInfo):
-    # Prepare the transmit buffer
-    chunk_size = 240  # 240 bytes /max = 240
-    image_size = image_info.e_addr - image_info.s_addr + 1
-    num_of_packets = int(
-        image_size /
-        chunk_size) + 1  # last packet may be smaller than 128 bytes
-
-    # 1. Clear the flash image
-    print("Uploading file: Cleaning flash image...")
-    start_addr = image_info.main_addr + image_info.s_addr
-    if not dl_bld_erase(uart_port, start_addr, image_size, 1):
-        print("Image cleaning failed")
-        return 0
-    print("Uploading file: Cleaning flash image success")
+def dl_bld_upload_target_file(uart_port: serial.Serial,
+                              image_info,
+                              window: int = BLD_UPLOAD_WINDOW,
+                              chunk_size: int = None,
+                              progress=None,
+                              delta: bool = False,
+                              compress: bool = True,
+                              baud_max: int = None):
+    """
+    Erase, write and verify the image.
 
-    # 2. Send write command
-    print("Uploading file: writing flash image...")
-    for i in range(num_of_packets):
+    Args:
+        uart_port (serial.Serial): The UART port object used for communication.
+        image_info (ImageInfo | BldImagePlan): Image to upload, a plan is
+            reused as is.
+        window (int): CMD_WRITE_SEQ packets in flight, 1 waits for every
+            ACK.
+        chunk_size (int): Bytes per write packet, by default the largest
+            one the bootloader reports it can receive, up to one sector.
+        progress (callable): Called as progress(stage, done, total) with
+            stage "erase", "write" or "verify".
+        delta (bool): Only erase and write the sectors whose CRC on the
+            device differs from the image.
+        compress (bool): Run-length encode the chunks that shrink, if the
+            bootloader supports CMD_WRITE_RLE.
+        baud_max (int): Adapt the baudrate to the link quality up to
+            baud_max while writing, see BldLinkManager. The port is back at
+            its baudrate on return.
+    """
+    plan = image_info if isinstance(image_info, BldImagePlan) else \
+        BldImagePlan(image_info)
+    metrics = measure_metrics(uart_port)
+    first_span = len(metrics.spans)
+
+    # Negotiate the frame size, old bootloaders only know 240 byte
+    # stop-and-wait CMD_WRITE_CRC. The query also restarts the write
+    # sequence numbers, blank sectors are written without an erase.
+    with metrics.span("caps"):
+        caps = dl_bld_get_caps(uart_port)
+    use_seq, window, chunk_size, compress = dl_bld_write_mode(
+        caps, window, chunk_size, compress)
+    print(f"Uploading file: {chunk_size} bytes per packet, window {window}"
+          f"{', RLE' if compress else ''}")
+
+    if delta and not (caps is not None and caps.sector_crc):
+        print("Delta update: not supported by the bootloader, full update")
+    elif delta:
+        with metrics.span("delta"):
+            device_crcs = dl_bld_read_sector_crcs(
+                uart_port, [sector_addr for sector_addr, _ in plan.sectors])
+        if device_crcs is None:
+            return 0
+        num_sectors = len(plan.sectors)
+        plan = plan.delta(device_crcs)
+        print(f"Delta update: {len(plan.sectors)} of {num_sectors} sectors "
+              f"changed")
+        if not plan.sectors:
+            return 1
+
+    link = None
+    if baud_max and not (use_seq and caps.set_baud):
+        print("Adaptive baudrate: not supported by the bootloader")
+    elif baud_max:
+        link = BldLinkManager(uart_port, baud_max)
+        link.start()
+
+    try:
+        # Prepare the transmit buffer
+        chunks = plan.chunks(chunk_size)
+
+        # 1. Clear the flash image
+        # every span is erased before writing, so segments sharing a sector
+        # are not wiped out once programmed
+        print("Uploading file: Cleaning flash image...")
+        with metrics.span("erase"):
+            if not dl_bld_erase_image(uart_port, plan, progress):
+                print("Image cleaning failed")
+                return 0
+        print("Uploading file: Cleaning flash image success")
+
+        # 2. Send write command
+        print("Uploading file: writing flash image...")
+        t_start = time.perf_counter()
+        with metrics.span("write"):
+            if use_seq:
+                tx_bytes = dl_bld_write_pipelined(uart_port,
+                                                  chunks,
+                                                  window,
+                                                  progress=progress,
+                                                  compress=compress,
+                                                  link=link)
+            else:
+                tx_bytes = dl_bld_write_stop_and_wait(uart_port, chunks,
+                                                      progress)
+        if not tx_bytes:
+            return 0
+
+        elapsed = time.perf_counter() - t_start
+        print("Uploading file: write flash image success")
+        line_util = dl_uart_line_util(uart_port, tx_bytes, elapsed)
+        print(f"Uploading file: {tx_bytes} bytes in {elapsed:.3f} s, line "
+              f"utilization {line_util:.0%}")
+
+        # 3. CRC check
+        with metrics.span("verify"):
+            for idx, (start_addr, span_size) in enumerate(plan.spans):
+                if not dl_bld_check_img_crc(uart_port, start_addr, span_size,
+                                            crc=plan.span_crcs[idx]):
+                    return 0
+                if progress:
+                    progress("verify", idx + 1, len(plan.spans))
+    finally:
+        if link is not None:
+            link.restore()
+
+    print("Uploading file: " + ", ".join(
+        f"{name} {duration / 1e9:.3f} s"
+        for name, duration in metrics.spans[first_span:]))
+    return 1
+
+
+@staticmethod
+def dl_bld_write_mode(caps: BldCaps,
+                      window: int,
+                      chunk_size: int = None,
+                      compress: bool = True) -> tuple:
+    """
+    Write protocol of an upload, old bootloaders only know 240 byte
+    stop-and-wait CMD_WRITE_CRC.
+
+    Args:
+        caps (BldCaps): Capabilities of the device, None if unknown.
+        window (int): Requested packets in flight.
+        chunk_size (int): Requested bytes per packet, None for the largest
+            one the device can receive.
+        compress (bool): Run-length encoding requested.
+
+    Returns:
+        tuple: (use_seq, window, chunk_size, compress) to upload with.
+    """
+    use_seq = caps is not None and caps.write_seq
+    if use_seq:
+        chunk_size = chunk_size or caps.chunk_size()
+    else:
+        window = 1
+        chunk_size = min(chunk_size or BLD_CHUNK_SIZE_LEGACY,
+                         BLD_CHUNK_SIZE_LEGACY)
+    return use_seq, window, chunk_size, use_seq and compress and \
+        caps.write_rle
+
+
+@staticmethod
+def dl_bld_erase_image(uart_port: serial.Serial,
+                       plan: BldImagePlan,
+                       progress=None) -> int:
+    """
+    Erase the sectors of the plan, skipping the ones already blank, see
+    dl_bld_erase_steps().
+
+    Returns:
+        int: 1 on success, 0 if an erase failed.
+    """
+    steps = dl_bld_erase_steps(plan, progress)
+    try:
+        cmd, addr, size = next(steps)
+        while True:
+            # the upload already reached the bootloader with CMD_GET_CAPS
+            if cmd == Cmd.CMD_CHECK_BLANKING:
+                answer = dl_bld_blanking(uart_port, addr, size,
+                                         check_conn=False)
+            else:
+                answer = dl_bld_erase(uart_port, addr, size, 1,
+                                      check_conn=False)
+            cmd, addr, size = steps.send(answer)
+    except StopIteration as stop:
+        return stop.value
+
+
+@staticmethod
+def dl_bld_erase_steps(plan: BldImagePlan, progress=None):
+    """
+    Requests erasing the sectors of the plan, without the I/O so the
+    blocking and asyncio uploads erase the same sectors.
+
+    A CMD_CHECK_BLANKING over the whole erase range catches blank devices
+    in one request. Otherwise only the sectors the image leaves blank
+    (padding) are checked one by one, sectors holding data are erased
+    without asking.
+
+    Yields:
+        tuple: (cmd, addr, size) with cmd CMD_CHECK_BLANKING or CMD_ERASE,
+            the caller sends back whether the device answered blank / ACK.
+
+    Returns:
+        int: 1 on success, 0 if an erase failed (StopIteration value).
+    """
+    num_sectors = 0
+    num_skipped = 0
+    for idx, (erase_addr, erase_size) in enumerate(plan.erase_ranges):
+        sectors = [
+            sector_addr
+            for sector_addr in range(erase_addr, erase_addr +
+                                     erase_size, SECTOR_SIZE)
+            if sector_addr not in plan.device_blank
+        ]
+        num_sectors += erase_size // SECTOR_SIZE
+        if sectors and (yield (Cmd.CMD_CHECK_BLANKING, erase_addr,
+                               erase_size)):
+            sectors = []
+        to_erase = []
+        for sector_addr in sectors:
+            if sector_addr not in plan.blank_sectors or not (
+                    yield (Cmd.CMD_CHECK_BLANKING, sector_addr,
+                           SECTOR_SIZE)):
+                to_erase.append(sector_addr)
+        sectors = to_erase
+        num_skipped += erase_size // SECTOR_SIZE - len(sectors)
+
+        # erase runs of consecutive sectors with one request each
+        runs = []
+        for sector_addr in sectors:
+            if runs and runs[-1][0] + runs[-1][1] == sector_addr:
+                runs[-1][1] += SECTOR_SIZE
+            else:
+                runs.append([sector_addr, SECTOR_SIZE])
+        for run_addr, run_size in runs:
+            if not (yield (Cmd.CMD_ERASE, run_addr, run_size)):
+                return 0
+        if progress:
+            progress("erase", idx + 1, len(plan.erase_ranges))
+
+    if num_skipped:
+        print(f"Uploading file: {num_skipped} of {num_sectors} sectors "
+              f"already blank")
+    return 1
+
+
+@staticmethod
+def dl_bld_write_stop_and_wait(uart_port: serial.Serial,
+                               chunks: list,
+                               progress=None) -> int:
+    """
+    Write the chunks one by one, waiting for each ACK.
+
+    progress(stage, done, total) is called after every ACK when given.
+    A chunk is resent after the UartLinkQuality backoff when its ACK times
+    out, at once when it is NACKed.
+
+    Returns:
+        int: Number of bytes sent, 0 if a chunk failed 3 times.
+    """
+    quality = dl_uart_link_quality(uart_port)
+    tx_bytes = 0
+    for idx, (write_addr, chunk) in enumerate(chunks):
+        tx_buf = dl_bld_prep_write_packet(write_addr, chunk)
         num_of_attempt = 0
         while (1):
             num_of_attempt += 1
-            packet_data = []
-            # add address
-            write_addr = (image_info.main_addr <<
-                          16) + image_info.s_addr + chunk_size * i
-            packet_data.extend(
-                (write_addr >> (24 - i * 8)) & 0xFF for i in range(4))
-
-            # add data, rearrange data to big endian format
-            for j in range(0, chunk_size, 4):
-                for k in range(4):
-                    packet_data.append(image_info.mem_buffer[(chunk_size * i) +
-                                                             j + 3 - k])
-
-            tx_buf = dl_bld_prep_packet(length=len(packet_data) + 7,
-                                        cmd=Cmd.CMD_WRITE_CRC,
-                                        data=packet_data,
-                                        crc32=1,
-                                        req_ack=1)
-
-            dl_uart_write(uart_port, tx_buf)
+            tx_bytes += dl_uart_write(uart_port, tx_buf)
 
             # Handle response
-            resp = dl_uart_read_resp(uart_port)
-            if num_of_attempt == 3:
-                print("Retry failed, abort")
-                exit()
-            if resp[0]:  # ACK return success
+            resp = dl_uart_read_frame(uart_port)
+            if resp is not None and resp[1]:  # ACK return success
+                quality.record_ok()
                 break
+            if resp is None:
+                quality.record_timeout()
             else:
-                print(f"Write @{write_addr} failed, retry: {num_of_attempt}")
+                quality.record_nack()
+                measure_metrics(uart_port).count("nacks")
+            if num_of_attempt == 3:
+                print("Retry failed, abort")
+                return 0
+            measure_metrics(uart_port).count("retries")
+            print(f"Write @{write_addr} failed, retry: {num_of_attempt}")
+            time.sleep(quality.backoff())
+        if progress:
+            progress("write", idx + 1, len(chunks))
 
-    print("Uploading file: write flash image success")
+    return tx_bytes
 
-    # 3. CRC check
-    if dl_bld_check_img_crc(uart_port, start_addr, image_size,
-                            image_info.mem_buffer[:image_size]):
-        return 1
-    return 0
+
+@staticmethod
+def dl_bld_write_pipelined(uart_port: serial.Serial,
+                           chunks: list,
+                           window: int,
+                           timeout: float = 1.0,
+                           max_attempt: int = 3,
+                           progress=None,
+                           compress: bool = False,
+                           link: BldLinkManager = None) -> int:
+    """
+    Write the chunks with up to `window` CMD_WRITE_SEQ packets in flight.
+
+    ACKs are matched by sequence number. A NACKed packet was corrupted on
+    the way and is resent with the next batch, packets whose ACK does not
+    come back within timeout are resent after the UartLinkQuality backoff.
+    progress(stage, done, total) is called when the acknowledged prefix
+    grows. With compress, chunks that shrink are sent as CMD_WRITE_RLE.
+
+    When the link manager asks for another baudrate, no packet is sent
+    until the window drained, then the packets still pending get their
+    attempts back.
+
+    Returns:
+        int: Number of bytes sent, 0 if a chunk failed max_attempt times.
+    """
+    window = max(1, min(window, BLD_SEQ_WINDOW_MAX))
+    quality = dl_uart_link_quality(uart_port)
+    metrics = measure_metrics(uart_port)
+    acked = bytearray(len(chunks))
+    # seq: [chunk index, packet, deadline (0 while waiting to be sent),
+    #       attempt]
+    pending = {}
+    base = 0  # oldest chunk not acknowledged yet
+    next_idx = 0
+    tx_bytes = 0
+
+    while base < len(chunks):
+        in_flight = any(entry[2] for entry in pending.values())
+        draining = link is not None and link.target() is not None
+        if draining and not in_flight:
+            link.switch()
+            for entry in pending.values():
+                entry[3] = 1
+            draining = False
+
+        if not draining:
+            # resends first, then fill the window, coalesced into one write
+            batch = [entry for entry in pending.values() if not entry[2]]
+            while next_idx < len(chunks) and next_idx < base + window:
+                seq = next_idx & 0xFF
+                write_addr, chunk = chunks[next_idx]
+                tx_buf = dl_bld_prep_write_packet(write_addr, chunk, seq,
+                                                  compress)
+                pending[seq] = [next_idx, tx_buf, 0.0, 1]
+                batch.append(pending[seq])
+                next_idx += 1
+            if batch:
+                tx_bytes += dl_uart_write_batch(uart_port,
+                                                [entry[1] for entry in batch])
+                deadline = time.monotonic() + timeout
+                for entry in batch:
+                    entry[2] = deadline
+
+        # wait for an ACK until the oldest packet expires
+        deadlines = [entry[2] for entry in pending.values() if entry[2]]
+        if not deadlines:
+            continue
+        frame = dl_uart_read_frame(uart_port,
+                                   max(min(deadlines) - time.monotonic(), 0.0))
+
+        failed = []
+        if frame is None:
+            now = time.monotonic()
+            for entry in pending.values():
+                if entry[2] and entry[2] <= now:
+                    quality.record_timeout()
+                    failed.append(entry)
+        elif len(frame) == 4 and frame[2] in pending:
+            if frame[1]:  # ACK, late ones of expired packets count too
+                quality.record_ok()
+                acked[pending.pop(frame[2])[0]] = 1
+                old_base = base
+                while base < len(chunks) and acked[base]:
+                    base += 1
+                if progress and base != old_base:
+                    progress("write", base, len(chunks))
+            elif pending[frame[2]][2]:  # NACK
+                quality.record_nack()
+                metrics.count("nacks")
+                failed.append(pending[frame[2]])
+
+        for entry in failed:
+            entry[2] = 0.0
+            write_addr = chunks[entry[0]][0]
+            if entry[3] == max_attempt:
+                if link is not None and link.target(urgent=True) is not None:
+                    continue  # another try at the next baudrate
+                print(f"Write @{write_addr} failed {max_attempt} times, abort")
+                return 0
+            entry[3] += 1
+            metrics.count("retries")
+            print(f"Write @{write_addr} failed, retry: {entry[3] - 1}")
+        if frame is None and failed:
+            time.sleep(quality.backoff())
+
+    return tx_bytes
 
 
 #
 # CMD 7: CHECK CRC
 #=====================================================================
 def dl_bld_check_img_crc(uart_port: serial.Serial, addr: int, size: int,
-                         data: bytearray):
+                         data: bytearray = None, crc: int = None):
     """
     Send check image crc to MCU. Including starting address and size of memory to be erased.
+    The CRC is computed from data unless it is given precomputed in crc.
 
     Notes: Data sent includes:
         1 length
@@ -377,7 +1257,7 @@ def dl_bld_check_img_crc(uart_port: serial.Serial, addr: int, size: int,
     """
     print(f"Check image crc: mem - {addr}, size - {size}, checking...")
 
-    crc_result = crc32_lookup_tb(data)
+    crc_result = crc32_lookup_tb(data) if crc is None else crc
 
     packet_data = []
     packet_data.extend((addr >> (24 - i * 8)) & 0xFF for i in range(4))
@@ -395,8 +1275,9 @@ def dl_bld_check_img_crc(uart_port: serial.Serial, addr: int, size: int,
     # Handle response
     resp = dl_uart_read_resp(uart_port)
     if not resp[0]:  # ACK return fail
-        print("Debug here")
-        exit()
+        measure_metrics(uart_port).count("crc_mismatches")
+        print("Check image crc: CRC mismatch")
+        return 0
 
     print(f"Check image crc: CRC correct")
     return resp[0]
@@ -405,12 +1286,26 @@ def dl_bld_check_img_crc(uart_port: serial.Serial, addr: int, size: int,
 #
 # CMD 9: EXIT BOOTLOADER
 #=====================================================================
-def dl_bld_exit(uart_port: serial.Serial):
+def dl_bld_exit(uart_port: serial.Serial, entry_addr: int = None):
+    """
+    Leave the bootloader and start the application.
+
+    Args:
+        uart_port (serial.Serial): The UART port object used for communication.
+        entry_addr (int): Optional entry point (e.g. ImageInfo.start_addr) to
+            jump to, by default the MCU boots from the application vector
+            table.
+    """
 
     print("Exit Bootloader: exiting...")
-    tx_buf = dl_bld_prep_packet(length=4,
+    packet_data = []
+    if entry_addr is not None:
+        packet_data.extend(
+            (entry_addr >> (24 - i * 8)) & 0xFF for i in range(4))
+
+    tx_buf = dl_bld_prep_packet(length=len(packet_data) + 4,
                                 cmd=Cmd.CMD_EXIT_BLD,
-                                data=[],
+                                data=packet_data,
                                 csum=1,
                                 req_ack=1)
 
@@ -419,7 +1314,7 @@ def dl_bld_exit(uart_port: serial.Serial):
     # Handle response
     resp = dl_uart_read_resp(uart_port)
     if not resp[0]:  # ACK return fail
-        print("Debug here")
-        exit()
+        print("Exit Bootloader: failed")
+        return 0
 
     return resp[0]
@@ -0,0 +1,228 @@
+import collections
+import hashlib
+import json
+import mmap
+import os
+import threading
+
+from dl_bld import *
+
+#
+# VARIABLES AND DEFINES
+#============================================================================
+
+# bump when the entry layout changes, older entries are then ignored
+IMG_CACHE_VERSION = 1
+IMG_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "mspm0_bld")
+# plans kept in the process
+IMG_CACHE_MEM_MAX = 8
+# bytes of image data kept on disk, least recently used entries go first
+IMG_CACHE_DISK_MAX = 256 * 1024 * 1024
+IMG_CACHE_HASH_BLOCK = 1024 * 1024
+
+
+class ImageCache:
+    """
+    Parsed images with their upload plan (span and sector CRCs), so an
+    image flashed on many boards is parsed and hashed once per build.
+
+    Entries are looked up by path, mtime and size first; on disk they are
+    stored under the SHA-256 of the file content, a copy of the file under
+    another name reuses them. The disk entry holds the image data, mapped
+    back without copying, and the CRCs of the plan.
+
+    Layout of cache_dir:
+        <sha256>-<addr>.json  segments, entry point and CRCs
+        <sha256>-<addr>.bin   segment data, back to back
+        <path hash>.idx       path, mtime and size -> content entry
+    """
+
+    def __init__(self,
+                 cache_dir: str = IMG_CACHE_DIR,
+                 mem_max: int = IMG_CACHE_MEM_MAX,
+                 disk_max: int = IMG_CACHE_DISK_MAX):
+        """
+        Args:
+            cache_dir (str): Directory of the disk entries, None keeps the
+                cache in memory only.
+            mem_max (int): Plans kept in the process.
+            disk_max (int): Image bytes kept on disk.
+        """
+        self.cache_dir = cache_dir
+        self.mem_max = mem_max
+        self.disk_max = disk_max
+        self._mem = collections.OrderedDict()  # (path, mtime, size, addr)
+        self._lock = threading.Lock()
+
+    def load(self, fpath: str, start_addr: int = None) -> BldImagePlan:
+        """
+        Plan of the image in fpath, parsed only if no cache entry matches.
+
+        Args:
+            fpath (str): Image file, see dl_file_load_image().
+            start_addr (int): Load address of a .bin file.
+
+        Returns:
+            BldImagePlan: The plan, None if the file cannot be read.
+        """
+        metrics = measure_metrics()
+        try:
+            fpath = os.path.abspath(fpath)
+            stat = os.stat(fpath)
+        except OSError:
+            print(f"File not found: {fpath}")
+            return None
+        key = (fpath, stat.st_mtime_ns, stat.st_size, start_addr)
+
+        with self._lock:
+            plan = self._mem.get(key)
+            if plan is not None:
+                self._mem.move_to_end(key)
+                metrics.count("cache_hits")
+                return plan
+
+        plan = self._disk_load(key)
+        if plan is None:
+            metrics.count("cache_misses")
+            image = dl_file_load_image(fpath, start_addr)
+            if not image or not image.segments:
+                return None
+            plan = BldImagePlan(image)
+            self._disk_store(key, plan)
+        else:
+            metrics.count("cache_hits")
+            print(f"Image cache: {os.path.basename(fpath)} "
+                  f"{plan.image_info.size} bytes, not parsed again")
+
+        with self._lock:
+            self._mem[key] = plan
+            while len(self._mem) > self.mem_max:
+                self._mem.popitem(last=False)
+        return plan
+
+    def clear(self) -> None:
+        """Drop the plans in memory, the disk entries stay."""
+        with self._lock:
+            self._mem.clear()
+
+    #
+    # Disk entries
+    #========================================================================
+
+    def _index_path(self, key: tuple) -> str:
+        name = hashlib.sha256(key[0].encode()).hexdigest()[:32]
+        return os.path.join(self.cache_dir, name + ".idx")
+
+    def _entry_name(self, key: tuple) -> str:
+        # the index remembers the content hash of an unchanged file
+        idx_path = self._index_path(key)
+        try:
+            with open(idx_path) as f:
+                index = json.load(f)
+            if [index["mtime_ns"], index["size"]] == [key[1], key[2]]:
+                return f"{index['sha256']}-{key[3] or 0:08x}"
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+        sha = hashlib.sha256()
+        with open(key[0], "rb") as f:
+            for block in iter(lambda: f.read(IMG_CACHE_HASH_BLOCK), b""):
+                sha.update(block)
+        _dl_cache_write(idx_path, json.dumps({
+            "path": key[0],
+            "mtime_ns": key[1],
+            "size": key[2],
+            "sha256": sha.hexdigest(),
+        }).encode())
+        return f"{sha.hexdigest()}-{key[3] or 0:08x}"
+
+    def _disk_load(self, key: tuple) -> BldImagePlan:
+        if self.cache_dir is None:
+            return None
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            entry = os.path.join(self.cache_dir, self._entry_name(key))
+            with open(entry + ".json") as f:
+                meta = json.load(f)
+            if meta["version"] != IMG_CACHE_VERSION:
+                return None
+            image = ImageInfo()
+            image.start_addr = meta["start_addr"]
+            with open(entry + ".bin", "rb") as f:
+                data = memoryview(mmap.mmap(f.fileno(), 0,
+                                            access=mmap.ACCESS_READ))
+            if sum(size for _, size in meta["segments"]) != len(data):
+                return None
+            ofs = 0
+            for addr, size in meta["segments"]:
+                image.add(addr, data[ofs:ofs + size], copy=False)
+                ofs += size
+            # CRCs not matching the image raise ValueError
+            plan = BldImagePlan(image, meta["span_crcs"], meta["sector_crcs"])
+            os.utime(entry + ".json")  # most recently used
+            return plan
+        except (OSError, ValueError, KeyError, TypeError):
+            # missing, partial or corrupt entry, parse again
+            return None
+
+    def _disk_store(self, key: tuple, plan: BldImagePlan) -> None:
+        if self.cache_dir is None:
+            return
+        image = plan.image_info
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            entry = os.path.join(self.cache_dir, self._entry_name(key))
+            # data first, the json marks the entry complete
+            _dl_cache_write(entry + ".bin",
+                            b"".join(view for _, view in image.views()))
+            _dl_cache_write(entry + ".json", json.dumps({
+                "version": IMG_CACHE_VERSION,
+                "source": key[0],
+                "start_addr": image.start_addr,
+                "segments": [[seg.addr, len(seg.data)]
+                             for seg in image.segments],
+                "span_crcs": plan.span_crcs,
+                "sector_crcs": [crc for _, crc in plan.sectors],
+            }).encode())
+            self._disk_evict()
+        except OSError as e:
+            print(f"Image cache: not stored, {e}")
+
+    def _disk_evict(self) -> None:
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".json"):
+                entry = os.path.join(self.cache_dir, name[:-5])
+                try:
+                    entries.append((os.stat(entry + ".json").st_mtime,
+                                    os.stat(entry + ".bin").st_size, entry))
+                except OSError:
+                    continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.disk_max:
+                break
+            for ext in (".json", ".bin"):
+                try:
+                    os.remove(entry + ext)
+                except OSError:
+                    pass
+            total -= size
+
+
+@staticmethod
+def _dl_cache_write(fpath: str, data: bytes) -> None:
+    # other processes see the old file or the whole new one
+    tmp_path = f"{fpath}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, fpath)
+
+
+# process wide cache used by dl_cache_load_plan()
+_image_cache = ImageCache()
+
+
+def dl_cache_load_plan(fpath: str, start_addr: int = None) -> BldImagePlan:
+    """Load an image through the process wide ImageCache."""
+    return _image_cache.load(fpath, start_addr)
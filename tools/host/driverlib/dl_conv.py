@@ -0,0 +1,299 @@
+import bisect
+import os
+
+from dl_hexf import *
+from dl_hexf import _IHEX_REC_DATA_LEN
+
+#
+# VARIABLES AND DEFINES
+#============================================================================
+
+# gaps between hex records are filled with the erased flash value
+CONV_FILL = 0xFF
+# data bytes per emitted hex record, 255 at most
+CONV_REC_LEN = 16
+# bytes read or filled at once, the memory used does not depend on the image
+CONV_BLOCK_SIZE = 64 * 1024
+
+
+class ConvInfo:
+    """
+    Result of a conversion.
+    """
+
+    def __init__(self, input_fpath: str, output_fpath: str):
+        self.input = input_fpath
+        self.output = output_fpath
+        self.s_addr = None  # address of the first output byte
+        self.size = 0  # bytes of the image, gaps included
+        self.records = 0  # data records read or written
+        self.start_addr = None  # entry point
+
+    def result(self) -> dict:
+        return {
+            "input": self.input,
+            "output": self.output,
+            "s_addr": self.s_addr,
+            "size": self.size,
+            "records": self.records,
+            "start_addr": self.start_addr,
+        }
+
+
+class _ConvRanges:
+    """
+    Address ranges written so far, merged while they touch. Their number
+    grows with the gaps of the image, not with its size.
+    """
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def add(self, start: int, end: int) -> bool:
+        """
+        Returns:
+            bool: False if [start, end) overlaps a range written before.
+        """
+        idx = bisect.bisect_right(self.starts, start)
+        if idx and self.ends[idx - 1] > start:
+            return False
+        if idx < len(self.starts) and self.starts[idx] < end:
+            return False
+        if idx and self.ends[idx - 1] == start:
+            idx -= 1
+            self.ends[idx] = end
+        else:
+            self.starts.insert(idx, start)
+            self.ends.insert(idx, end)
+        if idx + 1 < len(self.starts) and self.starts[idx + 1] == end:
+            self.ends[idx] = self.ends.pop(idx + 1)
+            self.starts.pop(idx + 1)
+        return True
+
+
+#
+# Command functions
+#============================================================================
+
+
+def dl_conv_hexf_to_binf(hex_fpath: str,
+                         bin_fpath: str,
+                         fill: int = CONV_FILL,
+                         s_addr: int = None,
+                         e_addr: int = None) -> ConvInfo:
+    """
+    Convert a hex file to a bin file record by record.
+
+    Every record is written to the bin file as soon as it is verified, the
+    image is never held in memory. Gaps between records are filled with
+    `fill`; records out of address order are written by seeking back into
+    the bin file.
+
+    Args:
+        hex_fpath (str): Hex file to read.
+        bin_fpath (str): Bin file to write, replaced if it exists.
+        fill (int): Value of the bytes between records.
+        s_addr (int): Address of the first bin byte, the first data record
+            if None. Data below it is left out.
+        e_addr (int): Data from this address on is left out.
+
+    Returns:
+        ConvInfo: The converted range, None if the hex file is invalid or a
+            file cannot be opened. No bin file is left behind then.
+
+    Notes:
+        Without s_addr the records must not go below the first one, as it
+        is the start of the bin file.
+    """
+    info = ConvInfo(hex_fpath, bin_fpath)
+
+    print(f"Converting {hex_fpath} to {bin_fpath}...")
+    try:
+        with open(hex_fpath, "r") as fin:
+            with open(bin_fpath, "w+b") as fout, \
+                    measure_metrics().span("convert"):
+                ok = dl_conv_hexf_stream(fin, fout, info, fill, s_addr,
+                                         e_addr)
+            if not ok:
+                os.remove(bin_fpath)
+                return None
+
+    except FileNotFoundError:
+        print(f"File not found: {hex_fpath}")
+        return None
+    except IOError as e:
+        print(f"An error occurred while converting the file: {e}")
+        return None
+
+    print(f"Wrote {info.size} bytes from 0x{info.s_addr:08X} to "
+          f"0x{info.s_addr + info.size - 1:08X} into {bin_fpath}")
+    return info
+
+
+@staticmethod
+def dl_conv_hexf_stream(fin, fout, info: ConvInfo, fill: int = CONV_FILL,
+                        s_addr: int = None, e_addr: int = None) -> bool:
+    """
+    Write the records of an opened hex file to an opened bin file, see
+    dl_conv_hexf_to_binf().
+
+    Returns:
+        bool: False if a record is invalid, overlaps another or lies below
+            the start of the bin file.
+    """
+    fill_block = bytes([fill]) * CONV_BLOCK_SIZE
+    addr_idx = IHexAddrIndex()
+    ranges = _ConvRanges()
+    base = s_addr
+    end = 0  # bin file size
+
+    for line_no, line in enumerate(fin, start=1):
+        line = line.strip()
+        if not line:
+            continue
+
+        hex_rec = dl_hexf_record_parse(line)
+        if hex_rec is None:
+            print(f"Hex file is invalid at line {line_no}: {line}")
+            return False
+        rec_type, offset, data = hex_rec
+
+        if rec_type != IHexRecType.DATA:
+            if len(data) != _IHEX_REC_DATA_LEN.get(rec_type, -1):
+                print(f"Unsupported record at line {line_no}: {line}")
+                return False
+            if rec_type == IHexRecType.START_SEG_ADDR:
+                info.start_addr = (int.from_bytes(data[:2], "big") << 4) + \
+                    int.from_bytes(data[2:], "big")
+            elif rec_type == IHexRecType.START_LINEAR_ADDR:
+                info.start_addr = int.from_bytes(data, "big")
+            elif rec_type == IHexRecType.EOF:
+                break
+            else:
+                addr_idx.update(rec_type, data)
+            continue
+
+        info.records += 1
+        for addr, piece in addr_idx.resolve(offset, data):
+            # clip to [s_addr, e_addr)
+            if e_addr is not None:
+                piece = piece[:max(e_addr - addr, 0)]
+            if s_addr is not None and addr < s_addr:
+                piece = piece[s_addr - addr:]
+                addr = s_addr
+            if not piece:
+                continue
+            if base is None:
+                base = addr
+            elif addr < base:
+                print(f"Hex record below 0x{base:08X} at line {line_no}, "
+                      f"give the start address")
+                return False
+
+            ofs = addr - base
+            if not ranges.add(ofs, ofs + len(piece)):
+                print(f"Hex file is invalid at line {line_no}: {line}")
+                return False
+            if ofs > end:
+                # the file position is at the end, fill the gap up to ofs
+                for gap in range(end, ofs, CONV_BLOCK_SIZE):
+                    fout.write(fill_block[:min(CONV_BLOCK_SIZE, ofs - gap)])
+            elif ofs < end:
+                fout.seek(ofs)
+            fout.write(piece)
+            if ofs + len(piece) < end:
+                fout.seek(end)
+            end = max(end, ofs + len(piece))
+
+    if not ranges.starts:
+        print("Hex file contains no data record")
+        return False
+    info.s_addr = base
+    info.size = end
+    return True
+
+
+def dl_conv_binf_to_hexf(bin_fpath: str,
+                         hex_fpath: str,
+                         addr: int,
+                         rec_len: int = CONV_REC_LEN,
+                         start_addr: int = None) -> ConvInfo:
+    """
+    Convert a bin file to a hex file, reading it block by block.
+
+    Args:
+        bin_fpath (str): Bin file to read.
+        hex_fpath (str): Hex file to write, replaced if it exists.
+        addr (int): Load address of the first bin byte.
+        rec_len (int): Data bytes per record, 1 to 255.
+        start_addr (int): Entry point emitted as start linear address (05)
+            record, none if None.
+
+    Returns:
+        ConvInfo: The converted range, None if the bin file cannot be read
+            or does not fit in the 32-bit address space.
+
+    Notes:
+        Records do not cross a 64 KB boundary, an extended linear address
+        (04) record is emitted at every boundary.
+    """
+    if not 0 < rec_len <= 0xFF:
+        print(f"Invalid record length: {rec_len}")
+        return None
+    info = ConvInfo(bin_fpath, hex_fpath)
+    info.s_addr = addr
+    info.start_addr = start_addr
+    upper = None
+    pending = b""
+
+    print(f"Converting {bin_fpath} to {hex_fpath}...")
+    try:
+        if addr + os.path.getsize(bin_fpath) > 0x100000000:
+            print(f"Bin file exceeds the 32-bit address space at "
+                  f"0x{addr:08X}")
+            return None
+        with open(bin_fpath, "rb") as fin, open(hex_fpath, "w") as fout, \
+                measure_metrics().span("convert"):
+            while True:
+                block = fin.read(CONV_BLOCK_SIZE)
+                view = memoryview(pending + block)
+                ofs = 0
+                while ofs < len(view):
+                    rec_size = min(rec_len, 0x10000 - (addr & 0xFFFF))
+                    # a short record only at the end of the file
+                    if block and len(view) - ofs < rec_size:
+                        break
+                    rec_size = min(rec_size, len(view) - ofs)
+                    if addr >> 16 != upper:
+                        upper = addr >> 16
+                        fout.write(dl_hexf_record_build(
+                            IHexRecType.EXT_LINEAR_ADDR, 0,
+                            upper.to_bytes(2, "big")))
+                    fout.write(dl_hexf_record_build(
+                        IHexRecType.DATA, addr & 0xFFFF,
+                        view[ofs:ofs + rec_size]))
+                    info.records += 1
+                    addr += rec_size
+                    ofs += rec_size
+                pending = bytes(view[ofs:])
+                info.size += ofs
+                if not block:
+                    break
+
+            if start_addr is not None:
+                fout.write(dl_hexf_record_build(
+                    IHexRecType.START_LINEAR_ADDR, 0,
+                    start_addr.to_bytes(4, "big")))
+            fout.write(dl_hexf_record_build(IHexRecType.EOF, 0, b""))
+
+    except FileNotFoundError:
+        print(f"File not found: {bin_fpath}")
+        return None
+    except IOError as e:
+        print(f"An error occurred while converting the file: {e}")
+        return None
+
+    print(f"Wrote {info.size} bytes from 0x{info.s_addr:08X} in "
+          f"{info.records} records into {hex_fpath}")
+    return info
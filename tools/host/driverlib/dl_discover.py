@@ -0,0 +1,193 @@
+import concurrent.futures
+
+import serial.tools.list_ports
+
+from dl_bld import *
+
+#
+# VARIABLES AND DEFINES
+#============================================================================
+
+# Rates tried by default, the bootloader starts at 115200 so it goes first
+DISCOVER_BAUDRATES = [115200] + [
+    baud for baud in reversed(BUADRATE_LIST)
+    if baud >= BLD_LINK_BAUD_MIN and baud != 115200
+]
+# Answer deadline of one probe on top of its time on the wire. It also
+# covers BLD_RX_IDLE_MS, after which the device dropped the garbage a probe
+# at a wrong rate left, so the next probe needs no extra wait.
+DISCOVER_TIMEOUT = 0.03
+# CMD_GET_BLD_VER frame and its response
+DISCOVER_PROBE_BYTES = 4 + 6
+
+
+class BldPortInfo:
+    """
+    Result of probing one serial port for a bootloader.
+    """
+
+    def __init__(self, port: str, description: str = ""):
+        self.port = port
+        self.description = description
+        self.baudrate = None  # rate the bootloader answered at
+        self.baud_max = None  # fastest rate it switched to, if probed
+        self.version = None
+        self.error = ""
+
+    @property
+    def found(self) -> bool:
+        return self.baudrate is not None
+
+    def result(self) -> dict:
+        return {
+            "port": self.port,
+            "description": self.description,
+            "baudrate": self.baudrate,
+            "baud_max": self.baud_max,
+            "version": self.version,
+            "error": self.error,
+        }
+
+
+#
+# Probing
+#============================================================================
+
+
+@staticmethod
+def dl_discover_probe(uart_port: serial.Serial,
+                      baudrates: list = DISCOVER_BAUDRATES,
+                      timeout: float = DISCOVER_TIMEOUT) -> tuple:
+    """
+    Send CMD_GET_BLD_VER at every rate until the bootloader answers.
+
+    Args:
+        uart_port (serial.Serial): Open port, left at the rate that answered.
+        baudrates (list): Rates in the order they are tried.
+        timeout (float): Answer deadline of one probe, without wire time.
+
+    Returns:
+        tuple: (baudrate, version bytes), None if nothing answered.
+    """
+    tx_buf = dl_bld_prep_packet(length=4,
+                                cmd=Cmd.CMD_GET_BLD_VER,
+                                data=[],
+                                csum=1,
+                                req_ack=1)
+    parser = dl_uart_frame_parser(uart_port)
+
+    for baudrate in baudrates:
+        uart_port.baudrate = baudrate
+        # answers to earlier probes arrive as garbage at this rate
+        uart_port.reset_input_buffer()
+        parser.reset()
+
+        dl_uart_write(uart_port, tx_buf)
+        wire_time = DISCOVER_PROBE_BYTES * UART_BITS_PER_BYTE / baudrate
+        resp = dl_uart_read_frame(uart_port, timeout + wire_time)
+        if resp is not None and len(resp) > 2:
+            return baudrate, bytes(resp[1:-1])
+    return None
+
+
+@staticmethod
+def dl_discover_baud_max(uart_port: serial.Serial, baud_max: int) -> int:
+    """
+    Find the fastest rate up to baud_max the bootloader switches to with
+    CMD_SET_BAUD, the link is moved back to its current rate afterwards.
+
+    Returns:
+        int: The fastest rate, the current one if the device cannot switch.
+    """
+    baudrate = uart_port.baudrate
+    caps = dl_bld_get_caps(uart_port)
+    if caps is None or not caps.set_baud:
+        return baudrate
+
+    for candidate in sorted(BUADRATE_LIST, reverse=True):
+        if candidate <= baudrate:
+            break
+        if candidate > baud_max:
+            continue
+        if dl_bld_set_baud(uart_port, candidate):
+            dl_bld_set_baud(uart_port, baudrate)
+            return candidate
+    return baudrate
+
+
+@staticmethod
+def dl_discover_port(port: str,
+                     description: str = "",
+                     baudrates: list = DISCOVER_BAUDRATES,
+                     timeout: float = DISCOVER_TIMEOUT,
+                     baud_max: int = None) -> BldPortInfo:
+    """Open port and probe it, see dl_discover_probe()."""
+    info = BldPortInfo(port, description)
+    try:
+        uart_port = serial.Serial(port=port,
+                                  baudrate=baudrates[0],
+                                  timeout=timeout)
+    except (serial.SerialException, OSError) as e:
+        info.error = f"Failed to open port: {e}"
+        return info
+
+    try:
+        answer = dl_discover_probe(uart_port, baudrates, timeout)
+        if answer is None:
+            info.error = "No bootloader answered"
+            return info
+        info.baudrate = answer[0]
+        info.version = answer[1].decode("ascii", errors="replace")
+        if baud_max is not None and baud_max > info.baudrate:
+            info.baud_max = dl_discover_baud_max(uart_port, baud_max)
+    except (serial.SerialException, OSError) as e:
+        info.error = f"Serial error: {e}"
+    finally:
+        uart_port.close()
+    return info
+
+
+#
+# Orchestrator
+#============================================================================
+def dl_discover_ports(ports: list = None,
+                      baudrates: list = DISCOVER_BAUDRATES,
+                      timeout: float = DISCOVER_TIMEOUT,
+                      baud_max: int = None) -> list:
+    """
+    Look for bootloaders on several ports at once, one thread per port.
+
+    A port without a device costs len(baudrates) probe timeouts, all ports
+    are probed in parallel so the scan takes about as long as one of them.
+
+    Args:
+        ports (list): Serial port names, None for every port of
+            serial.tools.list_ports.comports().
+        baudrates (list): Rates in the order they are tried.
+        timeout (float): Answer deadline of one probe.
+        baud_max (int): Also find the fastest rate up to baud_max every
+            bootloader switches to.
+
+    Returns:
+        list: The BldPortInfo of the ports that answered, in port order.
+    """
+    if ports is None:
+        ports = [(p.device, p.description)
+                 for p in serial.tools.list_ports.comports()]
+    else:
+        ports = [(port, "") for port in ports]
+    if not ports:
+        return []
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(ports)) as pool:
+        futures = [
+            pool.submit(dl_discover_port, port, description, baudrates,
+                        timeout, baud_max) for port, description in ports
+        ]
+
+    infos = []
+    for future in futures:
+        if future.exception() is None and future.result().found:
+            infos.append(future.result())
+    return infos
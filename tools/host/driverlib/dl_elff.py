@@ -0,0 +1,141 @@
+import mmap
+import struct
+
+from dl_file import *
+from utils.measure import measure_metrics
+
+#
+# DEFINES AND VARIABLES
+#============================================================================
+
+ELF_MAGIC = b"\x7fELF"
+ELF_CLASS_32 = 1
+ELF_DATA_LSB = 1
+ELF_DATA_MSB = 2
+
+ELF_PT_LOAD = 1
+ELF_SHT_NOBITS = 8
+ELF_SHF_ALLOC = 0x2
+
+# e_ident is read apart, the rest of the ELF32 header:
+# e_type, e_machine, e_version, e_entry, e_phoff, e_shoff, e_flags, e_ehsize,
+# e_phentsize, e_phnum, e_shentsize, e_shnum, e_shstrndx
+_ELF32_EHDR = "HHIIIIIHHHHHH"
+_ELF32_EHDR_OFS = 16
+# p_type, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_flags, p_align
+_ELF32_PHDR = "IIIIIIII"
+# sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size, sh_link, sh_info,
+# sh_addralign, sh_entsize
+_ELF32_SHDR = "IIIIIIIIII"
+
+#
+# Command functions
+#============================================================================
+
+
+def dl_elff_readf(file_path: str) -> ImageInfo:
+    """
+    Read the loadable segments of an ELF32 file, e.g. the .out/.elf of a
+    build, without converting it to hex first.
+
+    The file is memory-mapped and every segment of the image is a read-only
+    view into the mapping, the data is not copied. Segments are placed at
+    their physical (load) address, so initialised data goes to its flash
+    copy rather than to RAM.
+    """
+    print("Verify file path: opening file...")
+    try:
+        with open(file_path, "rb") as f, \
+                measure_metrics().span("parse_elf"):
+            print("Verify file path: file opened successfully")
+            # the mapping outlives the file, the segment views keep it open
+            buf = memoryview(mmap.mmap(f.fileno(), 0,
+                                       access=mmap.ACCESS_READ))
+            return dl_elff_shadow_read(buf, file_path)
+
+    except FileNotFoundError:
+        print(f"File not found: {file_path}")
+        return None
+    except (IOError, ValueError):
+        # an empty file cannot be mapped
+        print(f"An error occurred while reading the file: {file_path}")
+        return None
+
+
+@staticmethod
+def dl_elff_shadow_read(buf: memoryview, file_path: str = "") -> ImageInfo:
+    """
+    Build the image from an ELF32 file held in buf.
+
+    Returns:
+        ImageInfo: The image, None if the file is not a valid ELF32 file.
+    """
+    if len(buf) < _ELF32_EHDR_OFS + struct.calcsize(_ELF32_EHDR) or \
+            bytes(buf[:4]) != ELF_MAGIC:
+        print(f"Not an ELF file: {file_path}")
+        return None
+    if buf[4] != ELF_CLASS_32 or buf[5] not in (ELF_DATA_LSB, ELF_DATA_MSB):
+        print(f"Only 32-bit ELF files are supported: {file_path}")
+        return None
+    endian = "<" if buf[5] == ELF_DATA_LSB else ">"
+
+    (_, _, _, e_entry, e_phoff, e_shoff, _, _, e_phentsize, e_phnum,
+     e_shentsize, e_shnum, _) = struct.unpack_from(endian + _ELF32_EHDR, buf,
+                                                   _ELF32_EHDR_OFS)
+    phdrs = _dl_elff_table(buf, endian + _ELF32_PHDR, e_phoff, e_phentsize,
+                           e_phnum)
+    shdrs = _dl_elff_table(buf, endian + _ELF32_SHDR, e_shoff, e_shentsize,
+                           e_shnum)
+    if phdrs is None or shdrs is None:
+        print(f"ELF file is truncated: {file_path}")
+        return None
+
+    # GNU ld maps the ELF and program headers into the first PT_LOAD, only
+    # the parts holding allocated sections are image data (as in objcopy)
+    sections = sorted((sh[4], sh[4] + sh[5]) for sh in shdrs
+                      if sh[2] & ELF_SHF_ALLOC and sh[1] != ELF_SHT_NOBITS
+                      and sh[5] > 0)
+
+    image = ImageInfo()
+    for p_type, p_offset, _, p_paddr, p_filesz, _, _, _ in phdrs:
+        # the memsz - filesz tail is .bss, zeroed at startup
+        if p_type != ELF_PT_LOAD or p_filesz == 0:
+            continue
+        if p_offset + p_filesz > len(buf):
+            print(f"ELF file is truncated: {file_path}")
+            return None
+        # stripped files have no section headers, load the whole segment
+        ranges = [(p_offset, p_offset + p_filesz)]
+        if sections:
+            ranges = [(max(s_ofs, p_offset), min(e_ofs, p_offset + p_filesz))
+                      for s_ofs, e_ofs in sections
+                      if s_ofs < p_offset + p_filesz and e_ofs > p_offset]
+        for s_ofs, e_ofs in ranges:
+            if not image.add(p_paddr + s_ofs - p_offset, buf[s_ofs:e_ofs],
+                             copy=False):
+                print(f"ELF file has overlapping segments: {file_path}")
+                return None
+
+    if not image.segments:
+        print("ELF file contains no loadable data")
+        return None
+    image.start_addr = e_entry or None
+
+    print(f"Reading elf file: {image.size} bytes in "
+          f"{len(image.segments)} segment(s), {len(image.gaps())} gap(s)")
+    if image.start_addr is not None:
+        print(f"Reading elf file: entry point at 0x{image.start_addr:08X}")
+    return image
+
+
+def _dl_elff_table(buf: memoryview, fmt: str, offset: int, entsize: int,
+                   num: int) -> list:
+    # program and section header tables, None if they exceed the file
+    if num == 0:
+        return []
+    if entsize < struct.calcsize(fmt) or offset + entsize * num > len(buf):
+        return None
+    return [
+        struct.unpack_from(fmt, buf, offset + idx * entsize)
+        for idx in range(num)
+    ]
@@ -1,3 +1,4 @@
+import bisect
 import os
 
 from utils.measure import measure_exe_time
@@ -59,20 +60,211 @@ class FileInfo:
         print(f"\nSelect \"{cls.origin_dir}/{cls.files[idx]}\"\n")
 
 
+class ImageSegment:
+    """
+    A contiguous run of image data starting at an absolute address.
+
+    The data is an own bytearray, or with copy=False a view of a buffer
+    owned by someone else (e.g. a memory-mapped file) that is never
+    modified nor extended.
+    """
+
+    def __init__(self, addr: int, data=b"", copy: bool = True):
+        self.addr = addr
+        self.data = bytearray(data) if copy else memoryview(data)
+
+    @property
+    def owned(self) -> bool:
+        """True if data is a private bytearray that may grow."""
+        return isinstance(self.data, bytearray)
+
+    @property
+    def e_addr(self) -> int:
+        """Last address covered by the segment."""
+        return self.addr + len(self.data) - 1
+
+    def view(self) -> memoryview:
+        """Zero-copy view of the segment data."""
+        return memoryview(self.data)
+
+
 class ImageInfo:
+    """
+    Sparse flash image made of non-overlapping segments sorted by address.
+
+    Only the bytes present in the source file are stored, so memory use
+    follows the payload size rather than the address span.
+    """
+
+    def __init__(self):
+        self.segments = []
+        self.start_addr = None  # entry point, if given by the source file
+
+    @property
+    def s_addr(self) -> int:
+        return self.segments[0].addr if self.segments else 0xFFFFFFFF
+
+    @property
+    def e_addr(self) -> int:
+        return self.segments[-1].e_addr if self.segments else 0x00000000
+
+    @property
+    def size(self) -> int:
+        """Number of payload bytes stored in the image."""
+        return sum(len(seg.data) for seg in self.segments)
+
+    def add(self, addr: int, data, copy: bool = True) -> bool:
+        """
+        Store data at addr, merging it with adjacent segments.
+
+        Args:
+            addr (int): Address of the first byte.
+            data (bytes-like): The bytes, copied into the image.
+            copy (bool): False keeps a view of data as its own segment
+                instead, data must stay valid and unchanged as long as the
+                image is used.
+
+        Returns:
+            bool: False if data overlaps bytes already in the image.
+        """
+        if not data:
+            return True
+        segs = self.segments
+
+        # fast path, records usually come in ascending order
+        if copy and segs and segs[-1].owned and segs[-1].e_addr + 1 == addr:
+            segs[-1].data += data
+            return True
+
+        idx = bisect.bisect_right([seg.addr for seg in segs], addr)
+        prev = segs[idx - 1] if idx > 0 else None
+        nxt = segs[idx] if idx < len(segs) else None
+        if (prev and prev.e_addr >= addr) or (nxt and
+                                              addr + len(data) > nxt.addr):
+            print(f"Overlapping data at 0x{addr:08X}")
+            return False
+
+        if copy and prev and prev.owned and prev.e_addr + 1 == addr:
+            prev.data += data
+        else:
+            prev = ImageSegment(addr, data, copy)
+            segs.insert(idx, prev)
+            idx += 1
+
+        # the new data may close the gap to the next segment, views are
+        # left apart, spans() still joins them
+        if nxt and prev.owned and nxt.owned and prev.e_addr + 1 == nxt.addr:
+            prev.data += nxt.data
+            segs.pop(idx)
+        return True
+
+    def gaps(self) -> list:
+        """
+        Returns:
+            list: (start, end) address of every hole between segments.
+        """
+        return [(prev.e_addr + 1, nxt.addr - 1)
+                for prev, nxt in zip(self.segments, self.segments[1:])
+                if prev.e_addr + 1 < nxt.addr]
+
+    def views(self):
+        """Yield (addr, memoryview) for every segment without copying."""
+        for seg in self.segments:
+            yield seg.addr, seg.view()
+
+    def spans(self, align: int = 1) -> list:
+        """
+        Address ranges to program, each segment widened to `align` bytes.
+
+        Segments whose widened ranges touch are returned as one span.
+
+        Returns:
+            list: (addr, size) tuples.
+        """
+        spans = []
+        for seg in self.segments:
+            s_addr = seg.addr - seg.addr % align
+            e_addr = -(-(seg.e_addr + 1) // align) * align
+            if spans and s_addr <= spans[-1][1]:
+                spans[-1][1] = max(spans[-1][1], e_addr)
+            else:
+                spans.append([s_addr, e_addr])
+        return [(s_addr, e_addr - s_addr) for s_addr, e_addr in spans]
+
+    def clip(self, addr: int, size: int) -> "ImageInfo":
+        """
+        Returns:
+            ImageInfo: A copy of the data between addr and addr + size.
+        """
+        image = ImageInfo()
+        for seg in self.segments:
+            if seg.e_addr < addr:
+                continue
+            if seg.addr >= addr + size:
+                break
+            s_addr = max(seg.addr, addr)
+            e_addr = min(seg.e_addr + 1, addr + size)
+            image.add(s_addr,
+                      seg.view()[s_addr - seg.addr:e_addr - seg.addr])
+        return image
+
+    def read(self, addr: int, size: int, fill: int = 0xFF):
+        """
+        Read size bytes from addr, bytes outside any segment read as fill.
+
+        Returns:
+            memoryview | bytearray: A zero-copy view when the range lies
+                inside a single segment, else a filled copy.
+        """
+        buf = None
+        for seg in self.segments:
+            if seg.e_addr < addr:
+                continue
+            if seg.addr >= addr + size:
+                break
+            ofs = addr - seg.addr
+            if buf is None and ofs >= 0 and seg.e_addr >= addr + size - 1:
+                return seg.view()[ofs:ofs + size]
+            if buf is None:
+                buf = bytearray([fill]) * size
+            s_addr = max(seg.addr, addr)
+            e_addr = min(seg.e_addr + 1, addr + size)
+            buf[s_addr - addr:e_addr - addr] = \
+                seg.view()[s_addr - seg.addr:e_addr - seg.addr]
+
+        return buf if buf is not None else bytearray([fill]) * size
+
+
+#
+# Loading function
+#============================================================================
+def dl_file_load_image(fpath: str, start_addr: int = None) -> ImageInfo:
+    """
+    Read an image file, the format is picked from its extension.
+
+    Args:
+        fpath (str): Path of a .hex, .bin or .elf (.out, .axf) file.
+        start_addr (int): Load address of a .bin file, hex files carry
+            their own addresses.
+
+    Returns:
+        ImageInfo: The image, None if the file is not supported or invalid.
+    """
+    if fpath.endswith(".hex"):
+        from dl_hexf import dl_hexf_readf
+        return dl_hexf_readf(fpath)
+    if fpath.endswith(".bin"):
+        if start_addr is None:
+            print(f"Load address required for bin file: {fpath}")
+            return None
+        from dl_binf import dl_bin_readf
+        return dl_bin_readf(fpath, start_addr)
+    if fpath.endswith((".elf", ".out", ".axf")):
+        from dl_elff import dl_elff_readf
+        return dl_elff_readf(fpath)
 
-    def __init__(self,
-                 flash_size=0x2000,
-                 main_addr=0x0000,
-                 cur_addr=0x0000,
-                 s_addr=0xFFFFFFFF,
-                 e_addr=0x00000000):
-        self.flash_size = flash_size
-        self.main_addr = main_addr
-        self.cur_addr = cur_addr
-        self.s_addr = s_addr
-        self.e_addr = e_addr
-        self.mem_buffer = [0xFF] * flash_size
+    print(f"Unsupported file type: {fpath}")
+    return None
 
 
 #
@@ -80,22 +272,11 @@ class ImageInfo:
 #============================================================================
 @measure_exe_time
 def dl_hexf_to_binf(fpath: str, ouputf_name: str = "app.bin") -> bool:
-    from dl_hexf import dl_hexf_readf
-    # Read hex file
-    image = dl_hexf_readf(fpath)
-    mem_buffer = image.mem_buffer
-    image_size = image.e_addr - image.s_addr + 1
-
-    # Write bin file
-    save_fpath = os.path.abspath(f"../../Release/{ouputf_name}")
-    try:
-        with open(save_fpath, "wb") as f:
-            f.write(bytearray(mem_buffer[:image_size]))
-
-        print(
-            f"Wrote {len(mem_buffer[:image_size])} bytes from 0x{image.s_addr:X} to 0x{image.e_addr :X} into {ouputf_name}"
-        )
-    except all:
-        return False
-
-    return True
+    """
+    Convert a hex file to ouputf_name in FileInfo.origin_dir, gaps between
+    segments are filled with 0xFF. See dl_conv for other options.
+    """
+    from dl_conv import dl_conv_hexf_to_binf
+    save_fpath = os.path.abspath(os.path.join(FileInfo.origin_dir,
+                                              ouputf_name))
+    return dl_conv_hexf_to_binf(fpath, save_fpath) is not None
@@ -2,6 +2,7 @@ import time
 from dl_uart import *
 from common.memory_map import *
 from dl_file import *
+from utils.measure import measure_metrics
 
 #
 # DEFINES AND VARIABLES
@@ -20,7 +21,57 @@ class IHexRecType:
     START_LINEAR_ADDR = 0x05
 
 
-_image_info = ImageInfo()
+class IHexAddrIndex:
+    """
+    Resolve the 16-bit load offset of data records to 32-bit absolute
+    addresses, following extended segment (02) and linear (04) records.
+    """
+
+    def __init__(self):
+        self.base = 0x00000000
+        self.seg_mode = False
+
+    def update(self, rec_type: int, data: bytes) -> None:
+        """Update the base address from an 02 or 04 record."""
+        if rec_type == IHexRecType.EXT_SEG_ADDR:
+            self.base = int.from_bytes(data, "big") << 4
+            self.seg_mode = True
+        elif rec_type == IHexRecType.EXT_LINEAR_ADDR:
+            self.base = int.from_bytes(data, "big") << 16
+            self.seg_mode = False
+
+    def resolve(self, offset: int, data: bytes) -> list:
+        """
+        Place a data record in the 32-bit address space.
+
+        Segment addresses wrap inside their 64 KB segment and linear
+        addresses wrap at 4 GB, so a record may be split in two.
+
+        Returns:
+            list: (addr, data) pieces of the record.
+        """
+        if self.seg_mode:
+            wrap = 0x10000 - offset
+            pieces = [(self.base + offset, data[:wrap])]
+            if len(data) > wrap:
+                pieces.append((self.base, data[wrap:]))
+        else:
+            addr = (self.base + offset) & 0xFFFFFFFF
+            wrap = 0x100000000 - addr
+            pieces = [(addr, data[:wrap])]
+            if len(data) > wrap:
+                pieces.append((0x00000000, data[wrap:]))
+        return pieces
+
+
+# Expected data length of the address records
+_IHEX_REC_DATA_LEN = {
+    IHexRecType.EOF: 0,
+    IHexRecType.EXT_SEG_ADDR: 2,
+    IHexRecType.EXT_LINEAR_ADDR: 2,
+    IHexRecType.START_SEG_ADDR: 4,
+    IHexRecType.START_LINEAR_ADDR: 4,
+}
 
 
 #
@@ -29,23 +80,16 @@ _image_info = ImageInfo()
 def dl_hexf_readf(file_path: str) -> ImageInfo:
     """
     Read and verify the hex file, and store the image in RAM.
+
+    The file is read in a single pass: every record is checksum-verified,
+    the address boundary is tracked and the data is shadowed at once.
     """
     print("Verify file path: opening file...")
     try:
-        with open(file_path, 'rb') as file:
+        with open(file_path, 'r') as file, \
+                measure_metrics().span("parse_hex"):
             print("Verify file path: file opened successfully")
-            # Verify the hex data
-            if not dl_hexf_verify_file(file):
-                print("Hex file is invalid")
-                return False
-
-            # Also to determine the start and end address
-            dl_hexf_get_addr_boundary(_image_info, file)
-
-            # Store image in RAM so can be used to verify later
-            dl_hexf_shadow_read(_image_info, file)
-
-            return _image_info
+            return dl_hexf_stream_read(file)
 
     except FileNotFoundError:
         print(f"File not found: {file_path}")
@@ -57,130 +101,111 @@ def dl_hexf_readf(file_path: str) -> ImageInfo:
 
 #=================================================================
 @staticmethod
-def dl_hexf_verify_file(file) -> bool:
-    """
-    Verify the hex file by checking the checksum of each line.
+def dl_hexf_stream_read(f) -> ImageInfo:
     """
-    # Verify file content
-    print("Verify file content: reading file...")
-    file.seek(0, 0)  # return cursor to start of line
-
-    for line in file:
-        hex_line = dl_hexf_line_breakdown(line)
-        # check validation, Hex line contains ":" at the beginning
-        if hex_line[0] != ord(":"):
-            print(f"error, first byte is not \":\": {hex_line[0]} with {':'}")
-            return False
-
-        # prepare check checksum
-        checksum_data = []
-        for i in range(1, len(hex_line) - 2):
-            if isinstance(hex_line[i], int):
-                checksum_data.append(hex_line[i])
-            elif isinstance(hex_line[i], list):
-                checksum_data.extend(hex_line[i])
-        # check checksum
-        if (checksum_calc(checksum_data) != hex_line[5]):
-            print("Checksum not pass, recheck the HEX file")
-            return False
-    print("Verify file content: complete")
-    return True
+    Parse an opened hex file record by record and build its image.
 
-
-@staticmethod
-def dl_hexf_get_addr_boundary(image_buf: ImageInfo, file) -> bool:
-    """
-    Read the hex file and determine the start and end addresses of the data.
+    Returns:
+        ImageInfo: The shadowed image, or None if a record is invalid.
     """
-    # read line
-    main_addr = 0
-    s_addr = 0xFFFFFFFF
-    e_addr = 0x00000000
-
-    file.seek(0, 0)  # return cursor to start of line
-
-    print("Finding boundary addresss: reading file...")
-    for line in file:
-        hex_line = dl_hexf_line_breakdown(line)
+    addr_idx = IHexAddrIndex()
+    image = ImageInfo()
+
+    print("Reading hex file: verifying and shadowing records...")
+    for line_no, line in enumerate(f, start=1):
+        line = line.strip()
+        if not line:
+            continue
+
+        hex_rec = dl_hexf_record_parse(line)
+        if hex_rec is None:
+            print(f"Hex file is invalid at line {line_no}: {line}")
+            return None
+        rec_type, offset, data = hex_rec
+
+        if rec_type == IHexRecType.DATA:
+            for addr, piece in addr_idx.resolve(offset, data):
+                if not image.add(addr, piece):
+                    print(f"Hex file is invalid at line {line_no}: {line}")
+                    return None
+            continue
+
+        if len(data) != _IHEX_REC_DATA_LEN.get(rec_type, -1):
+            print(f"Unsupported record at line {line_no}: {line}")
+            return None
+
+        if rec_type == IHexRecType.START_SEG_ADDR:
+            # CS:IP pair, real mode address
+            image.start_addr = (int.from_bytes(data[:2], "big") << 4) + \
+                int.from_bytes(data[2:], "big")
+        elif rec_type == IHexRecType.START_LINEAR_ADDR:
+            image.start_addr = int.from_bytes(data, "big")
+        elif rec_type == IHexRecType.EOF:
+            break
+        else:
+            addr_idx.update(rec_type, data)
+
+    if not image.segments:
+        print("Hex file contains no data record")
+        return None
 
-        # if indicating main address data, save main address
-        if hex_line[3] == IHexRecType.EXT_LINEAR_ADDR:
-            main_addr = hex_line[4]
-        # if indicating data, save start and end address
-        elif hex_line[3] == IHexRecType.DATA:
-            line_addr = main_addr + (hex_line[2][0] << 8 | hex_line[2][1])
+    print(f"Reading hex file: {image.size} bytes in "
+          f"{len(image.segments)} segment(s), {len(image.gaps())} gap(s)")
+    if image.start_addr is not None:
+        print(f"Reading hex file: entry point at 0x{image.start_addr:08X}")
+    return image
 
-            # update start and end address value
-            if line_addr < s_addr:
-                s_addr = line_addr
-            if line_addr > e_addr:
-                e_addr = line_addr + hex_line[1] - 1
 
-    image_buf.main_addr = main_addr
-    image_buf.s_addr = s_addr
-    image_buf.e_addr = e_addr
-    print("Finding boundary addresss: File read complete..")
-    return True
+@staticmethod
+def dl_hexf_record_parse(line: str) -> tuple:
+    """
+    Decode and verify a single record of a hex file.
 
+    Args:
+        line (str): A single line from the hex file, without end of line.
 
-@staticmethod
-def dl_hexf_shadow_read(image_buf: ImageInfo, f) -> bool:
-    f.seek(0, 0)  # return cursor to start of line
+    Returns:
+        tuple: (rec_type, addr, data) where addr is the 16-bit load offset
+            and data is a bytes object, or None if the record is malformed
+            or its checksum does not match.
+    """
+    # check validation, Hex line contains ":" at the beginning
+    if line[:1] != ":":
+        print(f"error, first byte is not \":\": {line[:1]}")
+        return None
 
-    print("Shadowing hex file: reading file...")
-    for line in f:
-        hex_line = dl_hexf_line_breakdown(line)
+    try:
+        rec = bytes.fromhex(line[1:])
+    except ValueError:
+        print("Record is not a valid hex string")
+        return None
 
-        # if indicating data, save start and end address
-        if hex_line[3] == IHexRecType.DATA:
-            line_addr = image_buf.main_addr + (hex_line[2][0] << 8
-                                               | hex_line[2][1])
-            for i in range(hex_line[1]):
-                # read data from hex line and store in memory
-                image_buf.mem_buffer[line_addr - image_buf.s_addr +
-                                     i] = hex_line[4][i]
+    # len, addr (2), type, data (len), checksum
+    if len(rec) < 5 or len(rec) != rec[0] + 5:
+        print("Record length does not match its byte count")
+        return None
 
-    print("Shadowing hex file: memory copy success")
+    # the two's complement checksum makes the record sum up to zero
+    if sum(rec) & 0xFF:
+        print("Checksum not pass, recheck the HEX file")
+        return None
 
-    return True
+    return rec[3], (rec[1] << 8) | rec[2], rec[4:-1]
 
 
 @staticmethod
-def dl_hexf_line_breakdown(line: str) -> list:
+def dl_hexf_record_build(rec_type: int, offset: int, data: bytes) -> str:
     """
-    Breaks down a single line of a hex file into its components.
+    Encode a single record of a hex file, the reverse of
+    dl_hexf_record_parse().
 
     Args:
-        line (str): A single line from the hex file.
+        rec_type (int): Record type, see IHexRecType.
+        offset (int): 16-bit load offset, 0 for the address records.
+        data (bytes): Up to 255 data bytes.
 
     Returns:
-        list: A list containing the following components:
-            - s_sym (str): Start symbol (e.g., ':').
-            - data_len (int): Length of the data in bytes.
-            - addr (list[int]): Address as a list of two bytes.
-            - rec_type (int): Record type.
-            - data (list[int]): Data bytes as a list of integers.
-            - checksum (int): Checksum value.
-            - eol (str): End of line characters.
+        str: The record with its checksum and end of line.
     """
-    # Extract components from the line
-    start_symbol = line[0]
-    data_length = int(line[1:3], 16)
-    address = [int(line[3:5], 16), int(line[5:7], 16)]
-    record_type = int(line[7:9], 16)
-
-    # Extract data bytes
-    data = [int(line[i:i + 2], 16) for i in range(9, 9 + (data_length * 2), 2)]
-
-    # Extract checksum and end of line
-    checksum = int(line[-4:-2], 16)
-    end_of_line = line[-2:]
-
-    # Return the parsed components
-    return [
-        start_symbol, data_length, address, record_type, data, checksum,
-        end_of_line
-    ]
-
-
-
+    rec = bytes((len(data), offset >> 8, offset & 0xFF, rec_type)) + data
+    return f":{rec.hex().upper()}{-sum(rec) & 0xFF:02X}\n"
@@ -0,0 +1,279 @@
+import concurrent.futures
+
+from dl_bld import *
+
+#
+# VARIABLES AND DEFINES
+#============================================================================
+
+# Progress is reported every SESSION_PROGRESS_STEP percent of a stage
+SESSION_PROGRESS_STEP = 25
+# A connection idle for longer is confirmed again before the next command
+SESSION_IDLE_S = 5.0
+
+
+class SessionState:
+    """
+    Contains the states of a flashing session
+    """
+    IDLE = "idle"
+    CONNECTING = "connecting"
+    ERASE = "erase"
+    WRITE = "write"
+    VERIFY = "verify"
+    EXIT = "exit"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class BldSession:
+    """
+    One bootloader connection, the per-port replacement of the class level
+    Uart state so several boards can be driven from one process.
+
+    The port stays open across commands. The bootloader version is read
+    once by connect(), later commands skip the version round trip of the
+    dl_bld_* functions unless the last command failed or the connection was
+    idle for idle_timeout seconds. The capabilities are not cached, every
+    upload queries them as CMD_GET_CAPS also restarts the write sequence.
+    """
+
+    def __init__(self,
+                 port: str,
+                 baudrate: int = 115200,
+                 timeout: float = 1,
+                 idle_timeout: float = SESSION_IDLE_S):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.inst: serial.Serial = None
+        self.state = SessionState.IDLE
+        self.progress = (0, 0)  # done, total of the current state
+        self.version = None
+        self.error = ""
+        self.elapsed = 0.0
+        self._reported = -1
+        self._alive_at = None  # time.monotonic() of the last good answer
+
+    def open(self) -> bool:
+        """Open the UART port."""
+        try:
+            self.inst = serial.Serial(port=self.port,
+                                      baudrate=self.baudrate,
+                                      timeout=self.timeout)
+        except serial.SerialException as e:
+            self.error = f"Failed to open port: {e}"
+            return False
+        return True
+
+    def close(self) -> None:
+        """Close the UART port."""
+        self._alive_at = None
+        if self.inst is not None and self.inst.is_open:
+            self.inst.close()
+
+    def connect(self) -> bool:
+        """
+        Open the port if needed and make sure the bootloader answers.
+
+        The version handshake only runs on a new port, after a failed
+        command or after idle_timeout.
+
+        Returns:
+            bool: True if the bootloader is reachable.
+        """
+        if self.inst is None or not self.inst.is_open:
+            if not self.open():
+                return False
+        if self._alive_at is not None and \
+                time.monotonic() - self._alive_at < self.idle_timeout:
+            return True
+
+        version = dl_bld_get_version(self.inst)
+        if not version:
+            self.error = "No response, MCU might be out of bootloader"
+            return False
+        self.version = bytes(version).decode("ascii", errors="replace")
+        self._alive_at = time.monotonic()
+        return True
+
+    def _command(self, func, *args, nack_answers: bool = False, **kwargs):
+        """
+        Run func on the port, a timeout or NACK forces a handshake before
+        the next command. nack_answers marks commands whose NACK is a valid
+        answer (e.g. not blank), only a timeout counts for them.
+        """
+        if not self.connect():
+            return 0
+        metrics = measure_metrics(self.inst)
+        timeouts = metrics.counters["timeouts"]
+        try:
+            ret = func(self.inst, *args, **kwargs)
+        except serial.SerialException as e:
+            self.error = f"Serial error: {e}"
+            self.close()
+            return 0
+        if metrics.counters["timeouts"] != timeouts or \
+                not (ret or nack_answers):
+            self._alive_at = None
+        else:
+            self._alive_at = time.monotonic()
+        return ret
+
+    def blanking(self, addr: int, size: int) -> bool:
+        return self._command(dl_bld_blanking, addr, size, 1,
+                             nack_answers=True, check_conn=False)
+
+    def write(self, addr: int, data: bytearray) -> bool:
+        return self._command(dl_bld_write, addr, data, 1, check_conn=False)
+
+    def erase(self, addr: int, size: int) -> bool:
+        return self._command(dl_bld_erase, addr, size, 1, check_conn=False)
+
+    def upload(self) -> bool:
+        """Select a file and upload it, see dl_bld_upload()."""
+        return self._command(dl_bld_upload, check_conn=False)
+
+    def check_crc(self, addr: int, size: int, data: bytearray) -> bool:
+        return self._command(dl_bld_check_img_crc, addr, size, data)
+
+    def exit_bld(self, entry_addr: int = None) -> bool:
+        """Start the application, the port is closed afterwards."""
+        ret = self._command(dl_bld_exit, entry_addr)
+        self.close()
+        return ret
+
+    def on_progress(self, stage: str, done: int, total: int) -> None:
+        """
+        Progress callback of dl_bld_upload_target_file(), prints a line per
+        SESSION_PROGRESS_STEP percent.
+        """
+        if stage != self.state:
+            self.state = stage
+            self._reported = -1
+        self.progress = (done, total)
+        percent = done * 100 // total if total else 100
+        step = percent // SESSION_PROGRESS_STEP
+        if step != self._reported:
+            self._reported = step
+            print(f"[{self.port}] {stage} {percent}%")
+
+    def flash(self,
+              plan: BldImagePlan,
+              window: int = BLD_UPLOAD_WINDOW,
+              exit_bld: bool = True,
+              delta: bool = False,
+              compress: bool = True,
+              baud_max: int = None) -> bool:
+        """
+        Erase, write, verify and optionally start the image on the board.
+
+        Args:
+            plan (BldImagePlan): Image to flash, shared with other sessions.
+            window (int): Write packets in flight.
+            exit_bld (bool): Start the application once verified.
+            delta (bool): Only rewrite the sectors that differ.
+            compress (bool): Allow run-length encoded writes.
+            baud_max (int): Adapt the baudrate up to baud_max.
+
+        Returns:
+            bool: True on success, the failure is described in error.
+        """
+        t_start = time.perf_counter()
+        try:
+            return self._flash(plan, window, exit_bld, delta, compress,
+                               baud_max)
+        except serial.SerialException as e:
+            self.error = f"Serial error: {e}"
+            self.state = SessionState.FAILED
+            return False
+        finally:
+            self.elapsed = time.perf_counter() - t_start
+            self.close()
+
+    def _flash(self, plan: BldImagePlan, window: int, exit_bld: bool,
+               delta: bool, compress: bool, baud_max: int) -> bool:
+        self.state = SessionState.CONNECTING
+        if not self.connect():
+            self.state = SessionState.FAILED
+            return False
+
+        self.state = SessionState.ERASE
+        if not dl_bld_upload_target_file(self.inst,
+                                         plan,
+                                         window=window,
+                                         progress=self.on_progress,
+                                         delta=delta,
+                                         compress=compress,
+                                         baud_max=baud_max):
+            self.error = f"Upload failed during {self.state}"
+            self.state = SessionState.FAILED
+            return False
+
+        if exit_bld:
+            self.state = SessionState.EXIT
+            if not dl_bld_exit(self.inst, plan.image_info.start_addr):
+                self.error = "Exit bootloader failed"
+                self.state = SessionState.FAILED
+                return False
+
+        self.state = SessionState.DONE
+        print(f"[{self.port}] done")
+        return True
+
+    def result(self) -> dict:
+        return {
+            "port": self.port,
+            "ok": self.state == SessionState.DONE,
+            "state": self.state,
+            "version": self.version,
+            "error": self.error,
+            "elapsed_s": round(self.elapsed, 3),
+            "metrics": measure_metrics(self.inst).summary()
+            if self.inst is not None else None,
+        }
+
+
+#
+# Orchestrator
+#============================================================================
+def dl_session_flash_all(ports: list,
+                         image_info,
+                         baudrate: int = 115200,
+                         window: int = BLD_UPLOAD_WINDOW,
+                         exit_bld: bool = True,
+                         delta: bool = False,
+                         compress: bool = True,
+                         baud_max: int = None) -> list:
+    """
+    Flash the same image on several boards at once, one thread per port.
+
+    The image is planned (chunks, erase ranges, CRCs) once and shared
+    read-only by the sessions; the threads mostly wait on their own UART.
+
+    Args:
+        ports (list): Serial port names.
+        image_info (ImageInfo | BldImagePlan): Image to flash.
+
+    Returns:
+        list: The BldSession of every port, in the order of ports.
+    """
+    plan = image_info if isinstance(image_info, BldImagePlan) else \
+        BldImagePlan(image_info)
+    sessions = [BldSession(port, baudrate) for port in ports]
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, len(sessions))) as pool:
+        futures = [
+            pool.submit(session.flash, plan, window, exit_bld, delta,
+                        compress, baud_max)
+            for session in sessions
+        ]
+
+    for session, future in zip(sessions, futures):
+        if future.exception() is not None:
+            session.error = f"Unexpected error: {future.exception()!r}"
+            session.state = SessionState.FAILED
+
+    return sessions
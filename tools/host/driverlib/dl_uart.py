@@ -1,9 +1,11 @@
+import collections
 import serial
 import os
 import time
+import weakref
 
 from common.ret_no import ERRNO
-from utils.checksum import checksum_calc
+from utils.measure import measure_metrics
 
 BUADRATE_LIST = [
     110, 300, 600, 1200, 2400, 4800, 9600, 19200, 38400, 57600, 115200, 230400,
@@ -11,6 +13,23 @@ BUADRATE_LIST = [
     4000000
 ]
 
+# start bit + 8 data bits + stop bit
+UART_BITS_PER_BYTE = 10
+
+# exchanges per link quality sample
+UART_LINK_WINDOW = 32
+# wait before resending after a timeout, doubled per timeout in a row
+UART_BACKOFF_BASE = 0.02
+UART_BACKOFF_MAX = 1.0
+# port read timeout while waiting for a frame, set once per port (changing
+# it reconfigures the driver); the frame deadline is checked between reads
+UART_READ_POLL_S = 0.01
+# a partial frame that stops growing for this long is given up and the
+# stream resynchronized behind it; at slow baudrates UART_RX_IDLE_BYTES byte
+# times instead
+UART_RX_IDLE_S = 0.05
+UART_RX_IDLE_BYTES = 2
+
 # 🔹 Global Configuration Variables
 
 
@@ -107,67 +126,258 @@ class Uart:
 
 
 ####### Utility functions ######
-def dl_uart_write(uart_port: serial.Serial, data: list) -> None:
+def dl_uart_write(uart_port: serial.Serial, data) -> int:
     """
-    Send data to the specified COM port and introduce a delay.
+    Send a packet to the specified COM port as one contiguous write.
 
     Args:
-        COM (object): The COM port object used for communication.
-        data_to_send (int): The data byte to be sent to the COM port.
+        uart_port (serial.Serial): The COM port object used for communication.
+        data (bytes | bytearray | list | str): The packet to be sent.
+
+    Returns:
+        int: Number of bytes written.
     """
-    for byte in data:
-        if isinstance(byte, int):
-            uart_port.write(bytes([byte]))
-        elif isinstance(byte, str):
-            uart_port.write(byte.encode())
-        else:
-            uart_port.write(bytes([byte]))
+    if isinstance(data, str):
+        data = data.encode()
+    elif isinstance(data, list):
+        data = bytes(data)
+
+    nbytes = uart_port.write(data)
+    metrics = measure_metrics(uart_port)
+    metrics.count("tx_frames")
+    metrics.count("tx_bytes", nbytes)
+    return nbytes
 
 
-def dl_uart_read_resp(uart_port: serial.Serial) -> bytearray:
+def dl_uart_write_batch(uart_port: serial.Serial, packets: list) -> int:
     """
-    This function reads rx buffer, including verifying len and checksum
-    
-    Return:
-        if data is available, return from bit 1 to n-1 (excluding length and checksum)
-        else return [0]
+    Coalesce several packets into a single write, so the line is kept busy
+    without a syscall per packet.
+
+    Returns:
+        int: Number of bytes written.
+    """
+    nbytes = uart_port.write(b"".join(packets))
+    metrics = measure_metrics(uart_port)
+    metrics.count("tx_frames", len(packets))
+    metrics.count("tx_bytes", nbytes)
+    return nbytes
+
+
+def dl_uart_line_util(uart_port: serial.Serial, nbytes: int,
+                      elapsed: float) -> float:
     """
-    # Scan UART buffer for incoming data
-    time_out = 0
-    while not uart_port.in_waiting:
-        time.sleep(0.001)  # as tested, 0.001 is min
-        time_out += 1
-        if time_out == 1000:
-            print("timeout")
-            return [0]
-
-    # if catched data
-    try:
-        rx_buf = uart_port.read(uart_port.in_waiting)
-    except ValueError:
-        print("catch value error")
-
-    # check data integrity and return if data is valid
-    if dl_uart_check_rx_buf_integrity(rx_buf):
-        return rx_buf[1:len(rx_buf) - 1]
-
-    return [0]
-
-
-@staticmethod
-def dl_uart_check_rx_buf_integrity(rx_buf: bytearray) -> bool:
+    Ratio between the time nbytes take on the wire at the port baudrate
+    and the measured elapsed time (1.0 means the line never idled).
     """
-    Check the integrity of the received buffer by verifying its length and checksum.
+    if elapsed <= 0:
+        return 0.0
+    return nbytes * UART_BITS_PER_BYTE / uart_port.baudrate / elapsed
+
+
+class UartFrameParser:
+    """
+    Split the received byte stream into response frames.
+
+    A frame is [len][data ...][checksum], len counting the whole frame.
+    Partial frames are kept until the next feed, and bytes that cannot start
+    a valid frame are dropped one by one to resynchronize on the stream. An
+    incomplete frame is only given up when the caller resyncs, once its
+    deadline or an idle gap has passed.
     """
+    FRAME_LEN_MIN = 2
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.fed_at = 0.0  # time.monotonic() of the last feed
+
+    def feed(self, data) -> None:
+        self.buf += data
+        self.fed_at = time.monotonic()
+
+    def idle(self, gap: float) -> bool:
+        """True if a partial frame has not grown for gap seconds."""
+        return bool(self.buf) and time.monotonic() - self.fed_at >= gap
+
+    def next_frame(self, resync: bool = False) -> bytes:
+        """
+        Args:
+            resync (bool): Give up an incomplete frame at the head, its
+                length byte may be garbage; a valid frame behind it is
+                returned instead.
+
+        Returns:
+            bytes: The next complete and valid frame, or None.
+        """
+        dropped = 0
+        frame = None
+        while self.buf:
+            state = self._frame_state(0)
+            if state > 0:
+                frame_len = self.buf[0]
+                frame = bytes(self.buf[:frame_len])
+                del self.buf[:frame_len]
+                break
+            if state == 0:
+                if not resync:
+                    # wait for the rest, its payload may look like a frame
+                    break
+                ofs = next((i for i in range(1, len(self.buf))
+                            if self._frame_state(i) > 0), len(self.buf))
+                del self.buf[:ofs]
+                dropped += ofs
+                continue
+            del self.buf[0]
+            dropped += 1
+
+        if dropped:
+            print(f"Error: dropped {dropped} invalid byte(s), resynchronized")
+        return frame
+
+    def _frame_state(self, ofs: int) -> int:
+        """
+        Returns:
+            int: 1 if a valid frame starts at ofs, 0 if it is incomplete,
+                -1 if it is invalid.
+        """
+        frame_len = self.buf[ofs]
+        if frame_len < self.FRAME_LEN_MIN:
+            return -1
+        if len(self.buf) - ofs < frame_len:
+            return 0
+        # the checksum makes the whole frame sum up to zero
+        if sum(self.buf[ofs:ofs + frame_len]) & 0xFF:
+            return -1
+        return 1
+
+    def reset(self) -> None:
+        self.buf.clear()
+
+
+# one parser per port, so partial frames survive between calls
+_frame_parsers = weakref.WeakKeyDictionary()
+
+
+class UartLinkQuality:
+    """
+    Outcome of the last exchanges on a port: ACKed, NACKed (corrupted on
+    the way) or timed out (lost, or the device is busy or gone).
+    """
+
+    def __init__(self, window: int = UART_LINK_WINDOW):
+        self.outcomes = collections.deque(maxlen=window)  # 1 means error
+        self.timeouts_in_row = 0
 
-    # Check if the buffer is empty or too short
-    if len(rx_buf) != rx_buf[0]:
-        print("Error: Received buffer is empty or too short.")
-        return False
+    def record_ok(self) -> None:
+        self.outcomes.append(0)
+        self.timeouts_in_row = 0
 
-    # Check CRC
-    if rx_buf[-1] != checksum_calc(rx_buf[:-1]):
-        print("Error: Checksum mismatch.")
-        return False
+    def record_nack(self) -> None:
+        self.outcomes.append(1)
+
+    def record_timeout(self) -> None:
+        self.outcomes.append(1)
+        self.timeouts_in_row += 1
+
+    def full(self) -> bool:
+        """True once a whole window of exchanges has been recorded."""
+        return len(self.outcomes) == self.outcomes.maxlen
+
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return sum(self.outcomes) / len(self.outcomes)
+
+    def backoff(self) -> float:
+        """Seconds to wait before resending, 0 unless the last one timed out."""
+        if not self.timeouts_in_row:
+            return 0.0
+        return min(UART_BACKOFF_BASE * 2**(self.timeouts_in_row - 1),
+                   UART_BACKOFF_MAX)
+
+    def reset(self) -> None:
+        self.outcomes.clear()
+        self.timeouts_in_row = 0
+
+
+_link_qualities = weakref.WeakKeyDictionary()
+
+
+def dl_uart_link_quality(uart_port: serial.Serial) -> UartLinkQuality:
+    """Return the link quality tracker bound to uart_port."""
+    quality = _link_qualities.get(uart_port)
+    if quality is None:
+        quality = _link_qualities[uart_port] = UartLinkQuality()
+    return quality
+
+
+def dl_uart_frame_parser(uart_port: serial.Serial) -> UartFrameParser:
+    """Return the frame parser bound to uart_port."""
+    parser = _frame_parsers.get(uart_port)
+    if parser is None:
+        parser = _frame_parsers[uart_port] = UartFrameParser()
+    return parser
+
+
+def dl_uart_rx_idle_s(baudrate: int) -> float:
+    """Seconds without a byte after which a partial frame is given up."""
+    return max(UART_RX_IDLE_S,
+               UART_RX_IDLE_BYTES * UART_BITS_PER_BYTE / baudrate)
+
+
+def dl_uart_read_frame(uart_port: serial.Serial,
+                       timeout: float = 1.0) -> bytes:
+    """
+    Block on the port until one complete frame is received.
+
+    Every read takes what has arrived and the parser checks the buffer
+    again, so responses that arrive split or merged are reassembled. A
+    partial frame is kept until it stops growing for dl_uart_rx_idle_s() or
+    the deadline passes, then a garbage length byte no longer holds back
+    the frame behind it.
+
+    Args:
+        uart_port (serial.Serial): The COM port object used for communication.
+        timeout (float): Deadline in seconds for the whole frame.
+
+    Returns:
+        bytes: The frame including length and checksum, or None on timeout.
+    """
+    parser = dl_uart_frame_parser(uart_port)
+    metrics = measure_metrics(uart_port)
+    idle_s = dl_uart_rx_idle_s(uart_port.baudrate)
+    deadline = time.monotonic() + timeout
+    if uart_port.timeout != UART_READ_POLL_S:
+        uart_port.timeout = UART_READ_POLL_S
+
+    while True:
+        expired = time.monotonic() >= deadline
+        frame = parser.next_frame(expired or parser.idle(idle_s))
+        if frame is not None:
+            metrics.count("rx_frames")
+            return frame
+
+        if expired:
+            metrics.count("timeouts")
+            return None
+        data = uart_port.read(max(uart_port.in_waiting, 1))
+        if data:
+            metrics.count("rx_bytes", len(data))
+            parser.feed(data)
+
+
+def dl_uart_read_resp(uart_port: serial.Serial,
+                      timeout: float = 1.0) -> bytearray:
+    """
+    This function reads one response frame, including verifying len and checksum
+    
+    Return:
+        if data is available, return from bit 1 to n-1 (excluding length and checksum)
+        else return [0]
+    """
+    rx_buf = dl_uart_read_frame(uart_port, timeout)
+    if rx_buf is None:
+        print("timeout")
+        return [0]
 
-    return True
+    return rx_buf[1:len(rx_buf) - 1]
@@ -1,5 +1,9 @@
 import sys
 import os
+import argparse
+import contextlib
+import json
+import time
 import serial.tools.list_ports
 
 sys.path.append(
@@ -11,23 +15,62 @@ sys.path.append(
 
 from driverlib.dl_uart import Uart
 from driverlib.dl_hexf import *
-from driverlib.dl_bld import *
+# dl_bld as the other driverlib modules import it, so they share its classes
+# (an image plan from dl_cache is a BldImagePlan to the upload)
+from dl_bld import *
+from driverlib.dl_session import BldSession, dl_session_flash_all
+from driverlib.dl_discover import dl_discover_ports
+from driverlib.dl_cache import dl_cache_load_plan
+from driverlib.dl_conv import (CONV_FILL, CONV_REC_LEN, dl_conv_hexf_to_binf,
+                               dl_conv_binf_to_hexf)
 from common.memory_map import *
+from common.ret_no import EXIT_CODE
+from utils.measure import measure_metrics
 
 
 #===========================================================================
 #                                 MAIN
 #===========================================================================
+
+# menu commands share one session, the port stays open between them
+bld_session: BldSession = None
+
+
 @staticmethod
-def uart_port_init() -> None:
-    Uart.scan_com_ports()
-    Uart.input_set_com_port()
-    Uart.cfg_port(Uart.target_com_port)
-    Uart.init()
+def uart_port_init() -> BldSession:
+    """
+    Returns:
+        BldSession: The menu session with a reachable bootloader, None if
+            it does not answer.
+    """
+    global bld_session
+    if bld_session is None:
+        # a single bootloader is taken as is, otherwise the operator picks
+        infos = dl_discover_ports()
+        if len(infos) == 1:
+            print(f"Found bootloader on {infos[0].port} @ "
+                  f"{infos[0].baudrate}")
+            Uart.cfg_port(infos[0].port)
+            Uart.cfg_baudrate(infos[0].baudrate)
+        else:
+            Uart.scan_com_ports()
+            Uart.input_set_com_port()
+            Uart.cfg_port(Uart.target_com_port)
+        bld_session = BldSession(Uart.port_addr, Uart.baudrate)
+
+    if not bld_session.connect():
+        print(f"{bld_session.port}: {bld_session.error}")
+        uart_port_deinit()
+        return None
+    return bld_session
 
 
 def uart_port_deinit() -> None:
-    Uart.deinit()
+    """Close the menu session, the next command selects a port again."""
+    global bld_session
+    if bld_session is not None:
+        bld_session.close()
+        bld_session = None
 
 
 def main() -> None:
@@ -56,6 +99,7 @@ def main() -> None:
 
     choice = input("Choosing mode: ").strip()
     if choice.lower() == 'r':
+        uart_port_deinit()
         exit()
     if choice.isdigit():
         idx = int(choice)
@@ -76,81 +120,87 @@ def main() -> None:
 
 @staticmethod
 def cmd_get_bld_version_cb():
-    uart_port_init()
-    print("Bootloader version is:", dl_bld_get_version(Uart.inst))
-    uart_port_deinit()
+    session = uart_port_init()
+    if session is not None:
+        print("Bootloader version is:", session.version)
 
 
 @staticmethod
 def cmd_check_blanking_cb():
-    uart_port_init()
+    session = uart_port_init()
+    if session is None:
+        return
     addr = 0x1800
     size = 0x400
     print(f"Image from {addr} with size of {size}\
-        is {'clean' if dl_bld_blanking(Uart.inst, addr, size, 1) else 'not blank'}"
+        is {'clean' if session.blanking(addr, size) else 'not blank'}"
           )
-    uart_port_deinit()
 
 
 @staticmethod
 def cmd_write():
-    uart_port_init()
+    session = uart_port_init()
+    if session is None:
+        return
     addr = 0x1800
     data = [
         0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07, 0x08, 0x09, 0x0A, 0x0B, 0x0C,
         0x0D, 0x0E, 0x0F
     ]
-    if dl_bld_write(Uart.inst, addr, data, 1):
+    if session.write(addr, data):
         print("Write success")
     else:
         print("Write failed")
-    uart_port_deinit()
 
 
 @staticmethod
 def cmd_erase():
-    uart_port_init()
+    session = uart_port_init()
+    if session is None:
+        return
     addr = 0x1800
     size = 0x400
-    if dl_bld_erase(Uart.inst, addr, size, 1):
+    if session.erase(addr, size):
         print("Erase success")
     else:
         print("Erase failed")
 
-    uart_port_deinit()
-
 
 @staticmethod
 def cmd_upload_file():
-    uart_port_init()
-    if dl_bld_upload(Uart.inst):
+    session = uart_port_init()
+    if session is None:
+        return
+    if session.upload():
         print("Upload success")
     else:
         print("Upload failed")
 
-    uart_port_deinit()
-
 
 @staticmethod
 def cmd_check_crc():
-    uart_port_init()
+    session = uart_port_init()
+    if session is None:
+        return
     addr = 0x1800
     size = 0x400
     data = input("Input some data here: ")
-    if dl_bld_check_img_crc(Uart.inst, addr, size, data):
+    if session.check_crc(addr, size, data):
         print("CRC check success")
     else:
         print("CRC check failed")
 
-    uart_port_deinit()
     
 @staticmethod
 def cmd_exit_bld():
-    uart_port_init()
-    if dl_bld_exit(Uart.inst):
+    session = uart_port_init()
+    if session is None:
+        return
+    if session.exit_bld():
         print("Exit bootloader successed, entering application")
     else:
         print("Exit bootloader failed")
+    # the application owns the port now
     uart_port_deinit()
 
 
@@ -171,10 +221,351 @@ def cmd_hexf_to_binf():
         dl_hexf_to_binf(fpath=FileInfo.fpath, ouputf_name=fname + ".bin")
 
 
+#===========================================================================
+# COMMAND LINE INTERFACE
+# Non-interactive entry point, e.g.
+#   python main.py flash --port /dev/ttyUSB0 --baud 115200 app.hex
+# The result is reported through the exit code (see EXIT_CODE) and, with
+# --json, as a JSON object on stdout.
+#===========================================================================
+
+
+@staticmethod
+def cli_int(value: str) -> int:
+    """Parse decimal or 0x prefixed integers."""
+    return int(value, 0)
+
+
+@staticmethod
+def cli_baudrate(value: str) -> int:
+    baudrate = int(value)
+    if baudrate not in BUADRATE_LIST:
+        raise argparse.ArgumentTypeError(f"unsupported baudrate {value}")
+    return baudrate
+
+
+@staticmethod
+def cli_rec_len(value: str) -> int:
+    rec_len = int(value, 0)
+    if not 0 < rec_len <= 0xFF:
+        raise argparse.ArgumentTypeError(f"record length {value} not in "
+                                         f"1..255")
+    return rec_len
+
+
+@staticmethod
+def cli_parse_args(argv: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="main.py", description="MSPM0 UART bootloader host")
+    port_args = argparse.ArgumentParser(add_help=False)
+    port_args.add_argument("--port", required=True,
+                           help="serial port, e.g. /dev/ttyUSB0 or COM3, "
+                           "\"auto\" for the first port a bootloader "
+                           "answers on")
+    link_args = argparse.ArgumentParser(add_help=False)
+    link_args.add_argument("--baud", type=cli_baudrate, default=115200,
+                           help="baudrate (default: %(default)s)")
+    link_args.add_argument("--json", action="store_true",
+                           help="print the result as JSON on stdout")
+    # shared by flash and gang
+    image_args = argparse.ArgumentParser(add_help=False)
+    image_args.add_argument("image", help=".hex, .bin or .elf file")
+    image_args.add_argument("--addr", type=cli_int,
+                            help="load address of a .bin file")
+    image_args.add_argument("--window", type=int, default=BLD_UPLOAD_WINDOW,
+                            help="write packets in flight "
+                            "(default: %(default)s)")
+    image_args.add_argument("--no-exit", action="store_true",
+                            help="stay in the bootloader after flashing")
+    image_args.add_argument("--delta", action="store_true",
+                            help="only rewrite the sectors that changed")
+    image_args.add_argument("--no-compress", action="store_true",
+                            help="send write payloads uncompressed")
+    image_args.add_argument("--baud-max", type=cli_baudrate, default=None,
+                            help="adapt the baudrate to the link up to this "
+                            "rate")
+    image_args.add_argument("--no-cache", action="store_true",
+                            help="parse the image even if it is cached")
+    cmds = parser.add_subparsers(dest="cmd", required=True)
+
+    cmds.add_parser("flash", parents=[port_args, link_args, image_args],
+                    help="erase, write and verify an image")
+
+    gang = cmds.add_parser("gang", parents=[link_args, image_args],
+                           help="flash an image on several ports at once")
+    gang.add_argument("--port", action="append", required=True,
+                      help="serial port, repeat for every board, \"auto\" "
+                      "for every port a bootloader answers on")
+
+    cmds.add_parser("version", parents=[port_args, link_args],
+                    help="read the bootloader version")
+
+    scan = cmds.add_parser("scan",
+                           help="find the ports a bootloader answers on")
+    scan.add_argument("--port", action="append", default=None,
+                      help="serial port to probe, repeat for several "
+                      "(default: every port)")
+    scan.add_argument("--baud-max", type=cli_baudrate, default=None,
+                      help="also find the fastest baudrate up to this rate")
+    scan.add_argument("--json", action="store_true",
+                      help="print the result as JSON on stdout")
+
+    convert = cmds.add_parser("convert",
+                              help="convert a .hex file to .bin or a .bin "
+                              "file to .hex")
+    convert.add_argument("input", help=".hex or .bin file")
+    convert.add_argument("output", help=".bin or .hex file to write")
+    convert.add_argument("--addr", type=cli_int,
+                         help="load address of a .bin input")
+    convert.add_argument("--entry", type=cli_int,
+                         help="entry point written to the .hex output")
+    convert.add_argument("--rec-len", type=cli_rec_len, default=CONV_REC_LEN,
+                         help="data bytes per .hex record "
+                         "(default: %(default)s)")
+    convert.add_argument("--fill", type=cli_int, default=CONV_FILL,
+                         help="value of the .bin bytes between .hex records "
+                         "(default: 0xFF)")
+    convert.add_argument("--start", type=cli_int,
+                         help="address of the first .bin byte, data below "
+                         "is left out (default: the first record)")
+    convert.add_argument("--end", type=cli_int,
+                         help=".hex data from this address on is left out")
+    convert.add_argument("--json", action="store_true",
+                         help="print the result as JSON on stdout")
+
+    erase = cmds.add_parser("erase", parents=[port_args, link_args],
+                            help="erase a flash range")
+    erase.add_argument("--addr", type=cli_int, required=True)
+    erase.add_argument("--size", type=cli_int, required=True)
+
+    return parser.parse_args(argv)
+
+
+@staticmethod
+def cli_resolve_ports(args: argparse.Namespace) -> bool:
+    """
+    Replace a --port auto by the ports a bootloader answers on, --baud by
+    the rate it answered at.
+
+    Returns:
+        bool: False if auto was given and no bootloader answered.
+    """
+    ports = args.port if isinstance(args.port, list) else [args.port]
+    if "auto" not in ports:
+        return True
+    infos = dl_discover_ports()
+    if not infos:
+        print("No bootloader found on any port")
+        return False
+    for info in infos:
+        print(f"Found bootloader on {info.port} @ {info.baudrate}")
+    if isinstance(args.port, list):
+        args.port = [info.port for info in infos]
+    else:
+        args.port = infos[0].port
+    args.baud = infos[0].baudrate
+    return True
+
+
+@staticmethod
+def cli_open_port(args: argparse.Namespace) -> serial.Serial:
+    try:
+        return serial.Serial(port=args.port, baudrate=args.baud, timeout=1)
+    except serial.SerialException as e:
+        print(f"Failed to open port {args.port}: {e}")
+        return None
+
+
+@staticmethod
+def cli_version(uart_port: serial.Serial, args: argparse.Namespace,
+                result: dict) -> int:
+    version = dl_bld_get_version(uart_port)
+    if not version:
+        return EXIT_CODE.ERR_NO_RESPONSE
+    result["version"] = bytes(version).decode("ascii", errors="replace")
+    print("Bootloader version is:", result["version"])
+    return EXIT_CODE.SUCCESS
+
+
+@staticmethod
+def cli_erase(uart_port: serial.Serial, args: argparse.Namespace,
+              result: dict) -> int:
+    if not dl_bld_erase(uart_port, args.addr, args.size, 1):
+        return EXIT_CODE.ERR_UPLOAD
+    return EXIT_CODE.SUCCESS
+
+
+@staticmethod
+def cli_flash(uart_port: serial.Serial, args: argparse.Namespace,
+              result: dict) -> int:
+    image = args.plan.image_info
+    result["image"] = args.image
+    result["s_addr"] = image.s_addr
+    result["size"] = image.size
+    result["segments"] = len(image.segments)
+
+    version = dl_bld_get_version(uart_port)
+    if not version:
+        return EXIT_CODE.ERR_NO_RESPONSE
+    result["version"] = bytes(version).decode("ascii", errors="replace")
+
+    if not dl_bld_upload_target_file(uart_port,
+                                     args.plan,
+                                     window=args.window,
+                                     delta=args.delta,
+                                     compress=not args.no_compress,
+                                     baud_max=args.baud_max):
+        return EXIT_CODE.ERR_UPLOAD
+
+    if not args.no_exit and not dl_bld_exit(uart_port, image.start_addr):
+        return EXIT_CODE.ERR_EXIT_BLD
+    return EXIT_CODE.SUCCESS
+
+
+@staticmethod
+def cli_scan(args: argparse.Namespace, result: dict) -> int:
+    infos = dl_discover_ports(args.port, baud_max=args.baud_max)
+    result["ports"] = [info.result() for info in infos]
+    for info in infos:
+        line = f"{info.port}: bootloader {info.version} @ {info.baudrate}"
+        if info.baud_max is not None:
+            line += f", up to {info.baud_max}"
+        print(line)
+    if not infos:
+        print("No bootloader found")
+        return EXIT_CODE.ERR_NO_RESPONSE
+    return EXIT_CODE.SUCCESS
+
+
+@staticmethod
+def cli_convert(args: argparse.Namespace, result: dict) -> int:
+    # the direction follows the file extensions
+    src, dst = (os.path.splitext(fpath)[1].lower()
+                for fpath in (args.input, args.output))
+    if (src, dst) == (".hex", ".bin"):
+        info = dl_conv_hexf_to_binf(args.input,
+                                    args.output,
+                                    fill=args.fill & 0xFF,
+                                    s_addr=args.start,
+                                    e_addr=args.end)
+    elif (src, dst) == (".bin", ".hex"):
+        if args.addr is None:
+            print(f"Load address required for bin file: {args.input}")
+            return EXIT_CODE.ERR_USAGE
+        info = dl_conv_binf_to_hexf(args.input,
+                                    args.output,
+                                    args.addr,
+                                    rec_len=args.rec_len,
+                                    start_addr=args.entry)
+    else:
+        print(f"Unsupported conversion: {src or args.input} to "
+              f"{dst or args.output}")
+        return EXIT_CODE.ERR_USAGE
+
+    if info is None:
+        return EXIT_CODE.ERR_FILE
+    result.update(info.result())
+    return EXIT_CODE.SUCCESS
+
+
+@staticmethod
+def cli_gang(args: argparse.Namespace, result: dict) -> int:
+    sessions = dl_session_flash_all(args.port,
+                                    args.plan,
+                                    baudrate=args.baud,
+                                    window=args.window,
+                                    exit_bld=not args.no_exit,
+                                    delta=args.delta,
+                                    compress=not args.no_compress,
+                                    baud_max=args.baud_max)
+    result["boards"] = [session.result() for session in sessions]
+    print("=" * 40)
+    for board in result["boards"]:
+        print(f"{board['port']}: {'success' if board['ok'] else 'failed'} "
+              f"{board['error']}")
+    if all(board["ok"] for board in result["boards"]):
+        return EXIT_CODE.SUCCESS
+    return EXIT_CODE.ERR_UPLOAD
+
+
+@staticmethod
+def cli_run(args: argparse.Namespace, result: dict) -> int:
+    if args.cmd == "convert":
+        return cli_convert(args, result)
+    if args.cmd == "scan":
+        return cli_scan(args, result)
+    if args.cmd in ("flash", "gang"):
+        # parsed and CRCed once per build, see dl_cache
+        if args.no_cache:
+            image = dl_file_load_image(args.image, args.addr)
+            args.plan = BldImagePlan(image) if image and image.segments \
+                else None
+        else:
+            args.plan = dl_cache_load_plan(args.image, args.addr)
+        if args.plan is None:
+            return EXIT_CODE.ERR_FILE
+    if not cli_resolve_ports(args):
+        return EXIT_CODE.ERR_NO_RESPONSE
+    result["port"] = args.port
+    if args.cmd == "gang":
+        # every session opens its own port
+        return cli_gang(args, result)
+
+    uart_port = cli_open_port(args)
+    if uart_port is None:
+        return EXIT_CODE.ERR_PORT
+
+    cmd_tb = {
+        "flash": cli_flash,
+        "version": cli_version,
+        "erase": cli_erase,
+    }
+    try:
+        return cmd_tb[args.cmd](uart_port, args, result)
+    except serial.SerialException as e:
+        print(f"Serial error on {args.port}: {e}")
+        return EXIT_CODE.ERR_PORT
+    finally:
+        result["metrics"] = measure_metrics(uart_port).summary()
+        uart_port.close()
+
+
+def cli_main(argv: list = None) -> int:
+    """
+    Run one command without prompting.
+
+    Returns:
+        int: The process exit code, EXIT_CODE.SUCCESS on success.
+    """
+    args = cli_parse_args(argv)
+    result = {"cmd": args.cmd, "port": getattr(args, "port", None)}
+    t_start = time.perf_counter()
+
+    if args.json:
+        # keep stdout for the JSON object, progress goes to stderr
+        with contextlib.redirect_stdout(sys.stderr):
+            exit_code = cli_run(args, result)
+    else:
+        exit_code = cli_run(args, result)
+
+    result["exit_code"] = exit_code
+    result["ok"] = exit_code == EXIT_CODE.SUCCESS
+    result["elapsed_s"] = round(time.perf_counter() - t_start, 3)
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print(f"{args.cmd}: {'success' if result['ok'] else 'failed'} "
+              f"(exit code {exit_code})")
+    return exit_code
+
+
 #===========================================================================
 #                                 MAIN
 #===========================================================================
 
 if __name__ == "__main__":
+    # arguments select the headless CLI, none the interactive menu
+    if len(sys.argv) > 1:
+        sys.exit(cli_main())
     while (1):
         main()
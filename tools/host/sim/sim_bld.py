@@ -0,0 +1,597 @@
+import argparse
+import collections
+import math
+import os
+import random
+import select
+import sys
+import threading
+import time
+import tty
+import zlib
+
+HOST_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(HOST_DIR)
+sys.path.append(os.path.join(HOST_DIR, "utils"))
+sys.path.append(os.path.join(HOST_DIR, "common"))
+sys.path.append(os.path.join(HOST_DIR, "driverlib"))
+
+from dl_bld import (Cmd, BldCaps, BLD_FRAME_EXT_MARK, BLD_SECTOR_CRC_MAX,
+                    BLD_BAUD_CONFIRM_S)
+from common.memory_map import (FLASH_START_ADDR, FLASH_SIZE, SECTOR_SIZE,
+                               FLASH_BLD_START, FLASH_BLD_SIZE)
+from dl_uart import UART_BITS_PER_BYTE
+from utils.checksum import checksum_calc
+from utils.rle import rle_decode
+
+#
+# DEFINES AND VARIABLES
+#============================================================================
+
+SIM_BLD_VER = b"0.1A"
+SIM_REQ_ACK = 0x01
+# host writes reach the device in pieces of this size, so a burst of frames
+# is answered frame by frame instead of all at the end of the burst
+SIM_FEED_SIZE = 32
+# UART clock of the MSPM0 port, 16x oversampling
+SIM_UART_CLK = 24000000
+# partial frames are dropped after this idle time, or this many byte times
+# if longer, see BLD_RX_IDLE_MS and BLD_RX_IDLE_BYTES
+SIM_RX_IDLE_S = 0.02
+SIM_RX_IDLE_BYTES = 2
+
+#
+# Simulated device
+#============================================================================
+
+
+class BldSim:
+    """
+    Software model of the bootloader command handling, see bld_exe_cmd() in
+    projects/bld_mspm0/bootloader/src/bootloader.c.
+    """
+
+    def __init__(self,
+                 flash_start: int = FLASH_START_ADDR,
+                 flash_size: int = FLASH_SIZE,
+                 rx_frame_max: int = 256,
+                 has_caps: bool = True,
+                 protected: tuple = None):
+        """
+        Args:
+            rx_frame_max (int): RX buffer size, longer frames are dropped.
+            has_caps (bool): False emulates a bootloader without
+                CMD_GET_CAPS and CMD_WRITE_SEQ.
+            protected (tuple): (addr, size) that may not be erased or
+                written, the device would overwrite itself there.
+        """
+        self.rx_frame_max = rx_frame_max
+        self.has_caps = has_caps
+        self.protected = protected
+        self.flash_start = flash_start
+        self.flash = bytearray([0xFF]) * flash_size
+        self.write_seq = set()
+        self.sector_erases = 0  # flash wear counter
+        self.rx_buf = bytearray()
+        self.rx_last = 0.0  # time.monotonic() of the last byte received
+        self.running_app = False
+        self.baudrate = 115200
+        # (previous baudrate, deadline) until a CMD_SET_BAUD is confirmed
+        self.baud_revert = None
+
+    @classmethod
+    def memory_map(cls, **kwargs) -> "BldSim":
+        """
+        Device with the flash layout of common/memory_map.py, the bootloader
+        region is protected.
+        """
+        kwargs.setdefault("protected", (FLASH_BLD_START, FLASH_BLD_SIZE))
+        return cls(FLASH_START_ADDR, FLASH_SIZE, **kwargs)
+
+    def feed(self, data: bytes) -> bytes:
+        """
+        Receive bytes from the host, frames are split on their length byte
+        like the UART interrupt does.
+
+        Returns:
+            bytes: Responses of the frames completed by data.
+        """
+        self.tick()
+        self.rx_buf += data
+        self.rx_last = time.monotonic()
+        resp = bytearray()
+        while self.rx_buf:
+            frame_len = self.rx_buf[0]
+            if frame_len == BLD_FRAME_EXT_MARK:
+                if len(self.rx_buf) < 3:
+                    break
+                frame_len = max((self.rx_buf[1] << 8) | self.rx_buf[2], 3)
+            if len(self.rx_buf) < frame_len:
+                break
+            frame = bytes(self.rx_buf[:frame_len])
+            del self.rx_buf[:frame_len]
+            if frame_len <= self.rx_frame_max:
+                resp += self.handle(frame)
+        return bytes(resp)
+
+    def tick(self) -> None:
+        """
+        Restore the baudrate if the last CMD_SET_BAUD was not confirmed and
+        drop a partial frame once the line went idle.
+        """
+        now = time.monotonic()
+        if self.baud_revert and now > self.baud_revert[1]:
+            # no frame at the new baudrate, see hal_uart_switch_baud()
+            self.baudrate = self.baud_revert[0]
+            self.baud_revert = None
+            self.rx_buf.clear()
+        idle = max(SIM_RX_IDLE_S, SIM_RX_IDLE_BYTES * 10 / self.baudrate)
+        if self.rx_buf and now - self.rx_last > idle:
+            # see hal_uart_rx_idle_poll()
+            self.rx_buf.clear()
+
+    def handle(self, frame: bytes) -> bytes:
+        """Verify and execute one frame, returns the response frame."""
+        hdr = 3 if frame[0] == BLD_FRAME_EXT_MARK else 1
+        if len(frame) < hdr + 2:
+            return b""
+        cmd = frame[hdr]
+
+        if cmd in (Cmd.CMD_WRITE_CRC, Cmd.CMD_WRITE_SEQ, Cmd.CMD_WRITE_RLE):
+            if zlib.crc32(frame[:-4]) != int.from_bytes(frame[-4:], "big"):
+                if cmd != Cmd.CMD_WRITE_CRC:
+                    return self.resp(bytes([0x00, frame[hdr + 1]]))
+                return b""
+        elif hdr != 1 or checksum_calc(list(frame[:-1])) != frame[-1]:
+            return b""
+        # handlers see extended frames with the 1-byte header layout
+        frame = frame[hdr - 1:]
+        self.baud_revert = None
+        if not self.has_caps and cmd in (Cmd.CMD_WRITE_SEQ, Cmd.CMD_GET_CAPS,
+                                         Cmd.CMD_SECTOR_CRC,
+                                         Cmd.CMD_WRITE_RLE,
+                                         Cmd.CMD_SET_BAUD):
+            return b""
+
+        handler = {
+            Cmd.CMD_GET_BLD_VER: self.cmd_get_version,
+            Cmd.CMD_CHECK_BLANKING: self.cmd_check_blanking,
+            Cmd.CMD_ERASE: self.cmd_erase,
+            Cmd.CMD_WRITE: self.cmd_write,
+            Cmd.CMD_WRITE_CRC: self.cmd_write_crc,
+            Cmd.CMD_WRITE_SEQ: self.cmd_write_seq,
+            Cmd.CMD_IMAGE_CRC_VERIFY: self.cmd_crc_verify,
+            Cmd.CMD_EXIT_BLD: self.cmd_exit,
+            Cmd.CMD_GET_CAPS: self.cmd_get_caps,
+            Cmd.CMD_SECTOR_CRC: self.cmd_sector_crc,
+            Cmd.CMD_WRITE_RLE: self.cmd_write_rle,
+            Cmd.CMD_SET_BAUD: self.cmd_set_baud,
+        }.get(cmd)
+        return handler(frame) if handler else b""
+
+    @staticmethod
+    def resp(data: bytes) -> bytes:
+        frame = bytes([len(data) + 2]) + data
+        return frame + bytes([checksum_calc(list(frame))])
+
+    #
+    # Flash
+    #========================================================================
+
+    def flash_ofs(self, addr: int, size: int) -> int:
+        ofs = addr - self.flash_start
+        if ofs < 0 or ofs + size > len(self.flash):
+            raise IndexError(f"0x{addr:08X} + {size} is out of flash")
+        return ofs
+
+    def flash_check_writable(self, addr: int, size: int) -> None:
+        if self.protected is None:
+            return
+        p_addr, p_size = self.protected
+        if addr < p_addr + p_size and p_addr < addr + size:
+            raise IndexError(f"0x{addr:08X} + {size} hits the protected "
+                             f"region at 0x{p_addr:08X}")
+
+    def flash_read(self, addr: int, size: int) -> bytes:
+        ofs = self.flash_ofs(addr, size)
+        return bytes(self.flash[ofs:ofs + size])
+
+    def flash_write_words(self, addr: int, data: bytes) -> None:
+        """Program words sent MSB first, programming only clears bits."""
+        ofs = self.flash_ofs(addr, len(data))
+        self.flash_check_writable(addr, len(data))
+        for i in range(0, len(data) - len(data) % 4, 4):
+            for j, byte in enumerate(reversed(data[i:i + 4])):
+                self.flash[ofs + i + j] &= byte
+
+    #
+    # Commands
+    #========================================================================
+
+    def cmd_get_version(self, frame: bytes) -> bytes:
+        return self.resp(SIM_BLD_VER)
+
+    def cmd_check_blanking(self, frame: bytes) -> bytes:
+        addr = int.from_bytes(frame[2:6], "big")
+        size = int.from_bytes(frame[6:10], "big")
+        is_blank = self.flash_read(addr, size) == b"\xFF" * size
+        return self.resp(bytes([is_blank]))
+
+    def cmd_erase(self, frame: bytes) -> bytes:
+        addr = int.from_bytes(frame[2:6], "big")
+        size = int.from_bytes(frame[6:10], "big")
+        # one sector erase per SECTOR_SIZE step, as hal_flash_erase_mem()
+        for sector in range(addr, addr + size, SECTOR_SIZE):
+            sector -= sector % SECTOR_SIZE
+            ofs = self.flash_ofs(sector, SECTOR_SIZE)
+            self.flash_check_writable(sector, SECTOR_SIZE)
+            self.flash[ofs:ofs + SECTOR_SIZE] = b"\xFF" * SECTOR_SIZE
+            self.sector_erases += 1
+        self.write_seq.clear()
+        if frame[-2] == SIM_REQ_ACK:
+            return self.resp(b"\x01")
+        return b""
+
+    def cmd_write(self, frame: bytes) -> bytes:
+        addr = int.from_bytes(frame[2:6], "big")
+        self.flash_write_words(addr, frame[6:-2])
+        if frame[-2] == SIM_REQ_ACK:
+            return self.resp(b"\x01")
+        return b""
+
+    def cmd_write_crc(self, frame: bytes) -> bytes:
+        addr = int.from_bytes(frame[2:6], "big")
+        self.flash_write_words(addr, frame[6:-5])
+        if frame[-5] == SIM_REQ_ACK:
+            return self.resp(b"\x01")
+        return b""
+
+    def cmd_write_seq(self, frame: bytes) -> bytes:
+        seq = frame[2]
+        addr = int.from_bytes(frame[3:7], "big")
+        if seq not in self.write_seq:
+            self.flash_write_words(addr, frame[7:-5])
+            self.write_seq.add(seq)
+            self.write_seq.discard((seq + 128) & 0xFF)
+        return self.resp(bytes([0x01, seq]))
+
+    def cmd_write_rle(self, frame: bytes) -> bytes:
+        seq = frame[2]
+        addr = int.from_bytes(frame[3:7], "big")
+        size = int.from_bytes(frame[7:9], "big")
+        try:
+            data = rle_decode(frame[9:-5])
+        except ValueError:
+            data = b""
+        if len(data) != size or size % 4:
+            return self.resp(bytes([0x00, seq]))
+        if seq not in self.write_seq:
+            # same words as CMD_WRITE_SEQ would have carried
+            self.flash_write_words(
+                addr, b"".join(data[i:i + 4][::-1] for i in range(0, size, 4)))
+            self.write_seq.add(seq)
+            self.write_seq.discard((seq + 128) & 0xFF)
+        return self.resp(bytes([0x01, seq]))
+
+    def cmd_crc_verify(self, frame: bytes) -> bytes:
+        addr = int.from_bytes(frame[2:6], "big")
+        size = int.from_bytes(frame[6:10], "big")
+        ref_crc = int.from_bytes(frame[10:14], "big")
+        crc_ok = zlib.crc32(self.flash_read(addr, size)) == ref_crc
+        return self.resp(bytes([crc_ok]))
+
+    def cmd_get_caps(self, frame: bytes) -> bytes:
+        # an upload starts with the query, sequence numbers restart
+        self.write_seq.clear()
+        flags = BldCaps.WRITE_SEQ | BldCaps.SECTOR_CRC | BldCaps.WRITE_RLE | \
+            BldCaps.SET_BAUD
+        if self.rx_frame_max > 0xFF:
+            flags |= BldCaps.EXT_FRAME
+        return self.resp(
+            self.rx_frame_max.to_bytes(2, "big") + bytes([2, flags]))
+
+    def cmd_sector_crc(self, frame: bytes) -> bytes:
+        addr = int.from_bytes(frame[2:6], "big")
+        count = min(frame[6], BLD_SECTOR_CRC_MAX)
+        return self.resp(b"".join(
+            zlib.crc32(self.flash_read(addr + n * SECTOR_SIZE,
+                                       SECTOR_SIZE)).to_bytes(4, "big")
+            for n in range(count)))
+
+    def cmd_set_baud(self, frame: bytes) -> bytes:
+        baudrate = int.from_bytes(frame[2:6], "big")
+        # bld_baud_divisor(): 6-bit fractional divisor, 2% error at most
+        brd64 = (SIM_UART_CLK * 4 + baudrate // 2) // max(baudrate, 1)
+        ok = 64 <= brd64 and abs(SIM_UART_CLK * 4 // brd64 - baudrate) * \
+            50 <= baudrate
+        if ok:
+            self.baud_revert = (self.baudrate,
+                                time.monotonic() + BLD_BAUD_CONFIRM_S)
+            self.baudrate = baudrate
+        return self.resp(bytes([ok]))
+
+    def cmd_exit(self, frame: bytes) -> bytes:
+        self.running_app = True
+        return self.resp(b"\x01")
+
+
+#
+# Link
+#============================================================================
+
+
+class SimLink:
+    """
+    Impairments of the UART line between host and device: pacing at the
+    baudrate, a fixed one-way latency and random bit errors.
+
+    Times are time.monotonic() values, each direction of the line carries
+    one byte at a time like a real UART.
+    """
+    TX = 0  # host to device
+    RX = 1  # device to host
+
+    def __init__(self,
+                 baudrate: int = 115200,
+                 pace: bool = False,
+                 latency: float = 0.0,
+                 bit_error_rate: float = 0.0,
+                 seed: int = None,
+                 error_baud: int = None):
+        """
+        Args:
+            baudrate (int): Line rate used for pacing.
+            pace (bool): Hold bytes for their time on the wire.
+            latency (float): One-way delay in seconds added to every transfer,
+                e.g. the USB polling of a serial adapter.
+            bit_error_rate (float): Probability that a bit is flipped, in
+                both directions.
+            seed (int): Seed of the error generator, for repeatable runs.
+            error_baud (int): Bit errors only happen above this baudrate,
+                like on a long cable.
+        """
+        if not 0.0 <= bit_error_rate < 1.0:
+            raise ValueError("bit_error_rate must be in [0, 1)")
+        self.baudrate = baudrate
+        self.pace = pace
+        self.latency = latency
+        self.bit_error_rate = bit_error_rate
+        self.rng = random.Random(seed)
+        self.error_baud = error_baud
+        self.bit_errors = 0  # bits flipped so far
+        self._next_error = None
+        self._line_free = [0.0, 0.0]
+
+    def wire_time(self, nbytes: int) -> float:
+        if not self.pace:
+            return 0.0
+        return nbytes * UART_BITS_PER_BYTE / self.baudrate
+
+    def deliver(self, direction: int, t_send: float, nbytes: int) -> float:
+        """
+        Returns:
+            float: Time the last of nbytes sent at t_send reaches the other
+                end, bytes queue behind earlier ones on the same direction.
+        """
+        start = max(t_send, self._line_free[direction])
+        self._line_free[direction] = start + self.wire_time(nbytes)
+        return self._line_free[direction] + self.latency
+
+    def corrupt(self, data: bytes) -> bytes:
+        """Flip the bits of data that the error generator hits."""
+        if not self.bit_error_rate:
+            return data
+        if self.error_baud is not None and self.baudrate <= self.error_baud:
+            return data
+        if self._next_error is None:
+            self._next_error = self._error_gap()
+        nbits = len(data) * 8
+        pos = self._next_error
+        if pos >= nbits:
+            self._next_error = pos - nbits
+            return data
+
+        buf = bytearray(data)
+        while pos < nbits:
+            buf[pos >> 3] ^= 1 << (pos & 7)
+            self.bit_errors += 1
+            pos += 1 + self._error_gap()
+        self._next_error = pos - nbits
+        return bytes(buf)
+
+    def _error_gap(self) -> int:
+        # error free bits before the next error, geometric distribution so
+        # the generator runs once per error rather than once per bit
+        return int(
+            math.log(1.0 - self.rng.random()) /
+            math.log(1.0 - self.bit_error_rate))
+
+
+#
+# Transport
+#============================================================================
+
+
+class BldSimLoop:
+    """
+    In-process stand-in for serial.Serial wired to a BldSim, like pyserial's
+    loop:// but answered by the simulated device. Bytes sent at another
+    baudrate than the device one reach it as garbage.
+
+    It provides the subset of the serial.Serial interface used by the
+    driverlib, so dl_bld functions accept it as uart_port and no thread or
+    pty is needed.
+    """
+
+    def __init__(self,
+                 sim: BldSim,
+                 link: SimLink = None,
+                 timeout: float = 1.0):
+        self.sim = sim
+        self.link = link if link is not None else SimLink()
+        self.port = "sim://"
+        self.timeout = timeout
+        self.sim.baudrate = self.link.baudrate
+        self.is_open = True
+        self._rx = collections.deque()  # (ready time, bytes)
+
+    @property
+    def baudrate(self) -> int:
+        return self.link.baudrate
+
+    @baudrate.setter
+    def baudrate(self, value: int) -> None:
+        self.link.baudrate = value
+
+    @property
+    def in_waiting(self) -> int:
+        now = time.monotonic()
+        return sum(len(data) for ready, data in self._rx if ready <= now)
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        now = time.monotonic()
+        for ofs in range(0, len(data), SIM_FEED_SIZE):
+            piece = data[ofs:ofs + SIM_FEED_SIZE]
+            t_device = self.link.deliver(SimLink.TX, now, len(piece))
+            self.sim.tick()
+            if self.sim.baudrate != self.link.baudrate:
+                # the device samples garbage at another baudrate, mostly
+                # the idle high line
+                piece = bytes([0xFF]) * len(piece)
+            try:
+                resp = self.sim.feed(self.link.corrupt(piece))
+            except IndexError as e:
+                print(f"[SIM] {e}")
+                continue
+            if resp:
+                self._rx.append((self.link.deliver(SimLink.RX, t_device,
+                                                   len(resp)),
+                                 self.link.corrupt(resp)))
+        return len(data)
+
+    def read(self, size: int = 1) -> bytes:
+        """
+        Read up to size bytes, waiting at most timeout seconds like
+        serial.Serial.read().
+        """
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+        out = bytearray()
+        while True:
+            now = time.monotonic()
+            while self._rx and self._rx[0][0] <= now and len(out) < size:
+                ready, data = self._rx.popleft()
+                take = size - len(out)
+                out += data[:take]
+                if len(data) > take:
+                    self._rx.appendleft((ready, data[take:]))
+            if len(out) >= size:
+                break
+
+            wake = self._rx[0][0] if self._rx else None
+            if deadline is not None:
+                if now >= deadline:
+                    break
+                wake = deadline if wake is None else min(wake, deadline)
+            if wake is None:
+                break  # nothing will ever arrive
+            time.sleep(max(wake - now, 0))
+        return bytes(out)
+
+    def reset_input_buffer(self) -> None:
+        self._rx.clear()
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.is_open = False
+
+
+class BldSimPty:
+    """
+    Serve a BldSim on a pseudo-terminal, the host opens `port` like a real
+    serial device.
+    """
+
+    def __init__(self, sim: BldSim, link: SimLink = None):
+        self.sim = sim
+        self.link = link if link is not None else SimLink()
+        self.sim.baudrate = self.link.baudrate
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+
+    def start(self) -> "BldSimPty":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        # join before closing, a reused descriptor number would otherwise be
+        # read by this thread on behalf of the next pty
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        os.close(self.slave)
+        os.close(self.master)
+
+    def _serve(self) -> None:
+        pending = collections.deque()  # (due time, response)
+        while not self._stop.is_set():
+            now = time.monotonic()
+            while pending and pending[0][0] <= now:
+                os.write(self.master, pending.popleft()[1])
+            wait = 0.05
+            if pending:
+                wait = min(wait, pending[0][0] - now)
+            if not select.select([self.master], [], [], wait)[0]:
+                continue
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                return
+            now = time.monotonic()
+            for ofs in range(0, len(data), SIM_FEED_SIZE):
+                piece = data[ofs:ofs + SIM_FEED_SIZE]
+                t_device = self.link.deliver(SimLink.TX, now, len(piece))
+                try:
+                    resp = self.sim.feed(self.link.corrupt(piece))
+                except IndexError as e:
+                    print(f"[SIM] {e}")
+                    continue
+                if resp:
+                    pending.append((self.link.deliver(SimLink.RX, t_device,
+                                                      len(resp)),
+                                    self.link.corrupt(resp)))
+                # a pty has no line, pacing follows the device baudrate
+                self.link.baudrate = self.sim.baudrate
+
+
+def sim_parse_args():
+    parser = argparse.ArgumentParser(
+        description="Simulated bootloader on a pseudo-terminal")
+    parser.add_argument("--baudrate", type=int, default=115200)
+    parser.add_argument("--pace", action="store_true",
+                        help="hold bytes for their time on the wire")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="one-way delay in seconds")
+    parser.add_argument("--ber", type=float, default=0.0,
+                        help="bit error rate")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = sim_parse_args()
+    link = SimLink(args.baudrate, args.pace, args.latency, args.ber,
+                   args.seed)
+    pty_sim = BldSimPty(BldSim.memory_map(), link).start()
+    print(f"Simulated bootloader on {pty_sim.port}, Ctrl+C to stop")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pty_sim.stop()
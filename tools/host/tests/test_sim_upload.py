@@ -0,0 +1,72 @@
+import os
+import random
+import sys
+
+HOST_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(HOST_DIR)
+sys.path.append(os.path.join(HOST_DIR, "utils"))
+sys.path.append(os.path.join(HOST_DIR, "common"))
+sys.path.append(os.path.join(HOST_DIR, "driverlib"))
+sys.path.append(os.path.join(HOST_DIR, "sim"))
+
+from dl_bld import BLD_CHUNK_SIZE_LEGACY, dl_bld_upload_target_file
+from dl_file import ImageInfo
+from sim_bld import BldSim, BldSimLoop, SimLink
+from utils.measure import measure_metrics
+
+#
+# Uploads against the simulated bootloader, no board or pty needed
+#============================================================================
+
+SIM_FLASH_SIZE = 64 * 1024
+
+
+def _image(seed: int = 0) -> ImageInfo:
+    # two segments around a blank sector, the upload skips erasing it
+    rng = random.Random(seed)
+    image = ImageInfo()
+    image.add(0x1000, bytes(rng.randrange(256) for _ in range(3000)))
+    image.add(0x2000, bytes(rng.randrange(256) for _ in range(5000)))
+    return image
+
+
+def _upload(sim: BldSim, link: SimLink = None, **kwargs) -> BldSimLoop:
+    uart_port = BldSimLoop(sim, link, timeout=0.2)
+    image = _image()
+    assert dl_bld_upload_target_file(uart_port, image, **kwargs) == 1
+    for seg in image.segments:
+        assert sim.flash_read(seg.addr, len(seg.data)) == bytes(seg.data)
+    return uart_port
+
+
+def test_upload_pipelined():
+    uart_port = _upload(BldSim(0, SIM_FLASH_SIZE), window=8)
+    metrics = measure_metrics(uart_port)
+    assert metrics.counters["retries"] == 0
+    assert metrics.counters["timeouts"] == 0
+
+
+def test_upload_late_acks():
+    # ACKs of a whole window are still in flight when the next packets go
+    link = SimLink(latency=0.005)
+    uart_port = _upload(BldSim(0, SIM_FLASH_SIZE), link, window=8)
+    assert measure_metrics(uart_port).counters["retries"] == 0
+
+
+def test_upload_bit_errors():
+    # frequent enough for retries, rare enough that a chunk does not fail
+    # three times in a row whatever the seed
+    link = SimLink(bit_error_rate=3e-5, seed=1)
+    uart_port = _upload(BldSim(0, SIM_FLASH_SIZE), link, window=4)
+    assert link.bit_errors > 0
+    assert measure_metrics(uart_port).counters["retries"] > 0
+
+
+def test_upload_legacy():
+    # the device ignores CMD_GET_CAPS and CMD_WRITE_SEQ, the upload falls
+    # back to stop-and-wait CMD_WRITE_CRC of legacy sized chunks
+    uart_port = _upload(BldSim(0, SIM_FLASH_SIZE, has_caps=False),
+                        window=8)
+    num_chunks = sum(-(-len(seg.data) // BLD_CHUNK_SIZE_LEGACY)
+                     for seg in _image().segments)
+    assert measure_metrics(uart_port).counters["tx_frames"] >= num_chunks
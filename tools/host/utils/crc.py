@@ -4,187 +4,155 @@
 # https://www.youtube.com/watch?v=izG7qT0EpBw&ab_channel=BenEater
 ##################################################################################
 import binascii
+import zlib
 
 #################################################################################
 # CRC16 and CRC32 checksum calculation functions
+# CRC-32 and CRC-16-CCITT run in C (zlib / binascii), other polynomials use a
+# table built once at import
 ###################################################################################
 
+CRC16_POLY = 0x8005
 
-def crc16_ccitt_false(data_list: list[int]) -> int:
+
+def _crc16_table(polynomial: int) -> list[int]:
     """
-    Calculate the CRC-16-CCITT (False) checksum for a given list of 16-bit integers.
+    Build the 256 entry lookup table of a non reflected CRC-16.
     """
-    # Parameters for CRC-16-CCITT (False)
-    polynomial = 0x1021
-    crc = 0xFFFF
-
-    # Convert the list of 16-bit values into bytes (2 bytes per value, big-endian order)
-    data = b''.join(
-        value.to_bytes(2, byteorder='little') for value in data_list)
-
-    # Process each byte
-    for byte in data:
-        crc ^= (byte << 8)  # XOR byte into the upper 8 bits of CRC
+    table = []
+    for i in range(256):
+        crc = i << 8
         for _ in range(8):
-            if crc & 0x8000:  # if the uppermost bit is set
+            if crc & 0x8000:
                 crc = (crc << 1) ^ polynomial
             else:
                 crc <<= 1
-            crc &= 0xFFFF  # Trim CRC to 16 bits
+        table.append(crc & 0xFFFF)
+    return table
 
-    return crc
 
+_CRC16_TB = _crc16_table(CRC16_POLY)
 
-def crc32(data: bytearray, polynomial: int = 0xEDB88320) -> int:
-    gen_poly = polynomial
-    crc = 0xFFFFFFFF
 
-    for byte in data:
-        crc ^= byte  # XOR CRC với byte dữ liệu hiện tại
-        # Process each byte
-        for _ in range(8):
-            if crc & 1:  # Nếu bit cuối cùng của CRC là 1
-                crc = (crc >> 1) ^ gen_poly  # Dịch phải và XOR với polynomial
-            else:
-                crc >>= 1  # Nếu không thì chỉ dịch phải
+def _to_bytes(data):
+    """
+    Accept bytes-like objects as is, lists of byte values and str.
+    """
+    if isinstance(data, list):
+        return bytes(data)
+    if isinstance(data, str):
+        # one byte per character, the low byte of characters above U+00FF
+        # as the table driven code used
+        return bytes(ord(c) & 0xFF for c in data)
+    return data
+
+
+def crc16_ccitt_false(data_list: list[int]) -> int:
+    """
+    Calculate the CRC-16-CCITT (False) checksum for a given list of 16-bit integers.
+    """
+    # Convert the list of 16-bit values into bytes (2 bytes per value, little-endian order)
+    data = b''.join(
+        value.to_bytes(2, byteorder='little') for value in data_list)
+
+    # CRC-16-CCITT (False) is polynomial 0x1021 with initial value 0xFFFF
+    return binascii.crc_hqx(data, 0xFFFF)
 
-    return ~crc & 0xFFFFFFFF  # Lật bit cuối cùng trước khi trả về
 
+def crc32(data: bytearray, polynomial: int = 0xEDB88320) -> int:
+    """
+    CRC-32 (IEEE 802.3), other polynomials are not supported.
+    """
+    if polynomial != 0xEDB88320:
+        raise ValueError(f"Unsupported CRC-32 polynomial {polynomial:#010x}")
+    return zlib.crc32(_to_bytes(data))
 
-# Ví dụ sử dụng hàm tính CRC32
-data = b"Hello, World!"  # Dữ liệu truyền vào (chú ý là kiểu byte)
-crc = crc32(data)
-print(f"CRC32: {crc:08X}")  # In CRC32 theo định dạng hex (8 ký tự)
 
 ################################################################################
 #
 # CRC16 and 32 with lookup table
-# Note: For faster calculation, use lookup table method
+# Note: kept for their callers, both take bytes-like objects or lists
 ################################################################################
 
 
-def crc16_lookup_tb(data):
+def crc16_lookup_tb(data, CrcInit=0):
     '''
-    CRC-16 (CCITT) implemented with a precomputed lookup table
+    CRC-16 (polynomial 0x8005, no reflection) with the precomputed table
     '''
-    crc16_tb = [
-        0x0000, 0x8005, 0x800F, 0x000A, 0x801B, 0x001E, 0x0014, 0x8011, 0x8033,
-        0x0036, 0x003C, 0x8039, 0x0028, 0x802D, 0x8027, 0x0022, 0x8063, 0x0066,
-        0x006C, 0x8069, 0x0078, 0x807D, 0x8077, 0x0072, 0x0050, 0x8055, 0x805F,
-        0x005A, 0x804B, 0x004E, 0x0044, 0x8041, 0x80C3, 0x00C6, 0x00CC, 0x80C9,
-        0x00D8, 0x80DD, 0x80D7, 0x00D2, 0x00F0, 0x80F5, 0x80FF, 0x00FA, 0x80EB,
-        0x00EE, 0x00E4, 0x80E1, 0x00A0, 0x80A5, 0x80AF, 0x00AA, 0x80BB, 0x00BE,
-        0x00B4, 0x80B1, 0x8093, 0x0096, 0x009C, 0x8099, 0x0088, 0x808D, 0x8087,
-        0x0082, 0x8183, 0x0186, 0x018C, 0x8189, 0x0198, 0x819D, 0x8197, 0x0192,
-        0x01B0, 0x81B5, 0x81BF, 0x01BA, 0x81AB, 0x01AE, 0x01A4, 0x81A1, 0x01E0,
-        0x81E5, 0x81EF, 0x01EA, 0x81FB, 0x01FE, 0x01F4, 0x81F1, 0x81D3, 0x01D6,
-        0x01DC, 0x81D9, 0x01C8, 0x81CD, 0x81C7, 0x01C2, 0x0140, 0x8145, 0x814F,
-        0x014A, 0x815B, 0x015E, 0x0154, 0x8151, 0x8173, 0x0176, 0x017C, 0x8179,
-        0x0168, 0x816D, 0x8167, 0x0162, 0x8123, 0x0126, 0x012C, 0x8129, 0x0138,
-        0x813D, 0x8137, 0x0132, 0x0110, 0x8115, 0x811F, 0x011A, 0x810B, 0x010E,
-        0x0104, 0x8101, 0x8303, 0x0306, 0x030C, 0x8309, 0x0318, 0x831D, 0x8317,
-        0x0312, 0x0330, 0x8335, 0x833F, 0x033A, 0x832B, 0x032E, 0x0324, 0x8321,
-        0x0360, 0x8365, 0x836F, 0x036A, 0x837B, 0x037E, 0x0374, 0x8371, 0x8353,
-        0x0356, 0x035C, 0x8359, 0x0348, 0x834D, 0x8347, 0x0342, 0x03C0, 0x83C5,
-        0x83CF, 0x03CA, 0x83DB, 0x03DE, 0x03D4, 0x83D1, 0x83F3, 0x03F6, 0x03FC,
-        0x83F9, 0x03E8, 0x83ED, 0x83E7, 0x03E2, 0x83A3, 0x03A6, 0x03AC, 0x83A9,
-        0x03B8, 0x83BD, 0x83B7, 0x03B2, 0x0390, 0x8395, 0x839F, 0x039A, 0x838B,
-        0x038E, 0x0384, 0x8381, 0x0280, 0x8285, 0x828F, 0x028A, 0x829B, 0x029E,
-        0x0294, 0x8291, 0x82B3, 0x02B6, 0x02BC, 0x82B9, 0x02A8, 0x82AD, 0x82A7,
-        0x02A2, 0x82E3, 0x02E6, 0x02EC, 0x82E9, 0x02F8, 0x82FD, 0x82F7, 0x02F2,
-        0x02D0, 0x82D5, 0x82DF, 0x02DA, 0x82CB, 0x02CE, 0x02C4, 0x82C1, 0x8243,
-        0x0246, 0x024C, 0x8249, 0x0258, 0x825D, 0x8257, 0x0252, 0x0270, 0x8275,
-        0x827F, 0x027A, 0x826B, 0x026E, 0x0264, 0x8261, 0x0220, 0x8225, 0x822F,
-        0x022A, 0x823B, 0x023E, 0x0234, 0x8231, 0x8213, 0x0216, 0x021C, 0x8219,
-        0x0208, 0x820D, 0x8207, 0x0202
-    ]
-
-    if type(data) == list:
-        _data = ''
-        for e in data:
-            _data += '{:02x}'.format(e)
-        data = binascii.unhexlify(_data)
-    elif type(data) == bytes:
-        data = data
-
-    crc = 0
-    for byte in data:
-        crc = crc16_tb[((crc >> 8) ^ byte) & 0xFF] ^ (crc << 8)
-    crc = ((crc ^ 0) & ((1 << 16) - 1))
+    crc = CrcInit
+    for byte in _to_bytes(data):
+        crc = (_CRC16_TB[(crc >> 8) ^ byte] ^ (crc << 8)) & 0xFFFF
     return crc
 
 
-def crc32_lookup_tb(data: list[int], CrcInit=0):
+def crc32_lookup_tb(data, CrcInit=0):
     '''
-    CRC-32 implemented with a precomputed lookup table
+    CRC-32 (IEEE 802.3), CrcInit continues a previous result
     '''
-    crc32_tb = [
-        0x00000000, 0x77073096, 0xEE0E612C, 0x990951BA, 0x076DC419, 0x706AF48F,
-        0xE963A535, 0x9E6495A3, 0x0EDB8832, 0x79DCB8A4, 0xE0D5E91E, 0x97D2D988,
-        0x09B64C2B, 0x7EB17CBD, 0xE7B82D07, 0x90BF1D91, 0x1DB71064, 0x6AB020F2,
-        0xF3B97148, 0x84BE41DE, 0x1ADAD47D, 0x6DDDE4EB, 0xF4D4B551, 0x83D385C7,
-        0x136C9856, 0x646BA8C0, 0xFD62F97A, 0x8A65C9EC, 0x14015C4F, 0x63066CD9,
-        0xFA0F3D63, 0x8D080DF5, 0x3B6E20C8, 0x4C69105E, 0xD56041E4, 0xA2677172,
-        0x3C03E4D1, 0x4B04D447, 0xD20D85FD, 0xA50AB56B, 0x35B5A8FA, 0x42B2986C,
-        0xDBBBC9D6, 0xACBCF940, 0x32D86CE3, 0x45DF5C75, 0xDCD60DCF, 0xABD13D59,
-        0x26D930AC, 0x51DE003A, 0xC8D75180, 0xBFD06116, 0x21B4F4B5, 0x56B3C423,
-        0xCFBA9599, 0xB8BDA50F, 0x2802B89E, 0x5F058808, 0xC60CD9B2, 0xB10BE924,
-        0x2F6F7C87, 0x58684C11, 0xC1611DAB, 0xB6662D3D, 0x76DC4190, 0x01DB7106,
-        0x98D220BC, 0xEFD5102A, 0x71B18589, 0x06B6B51F, 0x9FBFE4A5, 0xE8B8D433,
-        0x7807C9A2, 0x0F00F934, 0x9609A88E, 0xE10E9818, 0x7F6A0DBB, 0x086D3D2D,
-        0x91646C97, 0xE6635C01, 0x6B6B51F4, 0x1C6C6162, 0x856530D8, 0xF262004E,
-        0x6C0695ED, 0x1B01A57B, 0x8208F4C1, 0xF50FC457, 0x65B0D9C6, 0x12B7E950,
-        0x8BBEB8EA, 0xFCB9887C, 0x62DD1DDF, 0x15DA2D49, 0x8CD37CF3, 0xFBD44C65,
-        0x4DB26158, 0x3AB551CE, 0xA3BC0074, 0xD4BB30E2, 0x4ADFA541, 0x3DD895D7,
-        0xA4D1C46D, 0xD3D6F4FB, 0x4369E96A, 0x346ED9FC, 0xAD678846, 0xDA60B8D0,
-        0x44042D73, 0x33031DE5, 0xAA0A4C5F, 0xDD0D7CC9, 0x5005713C, 0x270241AA,
-        0xBE0B1010, 0xC90C2086, 0x5768B525, 0x206F85B3, 0xB966D409, 0xCE61E49F,
-        0x5EDEF90E, 0x29D9C998, 0xB0D09822, 0xC7D7A8B4, 0x59B33D17, 0x2EB40D81,
-        0xB7BD5C3B, 0xC0BA6CAD, 0xEDB88320, 0x9ABFB3B6, 0x03B6E20C, 0x74B1D29A,
-        0xEAD54739, 0x9DD277AF, 0x04DB2615, 0x73DC1683, 0xE3630B12, 0x94643B84,
-        0x0D6D6A3E, 0x7A6A5AA8, 0xE40ECF0B, 0x9309FF9D, 0x0A00AE27, 0x7D079EB1,
-        0xF00F9344, 0x8708A3D2, 0x1E01F268, 0x6906C2FE, 0xF762575D, 0x806567CB,
-        0x196C3671, 0x6E6B06E7, 0xFED41B76, 0x89D32BE0, 0x10DA7A5A, 0x67DD4ACC,
-        0xF9B9DF6F, 0x8EBEEFF9, 0x17B7BE43, 0x60B08ED5, 0xD6D6A3E8, 0xA1D1937E,
-        0x38D8C2C4, 0x4FDFF252, 0xD1BB67F1, 0xA6BC5767, 0x3FB506DD, 0x48B2364B,
-        0xD80D2BDA, 0xAF0A1B4C, 0x36034AF6, 0x41047A60, 0xDF60EFC3, 0xA867DF55,
-        0x316E8EEF, 0x4669BE79, 0xCB61B38C, 0xBC66831A, 0x256FD2A0, 0x5268E236,
-        0xCC0C7795, 0xBB0B4703, 0x220216B9, 0x5505262F, 0xC5BA3BBE, 0xB2BD0B28,
-        0x2BB45A92, 0x5CB36A04, 0xC2D7FFA7, 0xB5D0CF31, 0x2CD99E8B, 0x5BDEAE1D,
-        0x9B64C2B0, 0xEC63F226, 0x756AA39C, 0x026D930A, 0x9C0906A9, 0xEB0E363F,
-        0x72076785, 0x05005713, 0x95BF4A82, 0xE2B87A14, 0x7BB12BAE, 0x0CB61B38,
-        0x92D28E9B, 0xE5D5BE0D, 0x7CDCEFB7, 0x0BDBDF21, 0x86D3D2D4, 0xF1D4E242,
-        0x68DDB3F8, 0x1FDA836E, 0x81BE16CD, 0xF6B9265B, 0x6FB077E1, 0x18B74777,
-        0x88085AE6, 0xFF0F6A70, 0x66063BCA, 0x11010B5C, 0x8F659EFF, 0xF862AE69,
-        0x616BFFD3, 0x166CCF45, 0xA00AE278, 0xD70DD2EE, 0x4E048354, 0x3903B3C2,
-        0xA7672661, 0xD06016F7, 0x4969474D, 0x3E6E77DB, 0xAED16A4A, 0xD9D65ADC,
-        0x40DF0B66, 0x37D83BF0, 0xA9BCAE53, 0xDEBB9EC5, 0x47B2CF7F, 0x30B5FFE9,
-        0xBDBDF21C, 0xCABAC28A, 0x53B39330, 0x24B4A3A6, 0xBAD03605, 0xCDD70693,
-        0x54DE5729, 0x23D967BF, 0xB3667A2E, 0xC4614AB8, 0x5D681B02, 0x2A6F2B94,
-        0xB40BBE37, 0xC30C8EA1, 0x5A05DF1B, 0x2D02EF8D
-    ]
-
-    if isinstance(data, list):
-        _data = ''
-        for e in data:
-            _data += '{:02x}'.format(e)
-        data = binascii.unhexlify(_data)
-        
-    elif isinstance(data, bytes):
-        data = data
-    elif isinstance(data, str):
-        _data = []
-        for e in data:
-            _data.append(ord(e))
-        data = _data
-
-    crc = CrcInit ^ 0xFFFFFFFF
-    for byte in data:
-        crc = crc32_tb[(int(crc) ^ byte) & 0xFF] ^ (crc >> 8)
-    crc = crc ^ 0xFFFFFFFF
-    return crc
+    return zlib.crc32(_to_bytes(data), CrcInit)
 
 
 #
-# Data type conversion functions
+# Streaming interface
 ################################################################################
+
+
+class Crc32:
+    """
+    Incremental CRC-32, for data that is produced or received in pieces.
+
+    Example:
+        crc = Crc32()
+        for chunk in chunks:
+            crc.update(chunk)
+        crc.digest()
+    """
+
+    def __init__(self, data=b"", value: int = 0):
+        self.value = value
+        self.update(data)
+
+    def update(self, data) -> "Crc32":
+        self.value = zlib.crc32(_to_bytes(data), self.value)
+        return self
+
+    def digest(self) -> bytes:
+        """
+        Returns:
+            bytes: The CRC in the big endian order used on the wire.
+        """
+        return self.value.to_bytes(4, "big")
+
+    def copy(self) -> "Crc32":
+        return Crc32(value=self.value)
+
+
+class Crc16:
+    """
+    Incremental CRC-16, CRC-16-CCITT (False) by default or the table driven
+    polynomial 0x8005 variant of crc16_lookup_tb().
+    """
+    CCITT_FALSE = 0x1021
+
+    def __init__(self, data=b"", polynomial: int = CCITT_FALSE,
+                 value: int = None):
+        if polynomial not in (self.CCITT_FALSE, CRC16_POLY):
+            raise ValueError(f"Unsupported CRC-16 polynomial {polynomial:#06x}")
+        self.polynomial = polynomial
+        if value is None:
+            value = 0xFFFF if polynomial == self.CCITT_FALSE else 0
+        self.value = value
+        self.update(data)
+
+    def update(self, data) -> "Crc16":
+        if self.polynomial == self.CCITT_FALSE:
+            self.value = binascii.crc_hqx(_to_bytes(data), self.value)
+        else:
+            self.value = crc16_lookup_tb(data, self.value)
+        return self
+
+    def digest(self) -> bytes:
+        return self.value.to_bytes(2, "big")
+
+    def copy(self) -> "Crc16":
+        return Crc16(polynomial=self.polynomial, value=self.value)
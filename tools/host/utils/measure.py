@@ -1,10 +1,147 @@
+import collections
+import contextlib
+import functools
+import logging
 import time
+import weakref
+
+#
+# Hooks
+#============================================================================
+
+# callables taking one event dict:
+#   {"kind": "span" | "count", "source": str | None, "name": str,
+#    "value": int}
+# a span value is its duration in ns, a count value the increment
+_hooks = []
+
+
+def measure_add_hook(hook) -> None:
+    """Send every span and counter event to hook(event)."""
+    if hook not in _hooks:
+        _hooks.append(hook)
+
+
+def measure_remove_hook(hook) -> None:
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+
+def measure_logging_hook(logger: logging.Logger = None,
+                         level: int = logging.DEBUG):
+    """
+    Returns:
+        callable: A hook writing the events to logger, for
+            measure_add_hook().
+    """
+    logger = logger or logging.getLogger("bld.measure")
+
+    def hook(event: dict) -> None:
+        if event["kind"] == "span":
+            logger.log(level, "%s span %s %.3f ms", event["source"],
+                       event["name"], event["value"] / 1e6)
+        else:
+            logger.log(level, "%s count %s +%d", event["source"],
+                       event["name"], event["value"])
+
+    return hook
+
+
+def _emit(kind: str, source, name: str, value: int) -> None:
+    if not _hooks:
+        return
+    event = {"kind": kind, "source": source, "name": name, "value": value}
+    for hook in list(_hooks):
+        hook(event)
+
+
+#
+# Metrics
+#============================================================================
+
+
+class Metrics:
+    """
+    Phase spans and counters of one source, usually a UART port.
+
+    Counters used by the driverlib:
+        tx_bytes, tx_frames, rx_bytes, rx_frames, timeouts, retries, nacks,
+        crc_mismatches, cache_hits, cache_misses (process wide)
+    Spans: parse_hex, parse_bin, parse_elf, convert, caps, delta, erase, write,
+        verify
+    """
+
+    def __init__(self, source: str = None):
+        self.source = source
+        self.counters = collections.Counter()
+        self.spans = []  # (name, duration in ns), in completion order
+
+    def count(self, name: str, value: int = 1) -> None:
+        self.counters[name] += value
+        _emit("count", self.source, name, value)
+
+    @contextlib.contextmanager
+    def span(self, name: str):
+        """Time the with block with perf_counter_ns as phase `name`."""
+        start = time.perf_counter_ns()
+        try:
+            yield self
+        finally:
+            duration = time.perf_counter_ns() - start
+            self.spans.append((name, duration))
+            _emit("span", self.source, name, duration)
+
+    def phase_ns(self) -> dict:
+        """Total duration of every phase, repeated spans add up."""
+        phases = collections.defaultdict(int)
+        for name, duration in self.spans:
+            phases[name] += duration
+        return dict(phases)
+
+    def summary(self) -> dict:
+        return {
+            "source": self.source,
+            "counters": dict(self.counters),
+            "phases_s": {
+                name: round(duration / 1e9, 6)
+                for name, duration in self.phase_ns().items()
+            },
+        }
+
+    def reset(self) -> None:
+        self.counters.clear()
+        self.spans.clear()
+
+
+# one Metrics per port, dropped with the port like the UART frame parsers
+_metrics = weakref.WeakKeyDictionary()
+# work that is not tied to a port, e.g. file parsing
+_metrics_global = Metrics()
+
+
+def measure_metrics(key=None) -> Metrics:
+    """
+    Args:
+        key: Object the metrics belong to, usually a serial.Serial; None
+            for the process wide metrics.
+
+    Returns:
+        Metrics: The metrics bound to key.
+    """
+    if key is None:
+        return _metrics_global
+    metrics = _metrics.get(key)
+    if metrics is None:
+        metrics = _metrics[key] = Metrics(getattr(key, "port", None))
+    return metrics
+
 
 def measure_exe_time(func):
+    """Record every call of func as a span of the process wide metrics."""
+
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        start = time.time()
-        result = func(*args, **kwargs)
-        end = time.time()
-        print(f"[DBG] {func.__name__} executed in {end - start:.6f} seconds")
-        return result
-    return wrapper
\ No newline at end of file
+        with _metrics_global.span(func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,73 @@
+#################################################################################
+# Run-length encoding of write payloads (PackBits)
+# The bootloader expands it while programming, see bld_rle_expand() in
+# sources/bld/bld.c
+#################################################################################
+import re
+
+#################################################################################
+# Control byte n:
+#   0x00..0x7F  copy the next n + 1 bytes
+#   0x81..0xFF  repeat the next byte 257 - n times (2..128)
+#   0x80        no operation
+#################################################################################
+
+RLE_LITERAL_MAX = 128
+RLE_RUN_MAX = 128
+RLE_RUN_MIN = 3  # shorter runs cost as much as literals
+
+# runs of RLE_RUN_MIN or more identical bytes, found by the C regex engine
+_RLE_RUN_RE = re.compile(rb"(.)\1{%d,}" % (RLE_RUN_MIN - 1), re.DOTALL)
+
+
+def _rle_literals(out: bytearray, data, start: int, end: int) -> None:
+    for ofs in range(start, end, RLE_LITERAL_MAX):
+        size = min(RLE_LITERAL_MAX, end - ofs)
+        out.append(size - 1)
+        out += data[ofs:ofs + size]
+
+
+def rle_encode(data) -> bytes:
+    """
+    Encode bytes-like data, the output is at most len(data) / 128 + 1 bytes
+    longer than the input.
+    """
+    data = bytes(data)
+    out = bytearray()
+    ofs = 0
+    for run in _RLE_RUN_RE.finditer(data):
+        _rle_literals(out, data, ofs, run.start())
+        value = data[run.start()]
+        size = run.end() - run.start()
+        while size >= RLE_RUN_MIN:
+            step = min(size, RLE_RUN_MAX)
+            out += bytes((257 - step, value))
+            size -= step
+        ofs = run.end() - size  # 1 or 2 bytes left over are literals
+    _rle_literals(out, data, ofs, len(data))
+    return bytes(out)
+
+
+def rle_decode(data) -> bytes:
+    """
+    Expand rle_encode() output.
+
+    Raises:
+        ValueError: The data is truncated.
+    """
+    out = bytearray()
+    ofs = 0
+    while ofs < len(data):
+        ctrl = data[ofs]
+        ofs += 1
+        if ctrl < 0x80:
+            if ofs + ctrl + 1 > len(data):
+                raise ValueError("Truncated RLE literal")
+            out += data[ofs:ofs + ctrl + 1]
+            ofs += ctrl + 1
+        elif ctrl > 0x80:
+            if ofs >= len(data):
+                raise ValueError("Truncated RLE run")
+            out += bytes([data[ofs]]) * (257 - ctrl)
+            ofs += 1
+    return bytes(out)